@@ -5,5 +5,27 @@ from .version import __version__
 
 PACKAGEDIR = os.path.dirname(os.path.abspath(__file__))
 KEPLER_CHANNEL_SHAPE = (1070, 1132)  # (rows, cols)
+QUALITY_NO_DATA = 65536  # QUALITY flag raised when a cadence contains no data
 
-from .mosaic import *
+# The public names of `k2mosaic.mosaic`, which are imported on first use
+_MOSAIC_NAMES = ['FFI_HEADERS_FILE', 'WCS_KEYS', 'MosaicException', 'KeplerChannelMosaic',
+                 'KeplerChannelStack', 'SparseChannelMosaic', 'atomic_writeto',
+                 'export_ffi_headers', 'get_ffi_header']
+__all__ = ['PACKAGEDIR', 'KEPLER_CHANNEL_SHAPE', 'QUALITY_NO_DATA'] + _MOSAIC_NAMES
+
+
+def __getattr__(name):
+    """Imports the mosaicking classes (e.g. `KeplerChannelMosaic`) from
+    `k2mosaic.mosaic` on first use, because they depend on astropy."""
+    if name.startswith('__'):
+        raise AttributeError(name)
+    import importlib
+    mosaic = importlib.import_module('.mosaic', __name__)
+    try:
+        return getattr(mosaic, name)
+    except AttributeError:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_MOSAIC_NAMES))
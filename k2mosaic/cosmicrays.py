@@ -0,0 +1,199 @@
+"""Detects cosmic rays as short-lived positive outliers in the TPF pixels.
+
+The flux of each pixel is compared with the median of the neighbouring
+cadences, and flagged if it exceeds the median by more than `nsigma` times
+the robust scatter (1.4826 x the median absolute deviation) of the window,
+or of the pipeline uncertainty if that is larger.  The statistics are
+computed for all pixels and all cadences of a chunk at once, and the TPFs
+are read in chunks of cadences, so a full campaign never has to be held
+in memory.
+
+The detected events are saved to a table with one row per event, from
+which each mosaic fills its COSMIC_RAY extension.
+
+Example usage
+-------------
+events = detect_cosmic_rays(tpf_filenames, half_window=5, nsigma=5.)
+write_cosmic_rays(events, 'k2mosaic-c05-ch15-cosmicrays.fits')
+mos.add_cosmic_rays(*cosmic_rays_at(events, cadenceno=mos.cadenceno), clean=True)
+"""
+import warnings
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE, QUALITY_NO_DATA
+
+MAD_TO_SIGMA = 1.4826  # Ratio of the standard deviation and MAD of a Gaussian
+EVENT_COLUMNS = ['CADENCENO', 'RAWX', 'RAWY', 'COSMIC_RAY']
+EVENT_DTYPES = {'CADENCENO': np.int32, 'RAWX': np.int16, 'RAWY': np.int16,
+                'COSMIC_RAY': np.float32}
+
+
+def rolling_median_mad(flux, half_window):
+    """Returns the median and median absolute deviation of each value of
+    `flux` over the window of +/- `half_window` neighbouring rows.
+
+    Parameters
+    ----------
+    flux : array of shape (n_cadences, n_pixels)
+        NaN values are ignored; the window is truncated at the edges.
+
+    half_window : int
+
+    Returns
+    -------
+    median, mad : arrays with the same shape as `flux`
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    padded = np.pad(flux, [(half_window, half_window), (0, 0)],
+                    mode='constant', constant_values=np.nan)
+    # Shape (n_cadences, n_pixels, 2 * half_window + 1); a view, not a copy
+    windows = sliding_window_view(padded, 2 * half_window + 1, axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN windows
+        median = np.nanmedian(windows, axis=-1)
+        mad = np.nanmedian(np.abs(windows - median[..., None]), axis=-1)
+    return median, mad
+
+
+def find_outliers(flux, flux_err, half_window=5, nsigma=5.):
+    """Returns a boolean array flagging the positive outliers in `flux`,
+    and the excess flux of every value above the rolling median."""
+    median, mad = rolling_median_mad(flux, half_window)
+    excess = flux - median
+    scatter = np.fmax(MAD_TO_SIGMA * mad, flux_err)
+    with np.errstate(invalid='ignore'):
+        return excess > nsigma * scatter, excess
+
+
+def detect_in_tpf(tpf_filename, half_window=5, nsigma=5., chunk_size=256,
+                  add_background=False, cadence_range=None, mask=None, pointing=None):
+    """Returns the cosmic ray events found in one TPF.
+
+    The TPF is read `chunk_size` cadences at a time, plus `half_window`
+    cadences on either side so that the windows are not truncated at the
+    chunk boundaries.  Only the collected pixels of the aperture are used.
+
+    Parameters
+    ----------
+    cadence_range : (int, int), optional
+        Only report events between these two cadence numbers (inclusive).
+
+    mask : boolean array, optional
+        Aperture pixels to search, defaults to all collected pixels.
+
+    pointing : `k2mosaic.pointing.PointingTracker`, optional
+        Fed the flux of every chunk, so that the centroids of the aperture
+        are measured in the same pass.
+
+    Returns
+    -------
+    events : dict of arrays
+        With keys `EVENT_COLUMNS`, i.e. the cadence number, the column
+        (RAWX) and row (RAWY) of the pixel, and its excess flux.
+    """
+    import fitsio
+    from .geometry import pinned_path, geometry_from_fits
+    from .pointing import feed_chunk, tpf_columns
+    with pinned_path(tpf_filename) as path, fitsio.FITS(path) as tpf:
+        geo = geometry_from_fits(tpf_filename, tpf)
+        rows, cols = np.nonzero(geo.mask if mask is None else mask & geo.mask)
+        cadenceno = tpf[1].read(columns=['CADENCENO'])['CADENCENO']
+        first, last = 0, len(cadenceno)
+        if cadence_range is not None:
+            first, last = np.searchsorted(cadenceno, [cadence_range[0], cadence_range[1] + 1])
+        columns = ['FLUX', 'FLUX_ERR', 'QUALITY']
+        if add_background:
+            columns += ['FLUX_BKG', 'FLUX_BKG_ERR']
+        columns += tpf_columns(tpf, pointing)
+        events = {column: [] for column in EVENT_COLUMNS}
+        for start in range(first, last, chunk_size):
+            stop = min(start + chunk_size, last)
+            # Read the chunk together with a halo of neighbouring cadences
+            lo, hi = max(start - half_window, 0), min(stop + half_window, len(cadenceno))
+            tbl = tpf[1].read(columns=columns, rows=np.arange(lo, hi))
+            if pointing is not None:
+                feed_chunk(pointing, cadenceno[start:stop], tbl[start - lo:stop - lo], geo.mask)
+            flux, flux_err = tbl['FLUX'][:, rows, cols], tbl['FLUX_ERR'][:, rows, cols]
+            if add_background:
+                flux = flux + tbl['FLUX_BKG'][:, rows, cols]
+                flux_err = np.hypot(flux_err, tbl['FLUX_BKG_ERR'][:, rows, cols])
+            flux[(tbl['QUALITY'] & QUALITY_NO_DATA) > 0] = np.nan
+            outliers, excess = find_outliers(flux, flux_err, half_window, nsigma)
+            outliers[:start - lo] = False
+            outliers[stop - lo:] = False
+            cad_idx, pix_idx = np.nonzero(outliers)
+            events['CADENCENO'].append(cadenceno[lo + cad_idx])
+            events['RAWX'].append(geo.col + cols[pix_idx])
+            events['RAWY'].append(geo.row + rows[pix_idx])
+            events['COSMIC_RAY'].append(excess[cad_idx, pix_idx])
+    if pointing is not None:
+        pointing.finish_tpf()
+    return _concatenate(events)
+
+
+def detect_cosmic_rays(tpf_filenames, ownership=None, **kwargs):
+    """Returns the cosmic ray events found in a set of TPFs, sorted by cadence.
+
+    Only the pixels which each TPF supplies to the mosaics, according to
+    the `k2mosaic.ownership.OwnershipMap` `ownership`, are searched.  The
+    other keyword arguments are passed on to `detect_in_tpf`.
+    """
+    masks = mosaic_masks(tpf_filenames, ownership=ownership)
+    return merge_events([detect_in_tpf(fn, mask=mask, **kwargs)
+                         for fn, mask in zip(tpf_filenames, masks)])
+
+
+def mosaic_masks(tpf_filenames, shape=KEPLER_CHANNEL_SHAPE, ownership=None):
+    """Returns the aperture pixels of each TPF which end up in a mosaic:
+    the pixels it owns in the `k2mosaic.ownership.OwnershipMap` `ownership`,
+    or, without a map, those not overwritten by a TPF further down the list."""
+    if ownership is None:
+        from .ownership import OwnershipMap
+        ownership = OwnershipMap.from_tpfs(tpf_filenames, policy='last', shape=shape)
+    return [ownership.mask(fn) for fn in tpf_filenames]
+
+
+def merge_events(events):
+    """Combines the events of several TPFs, sorted by cadence."""
+    events = _concatenate({column: [event[column] for event in events]
+                           for column in EVENT_COLUMNS})
+    order = np.argsort(events['CADENCENO'], kind='stable')
+    return {column: values[order] for column, values in events.items()}
+
+
+def cosmic_rays_at(events, cadenceno):
+    """Returns the (row, col, excess) of the events at one cadence."""
+    lo, hi = np.searchsorted(events['CADENCENO'], [cadenceno, cadenceno + 1])
+    return events['RAWY'][lo:hi], events['RAWX'][lo:hi], events['COSMIC_RAY'][lo:hi]
+
+
+def write_cosmic_rays(events, output_fn, half_window=None, nsigma=None):
+    """Saves the events returned by `detect_cosmic_rays` to a FITS table."""
+    from astropy.io import fits
+    from .mosaic import atomic_writeto
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='CADENCENO', format='J', array=events['CADENCENO']),
+        fits.Column(name='RAWX', format='I', array=events['RAWX']),
+        fits.Column(name='RAWY', format='I', array=events['RAWY']),
+        fits.Column(name='COSMIC_RAY', format='E', array=events['COSMIC_RAY'])])
+    hdu.header['EXTNAME'] = 'COSMIC_RAYS'
+    if half_window is not None:
+        hdu.header['CRWINDOW'] = (half_window, 'half width of the rolling window [cadences]')
+    if nsigma is not None:
+        hdu.header['CRNSIGMA'] = (nsigma, 'detection threshold [sigma]')
+    atomic_writeto(fits.HDUList([fits.PrimaryHDU(), hdu]), output_fn)
+
+
+def read_cosmic_rays(filename):
+    """Reads a table written by `write_cosmic_rays`."""
+    import fitsio
+    tbl = fitsio.read(filename, ext=1)
+    return {column: tbl[column] for column in EVENT_COLUMNS}
+
+
+def _concatenate(events):
+    """Turns a dict of lists of arrays into a dict of arrays."""
+    return {column: np.concatenate([np.empty(0, dtype=EVENT_DTYPES[column])] +
+                                   events[column]).astype(EVENT_DTYPES[column])
+            for column in EVENT_COLUMNS}
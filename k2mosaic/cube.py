@@ -0,0 +1,219 @@
+"""Lazy (cadence, row, col) cube over the pixels of a set of Target Pixel Files.
+
+Indexing the cube only reads the TPFs which overlap the requested box,
+and only the requested cadences of those TPFs.  Decoded blocks of cadences
+are kept in a least-recently-used cache with a limit in bytes.
+
+Example usage
+-------------
+cube = KeplerChannelCube(tpf_filenames)
+cube.shape  # (n_cadences, 1070, 1132)
+cutout = cube[1000:1100, 200:400, 300:500]
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE
+from .geometry import pinned_path, geometry_from_fits
+
+
+class LRUCache(object):
+    """Dictionary-like cache which evicts the least recently used items
+    once the total size of its values (in bytes) exceeds `max_bytes`.
+
+    It is safe to use from several threads.
+    """
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Returns a cached value, or `default` if `key` is not cached."""
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = item  # Mark as most recently used
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes=None):
+        """Adds a value, evicting old items if needed.  Values larger
+        than the whole cache are not stored."""
+        if nbytes is None:
+            nbytes = value.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._items.popitem(last=False)[1][1]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total > 0 else 0.
+
+    def stats(self):
+        return {'items': len(self), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
+class KeplerChannelCube(object):
+    """Read-only (cadence, row, col) array of the pixels of a set of TPFs.
+
+    The cadence axis runs over the rows of the TPF tables, i.e. index 0
+    corresponds to cadence number ``cube.cadenceno[0]``.  Pixels which are
+    not covered by any TPF are NaN.  Where apertures overlap, the last TPF
+    in the list wins, like in `KeplerChannelMosaic`.
+
+    Parameters
+    ----------
+    tpf_filenames : list of str
+        Paths or urls of the TPFs of a single channel.
+
+    column : str
+        TPF table column to expose, e.g. 'FLUX' or 'FLUX_ERR'.
+
+    add_background : bool
+        Add FLUX_BKG to FLUX (or FLUX_BKG_ERR in quadrature to FLUX_ERR).
+
+    block_size : int
+        Number of cadences of a TPF which are read and cached together.
+
+    cache : `LRUCache` or int
+        Cache of decoded blocks, or its size in bytes.
+    """
+    def __init__(self, tpf_filenames, column='FLUX', add_background=False,
+                 block_size=64, cache=256 * 1024**2, shape=KEPLER_CHANNEL_SHAPE):
+        import fitsio
+        self.tpf_filenames = tpf_filenames
+        self.column = column
+        self.add_background = add_background
+        self.block_size = block_size
+        self.cache = cache if isinstance(cache, LRUCache) else LRUCache(cache)
+        self.channel_shape = shape
+        self.geometry, self.first_cadenceno, n_rows = [], [], []
+        for fn in tpf_filenames:
+            with pinned_path(fn) as path, fitsio.FITS(path) as tpf:
+                self.geometry.append(geometry_from_fits(fn, tpf))
+                self.first_cadenceno.append(
+                    int(tpf[1].read(columns=['CADENCENO'], rows=[0])['CADENCENO'][0]))
+                n_rows.append(tpf[1].get_nrows())
+        self.first_cadenceno = np.array(self.first_cadenceno)
+        self.cadenceno = np.arange(self.first_cadenceno.min(),
+                                   (self.first_cadenceno + n_rows).max())
+        self._n_rows = np.array(n_rows)
+        self._rows = np.array([geo.row for geo in self.geometry])
+        self._cols = np.array([geo.col for geo in self.geometry])
+        self._heights = np.array([geo.height for geo in self.geometry])
+        self._widths = np.array([geo.width for geo in self.geometry])
+
+    @property
+    def shape(self):
+        return (len(self.cadenceno),) + tuple(self.channel_shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError('too many indices for a (cadence, row, col) cube')
+        key = key + (slice(None),) * (3 - len(key))
+        ranges, squeeze = [], []
+        for axis, (k, length) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                ranges.append(range(*k.indices(length)))
+            elif isinstance(k, (int, np.integer)):
+                if not -length <= k < length:
+                    raise IndexError('index {} is out of bounds for axis {} '
+                                     'with size {}'.format(k, axis, length))
+                ranges.append(range(k % length, k % length + 1))
+                squeeze.append(axis)
+            else:
+                raise TypeError('only integers and slices are valid cube indices')
+        result = self._read_box(*ranges)
+        return result.squeeze(axis=tuple(squeeze)) if squeeze else result
+
+    def _read_box(self, cadences, rows, cols):
+        """Returns the pixels in the box spanned by three ranges."""
+        result = np.full((len(cadences), len(rows), len(cols)), np.nan, dtype=np.float32)
+        if len(result) == 0 or len(rows) == 0 or len(cols) == 0:
+            return result
+        row_lo, row_hi = min(rows[0], rows[-1]), max(rows[0], rows[-1])
+        col_lo, col_hi = min(cols[0], cols[-1]), max(cols[0], cols[-1])
+        overlapping = np.nonzero((self._rows <= row_hi) & (self._rows + self._heights > row_lo) &
+                                 (self._cols <= col_hi) & (self._cols + self._widths > col_lo))[0]
+        row_idx, col_idx = np.array(rows), np.array(cols)
+        cadence_idx = np.array(cadences)
+        for i in overlapping:
+            geo = self.geometry[i]
+            # Positions of the requested rows/cols within the aperture
+            in_row = (row_idx >= geo.row) & (row_idx < geo.row + geo.height)
+            in_col = (col_idx >= geo.col) & (col_idx < geo.col + geo.width)
+            if not in_row.any() or not in_col.any():
+                continue  # A stepped slice may skip the aperture
+            ap_rows, ap_cols = row_idx[in_row] - geo.row, col_idx[in_col] - geo.col
+            mask = geo.mask[np.ix_(ap_rows, ap_cols)]
+            # Table rows of the requested cadences
+            tpf_rows = self.cadenceno[cadence_idx] - self.first_cadenceno[i]
+            valid = (tpf_rows >= 0) & (tpf_rows < self._n_rows[i])
+            pixels = self._read_rows(i, tpf_rows[valid])[:, ap_rows][:, :, ap_cols]
+            box = np.ix_(np.nonzero(valid)[0], np.nonzero(in_row)[0], np.nonzero(in_col)[0])
+            target = result[box]
+            target[:, mask] = pixels[:, mask]
+            result[box] = target
+        return result
+
+    def _read_rows(self, tpf_idx, tpf_rows):
+        """Returns the pixels of the given table rows of a TPF, using the cache."""
+        pixels = np.empty((len(tpf_rows), self._heights[tpf_idx], self._widths[tpf_idx]),
+                          dtype=np.float32)
+        blocks = tpf_rows // self.block_size
+        for block in np.unique(blocks):
+            in_block = blocks == block
+            pixels[in_block] = self._read_block(tpf_idx, block)[tpf_rows[in_block]
+                                                                - block * self.block_size]
+        return pixels
+
+    def _read_block(self, tpf_idx, block):
+        """Returns a block of `block_size` cadences of a TPF."""
+        key = (self.geometry[tpf_idx].filename, self.column, self.add_background, block)
+        data = self.cache.get(key)
+        if data is None:
+            import fitsio
+            start = block * self.block_size
+            stop = min(start + self.block_size, self._n_rows[tpf_idx])
+            columns = [self.column]
+            bkg_column = self.column.replace('FLUX', 'FLUX_BKG')
+            if self.add_background:
+                columns.append(bkg_column)
+            with pinned_path(self.geometry[tpf_idx].filename) as path, \
+                    fitsio.FITS(path) as tpf:
+                tbl = tpf[1].read(columns=columns, rows=np.arange(start, stop))
+            data = tbl[self.column].astype(np.float32)
+            if self.add_background and self.column == 'FLUX':
+                data += tbl[bkg_column]
+            elif self.add_background:
+                data = np.sqrt(data**2 + tbl[bkg_column]**2)
+            self.cache.put(key, data)
+        return data
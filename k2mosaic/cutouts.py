@@ -0,0 +1,327 @@
+"""Cuts movies or cubes of many targets out of one pass over the data.
+
+Making a movie per target with `k2mosaic movie --rows --cols` reads every
+full-channel mosaic once per target.  Here every mosaic is read once, the
+boxes of all the targets are cut out of it, and each cutout is handed to
+the writer of its target; the writers of the different targets encode
+their frames concurrently, while the next mosaic is being read.
+
+Frames can also be read from a `k2mosaic.cube.KeplerChannelCube` over the
+TPFs, in which case the cube's block cache makes sure that each block of
+a TPF is decoded only once, however many targets it overlaps.
+
+Targets are given as a csv file with a `name` column (optional), either
+`row` and `col` or `ra` and `dec` columns for the centre of the box, and
+optionally `size` or `height` and `width` columns in pixels.
+
+Example usage
+-------------
+targets = read_targets('targets.csv', campaign=5, channel=15)
+frames = mosaic_frames(mosaic_filenames, targets)
+write_cutouts(frames, targets, 'cutouts/m67-', fmt='gif')
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+
+import click
+import numpy as np
+
+from .sparse import read_mosaic_image
+
+DEFAULT_SIZE = 50  # Pixels
+
+CutoutTarget = namedtuple('CutoutTarget', ['name', 'row', 'col', 'height', 'width'])
+CutoutTarget.__doc__ = """Box of `height` x `width` pixels with corner (`row`, `col`),
+which may extend beyond the channel."""
+
+Frame = namedtuple('Frame', ['cadenceno', 'time', 'cutouts'])
+Frame.__doc__ = """The cutouts of all the targets at one cadence, in the order of the targets."""
+
+
+class CutoutException(Exception):
+    pass
+
+
+def read_targets(filename, campaign=None, channel=None, size=DEFAULT_SIZE):
+    """Reads a csv list of targets.
+
+    Parameters
+    ----------
+    filename : str
+        Csv file with columns `row` and `col`, or `ra` and `dec` (degrees),
+        of the centre of each box, and optionally `name`, `size`,
+        `height`, and `width`.
+
+    campaign, channel : int
+        Needed to convert RA/Dec into pixel positions.
+
+    size : int
+        Height and width of the boxes which do not set them.
+
+    Returns
+    -------
+    targets : list of `CutoutTarget`
+    """
+    import pandas as pd
+    table = pd.read_csv(filename)
+    table.columns = [column.strip().lower() for column in table.columns]
+    if {'row', 'col'} <= set(table.columns):
+        rows, cols = table['row'].values, table['col'].values
+    elif {'ra', 'dec'} <= set(table.columns):
+        rows, cols = sky_to_pixels(table['ra'].values, table['dec'].values, campaign, channel)
+    else:
+        raise CutoutException('{} needs either row and col, or ra and dec '
+                              'columns.'.format(filename))
+    targets = []
+    for i in range(len(table)):
+        record = table.iloc[i]
+        default = record['size'] if 'size' in table.columns else size
+        height = int(record['height']) if 'height' in table.columns else int(default)
+        width = int(record['width']) if 'width' in table.columns else int(default)
+        name = str(record['name']) if 'name' in table.columns else 'target{}'.format(i)
+        if not np.isfinite(rows[i]):
+            click.echo('Warning: {} does not fall on channel {} in campaign {}; '
+                       'skipping it.'.format(name, channel, campaign), err=True)
+            continue
+        targets.append(CutoutTarget(name, int(round(rows[i] - height / 2.)),
+                                    int(round(cols[i] - width / 2.)), height, width))
+    if len(set(target.name for target in targets)) < len(targets):
+        raise CutoutException('The target names in {} are not unique.'.format(filename))
+    return targets
+
+
+def sky_to_pixels(ra, dec, campaign, channel):
+    """Returns the zero-based (row, col) of sky positions on a channel,
+    NaN for those which do not fall on it."""
+    if campaign is None or channel is None:
+        raise CutoutException('The campaign and channel are needed to locate RA/Dec targets.')
+    from .skyindex import SkyIndex
+    index = SkyIndex()
+    rows, cols = np.full(len(ra), np.nan), np.full(len(ra), np.nan)
+    for i in range(len(ra)):
+        for match in index.locate(ra[i], dec[i]):
+            if match['campaign'] == int(campaign) and match['channel'] == int(channel):
+                rows[i], cols[i] = match['row'], match['col']
+    return rows, cols
+
+
+def _overlap(target, shape):
+    """Returns the (cutout, channel) slices of the part of a target's box
+    which lies on a channel of `shape`, or `None` if it is off the channel."""
+    row_lo, col_lo = max(target.row, 0), max(target.col, 0)
+    row_hi = min(target.row + target.height, shape[0])
+    col_hi = min(target.col + target.width, shape[1])
+    if row_lo >= row_hi or col_lo >= col_hi:
+        return None
+    return ((slice(row_lo - target.row, row_hi - target.row),
+             slice(col_lo - target.col, col_hi - target.col)),
+            (slice(row_lo, row_hi), slice(col_lo, col_hi)))
+
+
+def cut_out(image, target):
+    """Returns the box of a target, NaN where it extends beyond `image`."""
+    cutout = np.full((target.height, target.width), np.nan, dtype=np.float32)
+    overlap = _overlap(target, image.shape)
+    if overlap is not None:
+        cutout[overlap[0]] = image[overlap[1]]
+    return cutout
+
+
+def mosaic_frames(mosaic_filenames, targets, extension=1):
+    """Yields a `Frame` per mosaic, reading each mosaic only once."""
+    import fitsio
+    for fn in mosaic_filenames:
+        hdr = fitsio.read_header(fn, ext=extension)
+        image = read_mosaic_image(fn, extension)
+        yield Frame(hdr.get('CADENCEN'), hdr.get('MIDTIME'),
+                    [cut_out(image, target) for target in targets])
+
+
+def cube_frames(cube, targets, cadences=None):
+    """Yields a `Frame` per cadence of a `KeplerChannelCube`.
+
+    The cube is read one block of cadences at a time; the blocks of a TPF
+    overlapped by several targets are decoded once and shared through the
+    cube's cache.
+    """
+    if cadences is None:
+        cadences = range(len(cube))
+    cadences = list(cadences)
+    for start in range(0, len(cadences), cube.block_size):
+        block = cadences[start:start + cube.block_size]
+        lo, hi = block[0], block[-1] + 1
+        boxes = []
+        for target in targets:
+            box = np.full((hi - lo, target.height, target.width), np.nan, dtype=np.float32)
+            overlap = _overlap(target, cube.channel_shape)
+            if overlap is not None:
+                box[(slice(None),) + overlap[0]] = cube[(slice(lo, hi),) + overlap[1]]
+            boxes.append(box)
+        for idx in block:
+            yield Frame(int(cube.cadenceno[idx]), None, [box[idx - lo] for box in boxes])
+
+
+def cut_levels(frames, min_percent=10., max_percent=99.5):
+    """Returns the (min, max) cut levels of each target from a sample of frames."""
+    levels = []
+    for i in range(len(frames[0].cutouts)):
+        values = np.concatenate([frame.cutouts[i][np.isfinite(frame.cutouts[i])]
+                                 for frame in frames])
+        levels.append(tuple(np.percentile(values, [min_percent, max_percent]))
+                      if len(values) > 0 else None)
+    return levels
+
+
+class _MovieWriter(object):
+    """Streams the cutouts of a target into a gif or, through imageio, a video."""
+    def __init__(self, filename, cut, cmap='gray', fps=15., scale=1):
+        from .movie import NAN_COLOR, NAN_INDEX, UNCHANGED_INDEX
+        from .pyramid import Colorizer
+        self.colorize = Colorizer(cut, cmap=cmap, n_colors=NAN_INDEX)
+        self.scale = scale
+        self.nan_index = NAN_INDEX
+        self.palette = np.vstack([self.colorize.lut[:, :3], NAN_COLOR]).astype(np.uint8)
+        if filename.endswith('.gif'):
+            from .gif import GifWriter
+            self.gif = GifWriter(filename, self.palette, duration=1000. / fps,
+                                 transparent_index=UNCHANGED_INDEX)
+        else:
+            import imageio
+            self.gif = None
+            self.video = imageio.get_writer(filename, fps=fps)
+
+    def append(self, cutout, cadenceno=None, time=None):
+        if not np.isfinite(cutout).any():
+            return  # Like `KeplerMosaicMovie.to_gif`, skip frames without data
+        frame, finite = self.colorize.index(cutout)
+        frame[~finite] = self.nan_index
+        frame = np.flipud(frame)  # Row 0 at the bottom, like the movies
+        if self.scale > 1:
+            frame = frame.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+        if self.gif is not None:
+            self.gif.append(frame)
+        else:
+            self.video.append_data(self.palette[frame])
+
+    def close(self):
+        if self.gif is not None:
+            self.gif.close()
+        else:
+            self.video.close()
+
+
+class _CubeWriter(object):
+    """Streams the cutouts of a target into a FITS cube, with a table of
+    the cadence number and time of each plane."""
+    def __init__(self, filename, target, n_frames, header=None):
+        import fitsio
+        self.fits = fitsio.FITS(filename, 'rw', clobber=True)
+        header = dict(header or {})
+        header.update({'OBJECT': target.name, 'CUTROW': target.row, 'CUTCOL': target.col})
+        # A new file gets an empty primary HDU first, so that the cube is extension 1
+        self.fits.write(None, header={'CREATOR': 'k2mosaic'})
+        self.fits.create_image_hdu(dims=[n_frames, target.height, target.width],
+                                   dtype='f4', extname='FLUX', header=header)
+        self.cadenceno = np.full(n_frames, -1, dtype=np.int32)
+        self.time = np.full(n_frames, np.nan)
+        self.n_frames = 0
+
+    def append(self, cutout, cadenceno=None, time=None):
+        self.fits[1].write(cutout[None].astype(np.float32), start=[self.n_frames, 0, 0])
+        if cadenceno is not None:
+            self.cadenceno[self.n_frames] = cadenceno
+        if time is not None:
+            self.time[self.n_frames] = time
+        self.n_frames += 1
+
+    def close(self):
+        self.fits.write([self.cadenceno, self.time], names=['CADENCENO', 'TIME'],
+                        extname='CADENCES')
+        self.fits.close()
+
+
+def write_cutouts(frames, targets, output_prefix='cutout-', fmt='gif', n_frames=None,
+                  cuts=None, cmap='gray', fps=15., scale=None, header=None, workers=None):
+    """Streams the frames of every target into its own movie or FITS cube.
+
+    Parameters
+    ----------
+    frames : iterable of `Frame`
+        E.g. from `mosaic_frames` or `cube_frames`.
+
+    targets : list of `CutoutTarget`
+
+    output_prefix : str
+        Writes `output_prefix` + target name + '.' + `fmt`.
+
+    fmt : str
+        'gif', 'mp4' (or any other video format supported by imageio), or 'fits'.
+
+    n_frames : int
+        Number of frames, required for 'fits' cubes.
+
+    cuts : list of (float, float), optional
+        Cut levels of each target's movie, by default from `cut_levels`
+        applied to the first frames.
+
+    scale : int, optional
+        Screen pixels per Kepler pixel, by default the smallest scale
+        which makes each movie at least `MOVIE_WIDTH` pixels wide.
+
+    header : dict, optional
+        Keywords added to the FITS cubes, e.g. CAMPAIGN and CHANNEL.
+
+    workers : int, optional
+        Number of threads encoding the cutouts of the different targets.
+
+    Returns
+    -------
+    filenames : list of str
+        The files written, in the order of `targets`.
+    """
+    from itertools import chain, islice
+    from .movie import MOVIE_WIDTH
+    if fmt == 'fits' and n_frames is None:
+        raise CutoutException('The number of frames is needed to write FITS cubes.')
+    frames = iter(frames)
+    if fmt != 'fits' and cuts is None:
+        # Use the first frames to set the stretch, then replay them
+        sample = list(islice(frames, 10))
+        cuts = cut_levels(sample) if sample else [None] * len(targets)
+        frames = chain(sample, frames)
+    filenames, writers = [], []
+    for i, target in enumerate(targets):
+        fn = '{}{}.{}'.format(output_prefix, target.name, fmt)
+        directory = os.path.dirname(fn)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        filenames.append(fn)
+        if fmt == 'fits':
+            writers.append(_CubeWriter(fn, target, n_frames, header=header))
+        elif cuts[i] is None:
+            click.echo('Warning: {} has no data; not writing {}.'.format(target.name, fn),
+                       err=True)
+            writers.append(None)
+        else:
+            target_scale = scale or max(1, int(math.ceil(MOVIE_WIDTH / float(target.width))))
+            writers.append(_MovieWriter(fn, cuts[i], cmap=cmap, fps=fps, scale=target_scale))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            with click.progressbar(frames, length=n_frames, label='Cutting out',
+                                   show_pos=n_frames is not None) as bar:
+                for frame in bar:
+                    # Wait for the previous frame, so that every writer gets its frames in order;
+                    # the next frame is read while this one is being encoded
+                    [future.result() for future in pending]
+                    pending = [executor.submit(writer.append, cutout, frame.cadenceno, frame.time)
+                               for writer, cutout in zip(writers, frame.cutouts)
+                               if writer is not None]
+            [future.result() for future in pending]
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+    return [fn for fn, writer in zip(filenames, writers) if writer is not None]
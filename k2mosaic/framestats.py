@@ -0,0 +1,129 @@
+"""Summary statistics of every mosaic of a run, kept in one sidecar table.
+
+Choosing good frames or the stretch of a movie used to mean opening every
+mosaic again.  Instead, each mosaic computes a few statistics of its
+covered pixels while it is still in memory (see
+`KeplerChannelMosaic.statistics`), and `k2mosaic mosaic` collects them in a
+single table, ``<output>-stats.fits``, with one row per mosaic.  Runs
+with the same output prefix (e.g. over different cadence ranges) add their
+rows to the table, replacing the rows of the mosaics they write again:
+
+* FILENAME: the base name of the mosaic;
+* CADENCENO, TIME, QUALITY: the (first) cadence and its time and flags;
+* COVERAGE, NPIXELS: the fraction and number of channel pixels with data;
+* FLUX_MEDIAN, FLUX_LOW, FLUX_HIGH: the median and the `CUT_PERCENTILES`
+  of the flux, i.e. the default cut levels of a movie frame;
+* BACKGROUND: the mean background under the pixels (NaN for stacks);
+* ROW_MIN, ROW_MAX, COL_MIN, COL_MAX: the box around the pixels with data.
+
+`k2mosaic movie --stats` uses the table to leave out frames without data,
+and to crop to the data and set the cut levels without reading any image.
+
+Example usage
+-------------
+stats = FrameStatistics.read('k2mosaic-c05-ch15-stats.fits')
+good_filenames = stats.valid_filenames(mosaic_filenames)
+vmin, vmax = stats.cut_levels()
+"""
+import os
+
+import numpy as np
+
+from . import QUALITY_NO_DATA
+
+CUT_PERCENTILES = (10., 99.5)  # The default stretch of `k2mosaic.movie`
+FRAME_STATS_COLUMNS = [('CADENCENO', 'J'), ('TIME', 'D'), ('QUALITY', 'J'),
+                       ('COVERAGE', 'E'), ('NPIXELS', 'J'), ('FLUX_MEDIAN', 'E'),
+                       ('FLUX_LOW', 'E'), ('FLUX_HIGH', 'E'), ('BACKGROUND', 'E'),
+                       ('ROW_MIN', 'J'), ('ROW_MAX', 'J'), ('COL_MIN', 'J'), ('COL_MAX', 'J')]
+
+
+class FrameStatistics(object):
+    """Table of the statistics of a set of mosaics, sorted by cadence.
+
+    Parameters
+    ----------
+    columns : dict of arrays
+        The FILENAME column and the `FRAME_STATS_COLUMNS`.
+    """
+    def __init__(self, columns):
+        order = np.argsort(np.asarray(columns['CADENCENO']), kind='stable')
+        self.columns = {name: np.asarray(values)[order] for name, values in columns.items()}
+        self._index = {fn: idx for idx, fn in enumerate(self.columns['FILENAME'])}
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds the table from a list of `(filename, statistics)` tuples."""
+        columns = {'FILENAME': [os.path.basename(fn) for fn, _ in records]}
+        for name, _ in FRAME_STATS_COLUMNS:
+            columns[name] = [stats[name] for _, stats in records]
+        return cls(columns)
+
+    def merge(self, other):
+        """Returns a table with the rows of both tables; the rows of `other`
+        replace those of the same FILENAME in this table."""
+        keep = ~np.isin(self['FILENAME'], other['FILENAME'])
+        return FrameStatistics({name: np.concatenate([np.asarray(self[name])[keep],
+                                                      np.asarray(other[name])])
+                                for name in other.columns})
+
+    def __len__(self):
+        return len(self.columns['FILENAME'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def valid(self):
+        """Returns a boolean array flagging the mosaics which contain data."""
+        return (self['NPIXELS'] > 0) & ((self['QUALITY'] & QUALITY_NO_DATA) == 0)
+
+    def valid_filenames(self, filenames):
+        """Returns the `filenames` without the mosaics which the table
+        flags as not containing data."""
+        valid = self.valid()
+        keep = []
+        for fn in filenames:
+            idx = self._index.get(os.path.basename(fn))
+            if idx is None or valid[idx]:
+                keep.append(fn)
+        return keep
+
+    def bounds(self):
+        """Returns the (min, max) row and column ranges of the pixels with
+        data in any valid frame, or `None`."""
+        valid = self.valid()
+        if not valid.any():
+            return None
+        return ((int(self['ROW_MIN'][valid].min()), int(self['ROW_MAX'][valid].max())),
+                (int(self['COL_MIN'][valid].min()), int(self['COL_MAX'][valid].max())))
+
+    def cut_levels(self):
+        """Returns the cut levels of a stretch shared by all frames: the
+        medians of the `CUT_PERCENTILES` of the valid frames."""
+        valid = self.valid()
+        if not valid.any():
+            return None
+        return (float(np.median(self['FLUX_LOW'][valid])),
+                float(np.median(self['FLUX_HIGH'][valid])))
+
+    def writeto(self, output_fn, overwrite=True):
+        from astropy.io import fits
+        filenames = np.array(self['FILENAME'], dtype=str)
+        columns = [fits.Column(name='FILENAME', format='{}A'.format(
+                               max([len(fn) for fn in filenames] + [1])), array=filenames)]
+        columns += [fits.Column(name=name, format=fmt, array=self[name])
+                    for name, fmt in FRAME_STATS_COLUMNS]
+        hdu = fits.BinTableHDU.from_columns(columns)
+        hdu.header['EXTNAME'] = 'FRAMESTATS'
+        hdu.header['CUTLOW'] = (CUT_PERCENTILES[0], 'percentile in FLUX_LOW')
+        hdu.header['CUTHIGH'] = (CUT_PERCENTILES[1], 'percentile in FLUX_HIGH')
+        hdu.writeto(output_fn, overwrite=overwrite, checksum=True)
+
+    @classmethod
+    def read(cls, filename):
+        import fitsio
+        tbl = fitsio.read(filename, ext='FRAMESTATS')
+        columns = {name: tbl[name] for name, _ in FRAME_STATS_COLUMNS}
+        columns['FILENAME'] = [(fn.decode() if isinstance(fn, bytes) else str(fn)).strip()
+                               for fn in tbl['FILENAME']]
+        return cls(columns)
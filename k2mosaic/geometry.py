@@ -0,0 +1,70 @@
+"""Describes where the apertures of Target Pixel Files fall on a CCD channel.
+
+Only the headers and the aperture mask of a TPF are read,
+so obtaining the geometry of a TPF is much cheaper than reading its pixels.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE
+
+
+TPFGeometry = namedtuple('TPFGeometry', ['filename', 'row', 'col', 'height', 'width', 'mask'])
+TPFGeometry.__doc__ = """Position of a TPF aperture on the channel.
+
+(`row`, `col`) is the corner of the aperture in channel pixel coordinates,
+(`height`, `width`) its shape, and `mask` flags the pixels that were collected.
+"""
+
+
+def local_path(tpf_filename):
+    """Returns a local path for a TPF.  A url is looked up in the local
+    mirror set by K2MOSAIC_MIRROR (see `k2mosaic.mirror`), and otherwise
+    downloaded into the `k2mosaic.store.TPFStore` first.
+
+    A file of the store may be evicted by another process at any time;
+    use `pinned_path` to read it."""
+    with pinned_path(tpf_filename) as path:
+        return path
+
+
+@contextmanager
+def pinned_path(tpf_filename):
+    """Yields a local path for a TPF, like `local_path`, and keeps the
+    `k2mosaic.store.TPFStore` from evicting the file until the block exits."""
+    if tpf_filename.startswith("http"):
+        from .mirror import default_mirror
+        mirror = default_mirror()
+        path = None if mirror is None else mirror.resolve(tpf_filename)
+        if path is None:
+            from .store import default_store
+            with default_store().pinned(tpf_filename) as path:
+                yield path
+            return
+        yield path
+    else:
+        yield tpf_filename
+
+
+def read_tpf_geometry(tpf_filename):
+    """Returns the `TPFGeometry` of a Target Pixel File."""
+    import fitsio
+    with pinned_path(tpf_filename) as path, fitsio.FITS(path) as tpf:
+        return geometry_from_fits(tpf_filename, tpf)
+
+
+def geometry_from_fits(tpf_filename, tpf):
+    """Returns the `TPFGeometry` of a TPF which has been opened with fitsio."""
+    hdr = tpf[1].read_header()
+    mask = tpf[2].read() > 0
+    return TPFGeometry(filename=tpf_filename, row=int(hdr['2CRV5P']), col=int(hdr['1CRV5P']),
+                       height=mask.shape[0], width=mask.shape[1], mask=mask)
+
+
+def pixel_indices(row, col, mask, shape=KEPLER_CHANNEL_SHAPE):
+    """Returns the flattened channel indices of the pixels flagged in `mask`,
+    in the same (row-major) order as ``array[mask]``."""
+    rows, cols = np.nonzero(mask)
+    return np.ravel_multi_index((rows + row, cols + col), shape)
@@ -0,0 +1,144 @@
+"""Writes animated gifs from indexed frames which share one palette.
+
+The frames of a k2mosaic movie all use the same colormap and stretch, so
+a single global palette can be written once, and each frame can be given
+as an array of palette indices rather than being quantized separately.
+Only the rectangle which changed since the previous frame is encoded;
+within that rectangle, unchanged pixels are set to a transparent index so
+that they compress well.  Frames are written to disk as they are added,
+so the movie never has to be held in memory.
+
+Example usage
+-------------
+with GifWriter('movie.gif', palette, duration=200, transparent_index=255) as gif:
+    for frame in frames:  # 2D arrays of uint8 palette indices
+        gif.append(frame)
+"""
+import io
+import struct
+
+import numpy as np
+
+
+class GifWriter(object):
+    """Streams an animated gif to disk.
+
+    Parameters
+    ----------
+    filename : str
+
+    palette : array of shape (n_colors, 3)
+        RGB colours (uint8) of the global palette, at most 256.
+
+    duration : float
+        Default display time of each frame in milliseconds.
+
+    loop : int
+        Number of times the animation is repeated, 0 means forever.
+
+    transparent_index : int, optional
+        Palette index which is never used by the frames, and which is used
+        to mark the pixels that did not change since the previous frame.
+    """
+    def __init__(self, filename, palette, duration=100., loop=0, transparent_index=None):
+        palette = np.asarray(palette, dtype=np.uint8)
+        if len(palette) > 256:
+            raise ValueError('A gif palette has at most 256 colours.')
+        self.palette = np.zeros((256, 3), dtype=np.uint8)
+        self.palette[:len(palette)] = palette
+        self.duration = duration
+        self.loop = loop
+        self.transparent_index = transparent_index
+        self.n_frames = 0
+        self._fp = open(filename, 'wb')
+        self._previous = None
+        self._pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, frame, duration=None):
+        """Adds a 2D array of palette indices as the next frame.
+
+        A frame identical to the previous one extends its display time.
+        """
+        frame = np.asarray(frame, dtype=np.uint8)
+        if duration is None:
+            duration = self.duration
+        if self._previous is None:
+            self._write_header(frame.shape)
+            rect, offset = frame, (0, 0)
+        else:
+            if frame.shape != self._previous.shape:
+                raise ValueError('All frames must have the same shape.')
+            changed = frame != self._previous
+            rows = np.flatnonzero(changed.any(axis=1))
+            if len(rows) == 0:
+                self._pending[2] += duration
+                return
+            cols = np.flatnonzero(changed.any(axis=0))
+            box = slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+            rect, offset = frame[box], (cols[0], rows[0])
+            if self.transparent_index is not None:
+                rect = np.where(changed[box], rect, np.uint8(self.transparent_index))
+        # A frame is only written once the next one is known,
+        # so that the display time of repeated frames can be merged
+        self._flush()
+        self._pending = [rect, offset, duration]
+        self._previous = frame
+        self.n_frames += 1
+
+    def close(self):
+        if self._fp.closed:
+            return
+        self._flush()
+        self._fp.write(b';')  # Trailer
+        self._fp.close()
+
+    def _write_header(self, shape):
+        height, width = shape
+        # Global colour table of 2**(7 + 1) colours with 8 bits per channel
+        self._fp.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0))
+        self._fp.write(self.palette.tobytes())
+        # Netscape application extension, which makes the animation loop
+        self._fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+
+    def _flush(self):
+        if self._pending is None:
+            return
+        rect, offset, duration = self._pending
+        # Graphic control extension: draw on top of the previous frame
+        # (disposal 1), with the display time in 1/100 s
+        flags = (1 << 2) | (self.transparent_index is not None)
+        self._fp.write(b'!\xf9\x04' + struct.pack('<BHB', flags, int(round(duration / 10.)),
+                                                   self.transparent_index or 0) + b'\x00')
+        descriptor, data = _encode_frame(rect, self.palette)
+        self._fp.write(descriptor[:1] + struct.pack('<HH', *(int(o) for o in offset)) +
+                       descriptor[5:] + data)
+        self._pending = None
+
+
+def _encode_frame(indices, palette):
+    """Returns the image descriptor and the LZW-compressed data blocks of a
+    frame of palette indices, as encoded by Pillow's public gif writer."""
+    from PIL import Image  # Installed with imageio
+    im = Image.fromarray(np.ascontiguousarray(indices))
+    im.putpalette(palette.tobytes())
+    out = io.BytesIO()
+    im.save(out, format='GIF', optimize=False)
+    gif = out.getvalue()
+    # Skip the header, logical screen descriptor, and global colour table
+    pos = 13 + (3 * 2**((gif[10] & 0x07) + 1) if gif[10] & 0x80 else 0)
+    while gif[pos:pos + 1] == b'!':  # Extensions: label, then data sub-blocks
+        pos += 2
+        while gif[pos]:
+            pos += gif[pos] + 1
+        pos += 1
+    if gif[pos:pos + 1] != b',':
+        raise ValueError('Pillow wrote a gif without an image descriptor.')
+    # The descriptor is followed by a local colour table, if Pillow wrote one
+    end = pos + 10 + (3 * 2**((gif[pos + 9] & 0x07) + 1) if gif[pos + 9] & 0x80 else 0)
+    return gif[pos:end], gif[end:-1]  # Without the trailer
@@ -1,5 +1,9 @@
 """Query Target Pixel Files from the Kepler/K2 archive at MAST.
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
 import requests
 
 MAST_URL = 'https://archive.stsci.edu'
@@ -13,6 +17,20 @@ class ApiError(Exception):
     pass
 
 
+class BulkQueryError(ApiError):
+    """Some of the queries of `get_tpf_urls_bulk` failed.
+
+    `urls` holds the result of every query, with an empty list for the
+    failed ones, and `failures` maps each failed (quarter_or_campaign,
+    channel) onto its `ApiError`.
+    """
+    def __init__(self, urls, failures):
+        super(BulkQueryError, self).__init__('{} of {} MAST queries failed'.format(
+                                             len(failures), len(urls)))
+        self.urls = urls
+        self.failures = failures
+
+
 def data_search_url(campaign, mission='k2', channel=None, obsmode='LC'):
     """Returns a query URL to search target pixel files using the MAST API."""
     url = '{}/{}/data_search/search.php?'.format(MAST_URL, mission)
@@ -43,21 +61,98 @@ def get_tpf_urls(quarter_or_campaign, channel=None, short_cadence=False):
     quarter_or_campaign : str
         e.g. 'C4', 'Q4', or '4'.
     """
+    mission, campaign = parse_campaign(quarter_or_campaign)
+    obsmode = 'SC' if short_cadence else 'LC'
+    try:
+        resp = data_search(campaign, mission=mission, channel=channel, obsmode=obsmode)
+    except requests.RequestException as e:
+        raise ApiError('GET data_search failed: {}'.format(e))
+    return _parse_data_search_response(resp, obsmode)
+
+
+def get_tpf_urls_bulk(quarters_or_campaigns, channels=None, short_cadence=False,
+                      concurrency=8):
+    """Returns the TPF URLs of many campaigns and channels, queried concurrently.
+
+    Parameters
+    ----------
+    quarters_or_campaigns : list of str
+        e.g. ['C4', 'C5'].
+
+    channels : list of int
+        Channels to query for each campaign, or `None` to query
+        each campaign as a whole.
+
+    concurrency : int
+        Maximum number of simultaneous requests to MAST.
+
+    Returns
+    -------
+    urls : OrderedDict
+        Maps (quarter_or_campaign, channel) onto a list of URLs,
+        which is empty if no data were found.
+
+    Raises
+    ------
+    BulkQueryError
+        If some of the queries failed; the other queries are completed
+        and their URLs are available as the `urls` of the exception.
+    """
+    if channels is None:
+        channels = [None]
+    queries = [(campaign, channel)
+               for campaign in quarters_or_campaigns for channel in channels]
+    obsmode = 'SC' if short_cadence else 'LC'
+    local = threading.local()
+    sessions = []
+
+    def query(quarter_or_campaign_and_channel):
+        """Runs one query in a worker thread, with the session of that thread;
+        returns the URLs or the `ApiError`, so that it does not abort the others."""
+        quarter_or_campaign, channel = quarter_or_campaign_and_channel
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        mission, campaign = parse_campaign(quarter_or_campaign)
+        url = data_search_url(campaign, mission=mission, channel=channel, obsmode=obsmode)
+        try:
+            return _parse_data_search_response(local.session.get(url), obsmode)
+        except requests.RequestException as e:
+            return ApiError('GET data_search failed: {}'.format(e))
+        except NoDataFoundException:
+            return []
+        except ApiError as e:
+            return e
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(query, queries))
+    finally:
+        for session in sessions:
+            session.close()
+    urls, failures = OrderedDict(), OrderedDict()
+    for query_key, result in zip(queries, results):
+        if isinstance(result, ApiError):
+            failures[query_key], result = result, []
+        urls[query_key] = result
+    if len(failures) > 0:
+        raise BulkQueryError(urls, failures)
+    return urls
+
+
+def parse_campaign(quarter_or_campaign):
+    """Returns the (mission, number) of a campaign or quarter such as 'C4' or 'Q4'."""
     prefix = quarter_or_campaign.lower()[0]
     if prefix == 'c':
-        mission = 'k2'
-        campaign = int(quarter_or_campaign[1:])
+        return 'k2', int(quarter_or_campaign[1:])
     elif prefix == 'q':
-        mission = 'kepler'
-        campaign = int(quarter_or_campaign[1:])
+        return 'kepler', int(quarter_or_campaign[1:])
     else:  # Just a number?
-        mission = 'k2'
-        campaign = int(quarter_or_campaign)
-    if short_cadence:
-        obsmode = 'SC'
-    else:
-        obsmode = 'LC'
-    resp = data_search(campaign, mission=mission, channel=channel, obsmode=obsmode)
+        return 'k2', int(quarter_or_campaign)
+
+
+def _parse_data_search_response(resp, obsmode='LC'):
+    """Returns the TPF URLs listed in the response of a data search query."""
     if resp.status_code != 200:
         # This means something went wrong.
         raise ApiError('GET data_search {}'.format(resp.status_code))
@@ -0,0 +1,255 @@
+"""Machine-readable progress, throughput, and failure metrics of a mosaicking run.
+
+Every mosaic is made by `run_task`, which measures the time taken and the
+bytes read and written by the worker, and turns an exception into a
+structured failure record instead of only printing it.  A `MetricsRecorder`
+collects these records in the main process and publishes them as
+
+* a JSON-lines event stream, with one `start` event, a `task` event per
+  mosaic, a `progress` event every few seconds, and an `end` event;
+* a Prometheus textfile (as read by the node exporter's textfile
+  collector), which is rewritten atomically with every progress update.
+
+Example usage
+-------------
+metrics = MetricsRecorder(jsonl_fn='run.jsonl', prometheus_fn='k2mosaic.prom',
+                          labels={'campaign': 5, 'channel': 15})
+metrics.start(n_tasks=len(cadencelist), n_tpfs=len(tpf_filenames))
+for job in cadencelist:
+    metrics.record(run_task(task, job))
+metrics.finish()
+print(metrics.summary())
+"""
+import json
+import os
+import time
+
+PROMETHEUS_PREFIX = 'k2mosaic_'
+
+
+def io_counters():
+    """Returns the (bytes read, bytes written) by this process so far,
+    or `None` where /proc/self/io is not available."""
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_task(task, job):
+    """Runs `task(job, raise_errors=True)` and returns a record of the outcome.
+
+    The task returns the filename it wrote, or a tuple of the filename and
+    the statistics of the mosaic (see `k2mosaic.framestats`).
+
+    Returns
+    -------
+    record : dict
+        With keys job, output (`None` if the task failed), error (`None`,
+        or a dict with the exception type and message), seconds, bytes_read,
+        bytes_written, worker (the process id), and statistics (or `None`).
+    """
+    io_before, start = io_counters(), time.time()
+    statistics = None
+    try:
+        output, error = task(job, raise_errors=True), None
+        if isinstance(output, tuple):
+            output, statistics = output
+    except Exception as e:
+        import click
+        click.secho('{}'.format(e), fg='red')
+        output, error = None, {'type': type(e).__name__, 'message': str(e)}
+    io_after = io_counters()
+    bytes_read = None if io_before is None else io_after[0] - io_before[0]
+    bytes_written = 0
+    if output is not None and os.path.exists(output):
+        bytes_written = os.path.getsize(output)
+    return {'job': _jsonable(job), 'output': output, 'error': error,
+            'seconds': time.time() - start, 'bytes_read': bytes_read,
+            'bytes_written': bytes_written, 'worker': os.getpid(),
+            'statistics': statistics}
+
+
+class MetricsRecorder(object):
+    """Aggregates the records returned by `run_task`.
+
+    Parameters
+    ----------
+    jsonl_fn : str, optional
+        File to which the JSON-lines events are appended.
+
+    prometheus_fn : str, optional
+        Prometheus textfile to (re)write, e.g. ending in `.prom`.
+
+    labels : dict, optional
+        Labels identifying the run, e.g. the campaign and channel, added
+        to every event and metric.
+
+    interval : float
+        Minimum number of seconds between two progress updates.
+    """
+    def __init__(self, jsonl_fn=None, prometheus_fn=None, labels=None, interval=5.):
+        self.jsonl_fn = jsonl_fn
+        self.prometheus_fn = prometheus_fn
+        self.labels = {key: str(value) for key, value in (labels or {}).items()}
+        self.interval = interval
+        self.n_tasks = 0
+        self.n_tpfs = 0
+        self.start_time = None
+        self.end_time = None
+        self.last_update = None
+        self.counts = {'done': 0, 'failed': 0}
+        self.cadences = {'done': 0, 'failed': 0}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.failures = []
+        self.workers = {}
+
+    def start(self, n_tasks, n_tpfs, **info):
+        """Marks the start of a run of `n_tasks` mosaics, each reading `n_tpfs` TPFs."""
+        self.n_tasks, self.n_tpfs = n_tasks, n_tpfs
+        self.start_time = self.last_update = time.time()
+        self._emit('start', n_tasks=n_tasks, n_tpfs=n_tpfs, **info)
+        self._write_prometheus()
+
+    def record(self, record):
+        """Adds the record of a finished task."""
+        status = 'failed' if record['output'] is None else 'done'
+        self.counts[status] += 1
+        self.cadences[status] += len(record['job']) if isinstance(record['job'], list) else 1
+        self.bytes_read += record['bytes_read'] or 0
+        self.bytes_written += record['bytes_written']
+        worker = self.workers.setdefault(record['worker'], {'done': 0, 'failed': 0,
+                                                            'seconds': 0.})
+        worker[status] += 1
+        worker['seconds'] += record['seconds']
+        worker['last_job'] = record['job']
+        worker['last_seen'] = time.time()
+        if status == 'failed':
+            error = record['error'] or {'type': None, 'message': 'no output was written'}
+            self.failures.append(dict(job=record['job'], worker=record['worker'], **error))
+        # The statistics go to their own table (and may contain NaN, which is not JSON)
+        self._emit('task', status=status,
+                   **{key: value for key, value in record.items() if key != 'statistics'})
+        if time.time() - self.last_update >= self.interval:
+            self.update()
+
+    def update(self):
+        """Publishes the current progress."""
+        self.last_update = time.time()
+        self._emit('progress', **self.progress())
+        self._write_prometheus()
+
+    def finish(self):
+        """Marks the end of the run and publishes the final metrics."""
+        self.end_time = time.time()
+        self._emit('end', failures=self.failures, **self.progress())
+        self._write_prometheus()
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.
+        return (self.end_time or time.time()) - self.start_time
+
+    def progress(self):
+        """Returns a dict of counters, rates, and the ETA in seconds."""
+        elapsed = max(self.elapsed, 1e-9)
+        finished = self.counts['done'] + self.counts['failed']
+        remaining = self.n_tasks - finished
+        return {'tasks_done': self.counts['done'], 'tasks_failed': self.counts['failed'],
+                'tasks_total': self.n_tasks,
+                'cadences_done': self.cadences['done'],
+                'cadences_failed': self.cadences['failed'],
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'elapsed': elapsed,
+                'tpfs_per_second': finished * self.n_tpfs / elapsed,
+                'cadences_per_second': self.cadences['done'] / elapsed,
+                'read_mb_per_second': self.bytes_read / 1e6 / elapsed,
+                'written_mb_per_second': self.bytes_written / 1e6 / elapsed,
+                'eta': remaining * elapsed / finished if finished > 0 else None,
+                'workers': {str(pid): status for pid, status in self.workers.items()}}
+
+    def summary(self):
+        """Returns a human-readable summary of the run and its failures."""
+        progress = self.progress()
+        lines = ['{} of {} mosaics written in {:.1f} s ({:.2f} cadences/s, '
+                 '{:.1f} MB/s read, {:.1f} MB/s written).'.format(
+                    self.counts['done'], self.n_tasks, progress['elapsed'],
+                    progress['cadences_per_second'], progress['read_mb_per_second'],
+                    progress['written_mb_per_second'])]
+        if self.failures:
+            lines.append('{} mosaics failed:'.format(len(self.failures)))
+            lines += ['  {}: {}: {}'.format(failure['job'], failure['type'], failure['message'])
+                      for failure in self.failures]
+        return '\n'.join(lines)
+
+    def _emit(self, event, **fields):
+        if self.jsonl_fn is None:
+            return
+        line = dict(event=event, time=time.time(), **self.labels)
+        line.update(fields)
+        with open(self.jsonl_fn, 'a') as out:
+            out.write(json.dumps(line, default=_jsonable) + '\n')
+
+    def _write_prometheus(self):
+        if self.prometheus_fn is None:
+            return
+        progress = self.progress()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {}{} {}'.format(PROMETHEUS_PREFIX, name, help))
+            lines.append('# TYPE {}{} {}'.format(PROMETHEUS_PREFIX, name, kind))
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                label_str = ','.join('{}="{}"'.format(key, value)
+                                     for key, value in sorted(labels.items()))
+                lines.append('{}{}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                '{' + label_str + '}' if label_str else '',
+                                                float(value)))
+
+        metric('tasks_planned', 'gauge', 'Number of mosaics to make.', [({}, self.n_tasks)])
+        metric('tasks_total', 'counter', 'Number of mosaics finished, by status.',
+               [({'status': status}, count) for status, count in sorted(self.counts.items())])
+        metric('cadences_total', 'counter', 'Number of cadences mosaicked, by status.',
+               [({'status': status}, count) for status, count in sorted(self.cadences.items())])
+        metric('read_bytes_total', 'counter', 'Bytes read by the workers.',
+               [({}, self.bytes_read)])
+        metric('written_bytes_total', 'counter', 'Bytes of mosaics written.',
+               [({}, self.bytes_written)])
+        for name, key, help in [('tpfs_per_second', 'tpfs_per_second', 'TPFs read per second.'),
+                                ('cadences_per_second', 'cadences_per_second',
+                                 'Cadences mosaicked per second.'),
+                                ('read_megabytes_per_second', 'read_mb_per_second',
+                                 'Megabytes read per second.'),
+                                ('written_megabytes_per_second', 'written_mb_per_second',
+                                 'Megabytes written per second.')]:
+            metric(name, 'gauge', help, [({}, progress[key])])
+        if progress['eta'] is not None:
+            metric('eta_seconds', 'gauge', 'Estimated time until the run completes.',
+                   [({}, progress['eta'])])
+        metric('start_time_seconds', 'gauge', 'Unix time at which the run started.',
+               [({}, self.start_time or 0)])
+        metric('worker_tasks_total', 'counter', 'Number of mosaics finished by each worker.',
+               [({'worker': str(pid), 'status': status}, worker[status])
+                for pid, worker in sorted(self.workers.items()) for status in ['done', 'failed']])
+        metric('worker_last_seen_seconds', 'gauge',
+               'Unix time at which each worker last finished a mosaic.',
+               [({'worker': str(pid)}, worker['last_seen'])
+                for pid, worker in sorted(self.workers.items())])
+        tmp_fn = '{}.tmp{}'.format(self.prometheus_fn, os.getpid())
+        with open(tmp_fn, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+        os.replace(tmp_fn, self.prometheus_fn)
+
+
+def _jsonable(value):
+    """Converts numpy scalars and arrays (e.g. cadence numbers) to Python types."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
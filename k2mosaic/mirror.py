@@ -0,0 +1,212 @@
+"""Resolves TPF urls and dataset names to the files of a local archive mirror.
+
+A mirror is any directory tree containing Target Pixel Files, e.g. a copy
+of the MAST `missions/k2/target_pixel_files` and
+`missions/kepler/target_pixel_files` trees, gzipped or not.  The tree is
+walked once to build a persistent SQLite index mapping the dataset name of
+each TPF (e.g. 'ktwo210854069-c04_lpd-targ') onto its path; afterwards a
+lookup is a dictionary access, whatever the layout of the mirror or the
+protocol and host of the url.  Uncompressed files are preferred over
+gzipped ones, because they are much faster to read.
+
+If the index is built with `read_headers=True`, the campaign (or quarter)
+and channel of each TPF are recorded too, so that the TPFs of a channel
+can be listed without querying MAST.
+
+The mirror used by default is set using the K2MOSAIC_MIRROR environment
+variable.
+
+Example usage
+-------------
+mirror = MirrorIndex('/data/mast')
+mirror.build(read_headers=True)  # Only needed once, or when the mirror changes
+mirror.resolve('https://archive.stsci.edu/.../ktwo210854069-c04_lpd-targ.fits.gz')
+mirror.find('k2', 4, channel=15)
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.k2mosaic', 'mirrors')
+# e.g. ktwo210854069-c04_lpd-targ.fits.gz or kplr004912785-2010078095331_spd-targ.fits
+TPF_PATTERN = re.compile(r'^((ktwo|kplr)[^_]+_(lpd|spd)-targ)\.fits(\.gz)?$', re.IGNORECASE)
+
+
+class MirrorException(Exception):
+    pass
+
+
+def dataset_name(url_or_path):
+    """Returns the dataset name of a TPF url, path, or filename, e.g.
+    'ktwo210854069-c04_lpd-targ', or `None` if it is not named like a TPF."""
+    match = TPF_PATTERN.match(os.path.basename(url_or_path.strip()))
+    if match is None:
+        return None
+    return match.group(1).lower()
+
+
+class MirrorIndex(object):
+    """Persistent index of the TPFs in a local mirror.
+
+    Parameters
+    ----------
+    root : str
+        Top directory of the mirror.
+
+    index_fn : str, optional
+        SQLite file holding the index, by default a file named after
+        the mirror in ~/.k2mosaic/mirrors.
+    """
+    def __init__(self, root, index_fn=None):
+        self.root = os.path.abspath(root)
+        if index_fn is None:
+            key = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+            index_fn = os.path.join(DEFAULT_INDEX_DIR, '{}.sqlite'.format(key))
+        self.index_fn = index_fn
+        self._paths = None
+
+    @property
+    def exists(self):
+        """Whether the index has been built."""
+        return os.path.exists(self.index_fn)
+
+    @property
+    def has_headers(self):
+        """Whether the index records the campaign and channel of each TPF."""
+        return self._query("SELECT value FROM meta WHERE key = 'headers'")[0][0] == '1'
+
+    def build(self, read_headers=False, progress=None):
+        """Walks the mirror and (re)writes the index.
+
+        Parameters
+        ----------
+        read_headers : bool
+            Also record the mission, campaign or quarter, and channel of
+            every TPF, which requires opening each file.
+
+        progress : callable, optional
+            Called with the path of every TPF found.
+
+        Returns
+        -------
+        n_files : int
+            Number of TPFs indexed.
+        """
+        if not os.path.isdir(self.root):
+            raise MirrorException('{} is not a directory.'.format(self.root))
+        rows = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                name = dataset_name(fn)
+                if name is None:
+                    continue
+                path = os.path.relpath(os.path.join(dirpath, fn), self.root)
+                # Prefer uncompressed files, and otherwise the first one found
+                if name in rows and (fn.lower().endswith('.gz') or
+                                     not rows[name][0].lower().endswith('.gz')):
+                    continue
+                rows[name] = (path, None, None, None)
+        if read_headers:
+            for name, (path, _, _, _) in rows.items():
+                if progress is not None:
+                    progress(path)
+                rows[name] = (path,) + _read_mission_campaign_channel(
+                                           os.path.join(self.root, path))
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_fn)), exist_ok=True)
+        tmp_fn = '{}.tmp{}'.format(self.index_fn, os.getpid())
+        db = sqlite3.connect(tmp_fn)
+        try:
+            with db:
+                db.execute('CREATE TABLE files (name TEXT PRIMARY KEY, path TEXT, '
+                           'mission TEXT, campaign INTEGER, channel INTEGER)')
+                db.execute('CREATE INDEX files_channel ON files (mission, campaign, channel)')
+                db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                               [(name,) + row for name, row in rows.items()])
+                db.executemany('INSERT INTO meta VALUES (?, ?)',
+                               [('root', self.root), ('built', str(time.time())),
+                                ('headers', str(int(read_headers)))])
+        finally:
+            db.close()
+        os.replace(tmp_fn, self.index_fn)  # Readers never see a partial index
+        self._paths = None
+        return len(rows)
+
+    def resolve(self, url_or_name):
+        """Returns the local path of a TPF url, path, or dataset name,
+        or `None` if it is not in the mirror."""
+        if self._paths is None:
+            self._paths = dict(self._query('SELECT name, path FROM files'))
+        name = dataset_name(url_or_name) or url_or_name.strip().lower()
+        path = self._paths.get(name)
+        if path is None:
+            return None
+        path = os.path.join(self.root, path)
+        return path if os.path.exists(path) else None
+
+    def __contains__(self, url_or_name):
+        return self.resolve(url_or_name) is not None
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM files')[0][0]
+
+    def find(self, mission, campaign, channel=None, obsmode='LC'):
+        """Returns the paths of the TPFs of a campaign (or quarter) and channel.
+
+        Requires an index built with `read_headers=True`.
+        """
+        if not self.has_headers:
+            raise MirrorException('The index of {} does not record campaigns and channels; '
+                                  'rebuild it reading the headers.'.format(self.root))
+        suffix = '%_{}-targ'.format('spd' if obsmode == 'SC' else 'lpd')
+        sql = 'SELECT path FROM files WHERE mission = ? AND campaign = ? AND name LIKE ?'
+        args = [mission, int(campaign), suffix]
+        if channel is not None:
+            sql += ' AND channel = ?'
+            args.append(int(channel))
+        return [os.path.join(self.root, path) for path, in self._query(sql + ' ORDER BY name',
+                                                                      args)]
+
+    def _query(self, sql, args=()):
+        if not self.exists:
+            raise MirrorException('The mirror {} has not been indexed yet '
+                                  '(see `k2mosaic mirror`).'.format(self.root))
+        with self._index() as db:
+            return db.execute(sql, args).fetchall()
+
+    @contextmanager
+    def _index(self):
+        db = sqlite3.connect(self.index_fn, timeout=60)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def _read_mission_campaign_channel(path):
+    """Returns the (mission, campaign or quarter, channel) of a TPF."""
+    import fitsio
+    hdr = fitsio.read_header(path, ext=0)
+    if 'CAMPAIGN' in hdr and hdr['CAMPAIGN'] not in ('', None):
+        return 'k2', int(hdr['CAMPAIGN']), int(hdr['CHANNEL'])
+    elif 'CAMPAIGN' in hdr:  # C9 raw data lack a campaign number
+        return 'k2', 9, int(hdr['CHANNEL'])
+    return 'kepler', int(hdr['QUARTER']), int(hdr['CHANNEL'])
+
+
+_default_mirror = None
+
+
+def default_mirror():
+    """Returns the `MirrorIndex` of the K2MOSAIC_MIRROR directory,
+    or `None` if that variable is not set or the mirror is not indexed."""
+    global _default_mirror
+    root = os.getenv('K2MOSAIC_MIRROR')
+    if not root:
+        return None
+    if _default_mirror is None or _default_mirror.root != os.path.abspath(root):
+        _default_mirror = MirrorIndex(root)
+    return _default_mirror if _default_mirror.exists else None
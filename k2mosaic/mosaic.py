@@ -12,19 +12,19 @@ import glob
 import os
 import re
 
-import astropy
 from astropy.io import fits
 from astropy.io.fits import getheader
 from astropy.io.fits.card import UNDEFINED
-from astropy.time import Time
 
 import fitsio
 import numpy as np
 import pandas as pd
 import click
 import datetime
+import warnings
 
-from . import PACKAGEDIR, KEPLER_CHANNEL_SHAPE
+from . import PACKAGEDIR, KEPLER_CHANNEL_SHAPE, QUALITY_NO_DATA
+from .geometry import pinned_path
 
 FFI_HEADERS_FILE = os.path.join(PACKAGEDIR, 'data', 'k2-ffi-headers.csv')
 WCS_KEYS = ['TELESCOP', 'INSTRUME', 'CHANNEL', 'MODULE', 'OUTPUT', 'RADESYS',
@@ -40,12 +40,31 @@ class MosaicException(Exception):
 
 
 class KeplerChannelMosaic(object):
-    """Factory for an artificial Kepler Full-Frame Channel Image."""
+    """Factory for an artificial Kepler Full-Frame Channel Image.
+
+    If `compression` is set (e.g. 'RICE_1' or 'GZIP_1'), the IMAGE and
+    UNCERTAINTY extensions are written as FITS tile-compressed images.
+    The float data are quantized with `quantize_level` (a value of 0
+    gives lossless GZIP compression), using subtractive dithering unless
+    `dither` is `False`.
+
+    If given, `times` is the `k2mosaic.timing.CadenceTimes` of the channel,
+    from which the time keywords are looked up rather than computed.
+
+    If given, `ownership` is a `k2mosaic.ownership.OwnershipMap` of the
+    TPFs, and only the pixels each TPF owns are written.  Otherwise, where
+    apertures overlap, the last TPF added wins.
+    """
+    COMPRESSION_TYPES = ['RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1']
+
     def __init__(self, campaign=0, channel=1, cadenceno=1, data_store=None,
                  shape=KEPLER_CHANNEL_SHAPE, add_background=False, time=None,
                  quality=None, dateobs=None, dateend=None, mjdbeg=None, 
                  mjdend=None, template_tpf_header0=None,
-                 template_tpf_header1=None):
+                 template_tpf_header1=None, compression=None,
+                 quantize_level=16., dither=True, times=None, ownership=None):
+        if compression is not None and compression not in self.COMPRESSION_TYPES:
+            raise MosaicException('Unknown compression type: {}'.format(compression))
         self.campaign = campaign
         self.channel = channel
         self.cadenceno = cadenceno
@@ -64,6 +83,19 @@ class KeplerChannelMosaic(object):
         self.dateend = dateend
         self.mjdbeg = mjdbeg
         self.mjdend = mjdend
+        self.tstart = None
+        self.tstop = None
+        self.times = times
+        self.ownership = ownership
+        self.reference_fn = None
+        self.cosmic_rays = None
+        self.compression = compression
+        self.quantize_level = quantize_level
+        self.dither = dither
+        self.channel_size = int(np.prod(shape))
+        # Running totals of the background under the pixels, for `statistics`
+        self._background_sum = 0.
+        self._background_n = 0
 
     def gather_pixels(self):
         """Figures out the files needed and adds the pixels."""
@@ -71,15 +103,21 @@ class KeplerChannelMosaic(object):
         from .mast import get_tpf_urls
         urls = get_tpf_urls(self.campaign, channel=self.channel)
         print("Found {} target pixel files.".format(len(urls)))
+        mirror = None
+        if self.data_store is not None:
+            from .mirror import MirrorIndex
+            mirror = MirrorIndex(self.data_store)
+            if not mirror.exists:
+                print("Indexing the local mirror {}...".format(self.data_store))
+                mirror.build()
         with click.progressbar(urls, label="Reading target pixel files",
                                show_pos=True) as bar:
             for url in bar:
-                if self.data_store is not None:
-                    path = url.replace("http://archive.stsci.edu/missions/k2/target_pixel_files",
-                                       self.data_store)
-                else:
-                    path = url
-                self.add_tpf(path)
+                path = None if mirror is None else mirror.resolve(url)
+                self.add_tpf(path or url)
+        if self.data_store is None:
+            from .store import default_store
+            print(default_store().stats_summary())
 
     def add_wcs(self):
         """Injects the WCS keywords from an FFI of the same campaign."""
@@ -93,72 +131,156 @@ class KeplerChannelMosaic(object):
 
     def add_tpf(self, tpf_filename):
         #print("Adding {}".format(tpf_filename))
-        if tpf_filename.startswith("http"):
-            tpf_filename = astropy.utils.data.download_file(tpf_filename, cache=True)
-
-        self.template_tpf_header0 = getheader(tpf_filename, 0)
-        self.template_tpf_header1 = getheader(tpf_filename, 1)
-
-        tpf = fitsio.FITS(tpf_filename)
-        self.add_pixels(tpf)
-        tpf.close()
-
-    def add_pixels(self, tpf):
-        tpfdata = tpf[1].read()
-        aperture_shape = tpfdata['FLUX'][0].shape
+        owned = None
+        if self.ownership is not None:
+            owned = self.ownership.mask(tpf_filename)
+            # Skip a TPF whose pixels are all supplied by other TPFs, unless
+            # it is the first one and its headers are still needed
+            if not owned.any() and self.template_tpf_header1 is not None:
+                return
+        with pinned_path(tpf_filename) as path:
+            self.template_tpf_header0 = getheader(path, 0)
+            self.template_tpf_header1 = getheader(path, 1)
+            with fitsio.FITS(path) as tpf:
+                self.add_pixels(tpf, owned=owned)
+
+    def _aperture_mask(self, tpf, owned=None):
+        """Returns the pixels of a TPF to write: its aperture, or the part
+        of it which the TPF owns."""
+        mask = tpf[2].read() > 0
+        if owned is not None:
+            mask &= owned
+        return mask
+
+    def add_pixels(self, tpf, owned=None):
+        # Only read the table row of the cadence, not the whole table
+        first_cadenceno = tpf[1].read(columns=['CADENCENO'], rows=[0])['CADENCENO'][0]
+        tpfdata = tpf[1].read(rows=[self.cadenceno - first_cadenceno])
+        idx = 0
         # Get the pixel coordinates of the corner of the aperture
         col, row = (self.template_tpf_header1['1CRV5P'], self.template_tpf_header1['2CRV5P'])
-        height, width = aperture_shape[0], aperture_shape[1]
 
         # Fill the data
-        mask = tpf[2].read() > 0
-        idx = self.cadenceno - tpfdata["CADENCENO"][0]
+        mask = self._aperture_mask(tpf, owned)
 
         # When quality flag 65536 is raised, there is no data and the times are NaN.
-        if (tpfdata['QUALITY'][idx] & int(65536) > 0): 
+        if (tpfdata['QUALITY'][idx] & QUALITY_NO_DATA > 0):
             raise Exception('Error: Cadence {} does not appear to contain data!'.format(self.cadenceno))
 
         if self.add_background:
-            self.data[row:row+height, col:col+width][mask] = \
-                tpfdata['FLUX'][idx][mask] \
-                + tpfdata['FLUX_BKG'][idx][mask]
-            self.uncert[row:row+height, col:col+width][mask] = \
-                np.sqrt(
-                    (tpfdata['FLUX_ERR'][idx][mask])**2 +
-                    (tpfdata['FLUX_BKG_ERR'][idx][mask])**2
-                )
+            self._scatter(row, col, mask,
+                          tpfdata['FLUX'][idx][mask] + tpfdata['FLUX_BKG'][idx][mask],
+                          np.sqrt(
+                              (tpfdata['FLUX_ERR'][idx][mask])**2 +
+                              (tpfdata['FLUX_BKG_ERR'][idx][mask])**2
+                          ))
         else:
-            self.data[row:row+height, col:col+width][mask] = \
-                tpfdata['FLUX'][idx][mask]
-            self.uncert[row:row+height, col:col+width][mask] = \
-                tpfdata['FLUX_ERR'][idx][mask]
-
-        # If this is the first TPF being added, record the time and calculate DATE-OBS/END
+            self._scatter(row, col, mask,
+                          tpfdata['FLUX'][idx][mask],
+                          tpfdata['FLUX_ERR'][idx][mask])
+        background = tpfdata['FLUX_BKG'][idx][mask]
+        finite = np.isfinite(background)
+        self._background_sum += background[finite].sum(dtype=np.float64)
+        self._background_n += int(finite.sum())
+
+        # If this is the first TPF being added, record the time and DATE-OBS/END
         if self.time is None:
-            self.time = tpfdata['TIME'][idx]
-            self.quality = tpfdata['QUALITY'][idx]
-            frametim = np.float(self.template_tpf_header1['FRAMETIM'])
-            num_frm = np.float(self.template_tpf_header1['NUM_FRM'])
-
-            # Calculate DATE-OBS from BJD time:
-            mjd_start = self.time \
-                + np.float(self.template_tpf_header1['BJDREFI']) \
-                - frametim/3600./24./2. * num_frm \
-                - 2400000.5
-            self.mjdbeg = mjd_start
-            starttime = Time(mjd_start, format='mjd')
-            starttime = str(starttime.datetime)
-            self.dateobs = starttime.replace(' ', 'T') + 'Z'
-
-            # Calculate DATE-END:
-            mjd_end = self.time \
-                + np.float(self.template_tpf_header1['BJDREFI']) \
-                + frametim/3600./24./2. * num_frm \
-                - 2400000.5
-            self.mjdend = mjd_end
-            endtime = Time(mjd_end, format='mjd')
-            endtime = str(endtime.datetime)
-            self.dateend = endtime.replace(' ', 'T') + 'Z'
+            times = self.times
+            if times is None or self.cadenceno not in times:
+                times = self._cadence_times([self.cadenceno], tpfdata['TIME'][idx:idx + 1],
+                                            tpfdata['QUALITY'][idx:idx + 1])
+            self._set_times(times.row(self.cadenceno))
+
+    def _cadence_times(self, cadenceno, time, quality):
+        """Returns the `CadenceTimes` of a few cadences, for a mosaic made without a table."""
+        from .timing import CadenceTimes
+        return CadenceTimes(cadenceno, time, quality,
+                            float(self.template_tpf_header1['FRAMETIM']),
+                            float(self.template_tpf_header1['NUM_FRM']),
+                            float(self.template_tpf_header1['BJDREFI']))
+
+    def _set_times(self, row):
+        """Sets the time keywords from a row of `CadenceTimes`."""
+        self.time, self.quality = row['TIME'], row['QUALITY']
+        self.tstart, self.tstop = row['TSTART'], row['TSTOP']
+        self.mjdbeg, self.mjdend = row['MJD-BEG'], row['MJD-END']
+        self.dateobs, self.dateend = row['DATE-OBS'], row['DATE-END']
+
+    def _scatter(self, row, col, mask, flux, flux_err):
+        """Writes the pixels flagged in an aperture `mask` into the mosaic."""
+        height, width = mask.shape
+        self.data[row:row+height, col:col+width][mask] = flux
+        self.uncert[row:row+height, col:col+width][mask] = flux_err
+
+    def subtract_reference(self, reference_fn, data, uncert):
+        """Turns the mosaic into a difference image.
+
+        Parameters
+        ----------
+        reference_fn : str
+            Name of the reference mosaic, recorded in the header.
+
+        data, uncert : array
+            Reference image and its uncertainty, which is combined
+            in quadrature with the uncertainty of the mosaic.
+        """
+        self.data -= data
+        self.uncert = np.sqrt(self.uncert**2 + uncert**2)
+        self.reference_fn = reference_fn
+
+    def statistics(self):
+        """Returns summary statistics of the mosaic as a dict with the keys
+        of `k2mosaic.framestats.FRAME_STATS_COLUMNS` (except FILENAME),
+        computed over the covered pixels only."""
+        from .framestats import CUT_PERCENTILES
+        finite = np.isfinite(self.data)
+        values = self.data[finite]
+        if len(values) > 0:
+            low, median, high = np.percentile(values, [CUT_PERCENTILES[0], 50.,
+                                                       CUT_PERCENTILES[1]])
+            rows, cols = self._pixel_coordinates(finite)
+            bounds = [rows.min(), rows.max(), cols.min(), cols.max()]
+        else:
+            low = median = high = np.nan
+            bounds = [-1, -1, -1, -1]
+        background = np.nan
+        if self._background_n > 0:
+            background = self._background_sum / self._background_n
+        return {'CADENCENO': int(self.cadenceno),
+                'TIME': np.nan if self.time is None else float(self.time),
+                'QUALITY': 0 if self.quality is None else int(self.quality),
+                'COVERAGE': len(values) / float(self.channel_size),
+                'NPIXELS': len(values), 'FLUX_MEDIAN': float(median),
+                'FLUX_LOW': float(low), 'FLUX_HIGH': float(high),
+                'BACKGROUND': float(background),
+                'ROW_MIN': int(bounds[0]), 'ROW_MAX': int(bounds[1]),
+                'COL_MIN': int(bounds[2]), 'COL_MAX': int(bounds[3])}
+
+    def _pixel_coordinates(self, flags):
+        """Returns the (row, col) of the pixels flagged in an array like `data`."""
+        return np.nonzero(flags)
+
+    def add_cosmic_rays(self, row, col, excess, clean=False):
+        """Records the cosmic rays detected at this cadence.
+
+        Parameters
+        ----------
+        row, col : array of int
+            Channel coordinates of the affected pixels.
+
+        excess : array
+            Flux of the cosmic rays, i.e. the excess above the rolling median,
+            see `k2mosaic.cosmicrays`.
+
+        clean : bool
+            If `True`, also subtract the cosmic rays from the image.
+        """
+        self.cosmic_rays = (np.asarray(row), np.asarray(col), np.asarray(excess))
+        if clean:
+            self._clean(self.cosmic_rays[0], self.cosmic_rays[1], self.cosmic_rays[2])
+
+    def _clean(self, row, col, excess):
+        self.data[row, col] -= excess
 
     def to_fits(self):
         """Returns an astropy.io.fits.HDUList object."""
@@ -170,8 +292,8 @@ class KeplerChannelMosaic(object):
     def _make_primary_hdu(self):
         hdu = fits.PrimaryHDU()
 
-        int_time = np.float(self.template_tpf_header1['INT_TIME'])
-        num_frm = np.float(self.template_tpf_header1['NUM_FRM'])
+        int_time = float(self.template_tpf_header1['INT_TIME'])
+        num_frm = float(self.template_tpf_header1['NUM_FRM'])
 
         # Override the defaults where necessary
         hdu.header['NEXTEND'] = 3
@@ -234,7 +356,15 @@ class KeplerChannelMosaic(object):
 
     def _make_image_extension(self, extname, data):
         """Create an image extension."""
-        hdu = fits.ImageHDU(data)
+        if self.compression is None:
+            hdu = fits.ImageHDU(data)
+        else:
+            # Dithering avoids biasing the quantized values; NaNs are
+            # preserved by the tile compression convention (ZBLANK).
+            hdu = fits.CompImageHDU(data, compression_type=self.compression,
+                                    quantize_level=self.quantize_level,
+                                    quantize_method=1 if self.dither else -1,
+                                    dither_seed=1 if self.dither else 0)
 
         hdu.header.cards['NAXIS1'].comment = 'length of first array dimension'
         hdu.header.cards['NAXIS2'].comment = 'length of second array dimension'
@@ -264,18 +394,18 @@ class KeplerChannelMosaic(object):
             hdu.header[keyword] = self.template_tpf_header1[keyword]
             hdu.header.cards[keyword].comment = self.template_tpf_header1.comments[keyword]
 
-        frametim = np.float(self.template_tpf_header1['FRAMETIM'])
-        int_time = np.float(self.template_tpf_header1['INT_TIME'])
-        num_frm = np.float(self.template_tpf_header1['NUM_FRM'])
-        deadc = np.float(self.template_tpf_header1['DEADC'])
+        frametim = float(self.template_tpf_header1['FRAMETIM'])
+        int_time = float(self.template_tpf_header1['INT_TIME'])
+        num_frm = float(self.template_tpf_header1['NUM_FRM'])
+        deadc = float(self.template_tpf_header1['DEADC'])
 
         hdu.header['MIDTIME'] = self.time
         hdu.header.cards['MIDTIME'].comment = 'mid-time of exposure in BJD-BJDREF'
 
-        hdu.header['TSTART'] = self.time - frametim/3600./24./2. * num_frm
+        hdu.header['TSTART'] = self.tstart
         hdu.header.cards['TSTART'].comment = 'observation start time in BJD-BJDREF'
 
-        hdu.header['TSTOP'] = self.time + frametim/3600./24./2. * num_frm
+        hdu.header['TSTOP'] = self.tstop
         hdu.header.cards['TSTOP'].comment = 'observation stop time in BJD-BJDREF'
 
         hdu.header['TELAPSE'] = frametim/3600./24. * num_frm
@@ -326,6 +456,14 @@ class KeplerChannelMosaic(object):
         hdu.header['QUALITY'] = self.quality
         hdu.header.cards['QUALITY'].comment = 'data quality flags'
 
+        if self.reference_fn is not None:
+            hdu.header['DIFFREF'] = os.path.basename(self.reference_fn)
+            hdu.header.cards['DIFFREF'].comment = 'reference image subtracted'
+
+        if self.ownership is not None:
+            hdu.header['OVERLAP'] = self.ownership.policy
+            hdu.header.cards['OVERLAP'].comment = 'TPF supplying overlapping pixels'
+
         for keyword in ['RADESYS', 'EQUINOX']:
             hdu.header[keyword] = self.template_tpf_header1[keyword]
             hdu.header.cards[keyword].comment = self.template_tpf_header1.comments[keyword]
@@ -334,54 +472,306 @@ class KeplerChannelMosaic(object):
 
     def _make_cr_extension(self):
         """Create the cosmic ray extension (i.e. extension #3)."""
+        if self.cosmic_rays is None:
+            row, col, excess = np.array([]), np.array([]), np.array([])
+        else:
+            row, col, excess = self.cosmic_rays
         cols = []
-        cols.append(fits.Column(name='RAWX', format='I', disp='I4', array=np.array([])))
-        cols.append(fits.Column(name='RAWY', format='I', disp='I4', array=np.array([])))
-        cols.append(fits.Column(name='COSMIC_RAY', format='E', disp='E14.7', array=np.array([])))
+        cols.append(fits.Column(name='RAWX', format='I', disp='I4', array=col))
+        cols.append(fits.Column(name='RAWY', format='I', disp='I4', array=row))
+        cols.append(fits.Column(name='COSMIC_RAY', format='E', disp='E14.7', array=excess))
         coldefs = fits.ColDefs(cols)
         hdu = fits.BinTableHDU.from_columns(coldefs)
         return hdu
 
     def writeto(self, output_fn, overwrite=True):
-        self.to_fits().writeto(output_fn, overwrite=overwrite, checksum=True)
+        atomic_writeto(self.to_fits(), output_fn, overwrite=overwrite)
+
+
+class KeplerChannelStack(KeplerChannelMosaic):
+    """Factory for a channel image co-added over a window of cadences.
+
+    The pixels of each TPF are reduced over the window as soon as they are
+    read, so only the stacked image is kept in memory and written to disk.
+
+    Parameters
+    ----------
+    cadencenos : list of int
+        Cadence numbers to stack.
+
+    method : str
+        'mean', 'sum', or 'median'.
+
+    quality_bitmask : int
+        Cadences with any of these QUALITY bits set are left out of the
+        stack, as are cadences without data.
+
+    chunk_size : int, optional
+        Maximum number of cadences read from a TPF at once.  The mean and sum
+        are accumulated exactly; the median becomes the median of the
+        per-chunk medians, which is a robust running estimate of the median.
+    """
+    STACK_METHODS = ['mean', 'sum', 'median']
+
+    def __init__(self, cadencenos, method='mean', quality_bitmask=0, chunk_size=None,
+                 **kwargs):
+        if method not in self.STACK_METHODS:
+            raise MosaicException('Unknown stacking method: {}'.format(method))
+        super(KeplerChannelStack, self).__init__(cadenceno=cadencenos[0], **kwargs)
+        self.cadencenos = np.asarray(cadencenos)
+        self.method = method
+        self.quality_bitmask = int(quality_bitmask) | QUALITY_NO_DATA
+        self.chunk_size = chunk_size
+        self.ncadences = None
+
+    def add_pixels(self, tpf, owned=None):
+        # Only read the rows of the TPF table which fall inside the window,
+        # at most `chunk_size` rows at a time
+        first_cadenceno = tpf[1].read(columns=['CADENCENO'], rows=[0])['CADENCENO'][0]
+        rows = self.cadencenos - first_cadenceno
+        chunk_size = self.chunk_size or len(rows)
+        columns = ['TIME', 'QUALITY', 'FLUX', 'FLUX_ERR']
+        if self.add_background:
+            columns += ['FLUX_BKG', 'FLUX_BKG_ERR']
+        flux_sum, variance_sum, n = 0., 0., 0
+        chunk_medians, cadences, time, quality = [], [], [], []
+        for chunk_start in range(0, len(rows), chunk_size):
+            tpfdata = tpf[1].read(columns=columns,
+                                  rows=rows[chunk_start:chunk_start + chunk_size])
+            good = (tpfdata['QUALITY'] & self.quality_bitmask) == 0
+            if not good.any():
+                continue
+            flux = tpfdata['FLUX'][good]
+            variance = tpfdata['FLUX_ERR'][good].astype(np.float64)**2
+            if self.add_background:
+                flux = flux + tpfdata['FLUX_BKG'][good]
+                variance += tpfdata['FLUX_BKG_ERR'][good].astype(np.float64)**2
+            # Accumulate, ignoring pixels which are NaN in some cadences
+            finite = np.isfinite(flux)
+            n = n + finite.sum(axis=0)
+            flux_sum = flux_sum + np.where(finite, flux, 0.).sum(axis=0)
+            variance_sum = variance_sum + np.where(finite, variance, 0.).sum(axis=0)
+            if self.method == 'median':
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN pixels
+                    chunk_medians.append(np.nanmedian(flux, axis=0))
+            cadences.append(self.cadencenos[chunk_start:chunk_start + chunk_size][good])
+            time.append(tpfdata['TIME'][good])
+            quality.append(tpfdata['QUALITY'][good])
+        if len(time) == 0:
+            raise MosaicException('Error: cadences {}..{} do not appear to contain '
+                                  'good data!'.format(self.cadencenos[0], self.cadencenos[-1]))
+
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if self.method == 'sum':
+                stacked = flux_sum
+                stacked_err = np.sqrt(variance_sum)
+            elif self.method == 'mean':
+                stacked = flux_sum / n
+                stacked_err = np.sqrt(variance_sum) / n
+            else:
+                # With several chunks this is the median of the chunk medians.
+                # The median of n normal deviates is noisier than the mean
+                # by a factor sqrt(pi/2) in the large-n limit.
+                stacked = np.nanmedian(chunk_medians, axis=0)
+                stacked_err = np.sqrt(np.pi / 2. * variance_sum) / n
+        stacked[n == 0] = np.nan
+        stacked_err[n == 0] = np.nan
+
+        col, row = (self.template_tpf_header1['1CRV5P'], self.template_tpf_header1['2CRV5P'])
+        mask = self._aperture_mask(tpf, owned)
+        self._scatter(row, col, mask, stacked[mask], stacked_err[mask])
+
+        # If this is the first TPF being added, record the time span of the stack
+        if self.time is None:
+            cadences, time = np.concatenate(cadences), np.concatenate(time)
+            quality = np.concatenate(quality)
+            times = self.times
+            if times is None or cadences[0] not in times or cadences[-1] not in times:
+                times = self._cadence_times(cadences[[0, -1]], time[[0, -1]], quality[[0, -1]])
+            first, last = times.row(cadences[0]), times.row(cadences[-1])
+            self.ncadences = len(time)
+            self.time = float(np.mean(time))
+            self.quality = int(np.bitwise_or.reduce(quality))
+            self.tstart, self.tstop = float(first['TSTART']), float(last['TSTOP'])
+            self.mjdbeg, self.mjdend = first['MJD-BEG'], last['MJD-END']
+            self.dateobs, self.dateend = first['DATE-OBS'], last['DATE-END']
+
+    def _make_primary_hdu(self):
+        hdu = super(KeplerChannelStack, self)._make_primary_hdu()
+        hdu.header['XPOSURE'] = hdu.header['XPOSURE'] * self.ncadences
+        return hdu
+
+    def _make_image_extension(self, extname, data):
+        hdu = super(KeplerChannelStack, self)._make_image_extension(extname, data)
+        deadc = float(self.template_tpf_header1['DEADC'])
+        hdu.header['TSTART'] = self.tstart
+        hdu.header['TSTOP'] = self.tstop
+        hdu.header['TELAPSE'] = self.tstop - self.tstart
+        hdu.header['EXPOSURE'] = hdu.header['EXPOSURE'] * self.ncadences
+        hdu.header['LIVETIME'] = hdu.header['TELAPSE'] * deadc
+        hdu.header.cards['MIDTIME'].comment = 'mean mid-time of the stacked exposures'
+        hdu.header.cards['QUALITY'].comment = 'data quality flags (OR of stacked cadences)'
+        hdu.header['CADENCEN'] = int(self.cadencenos[0])
+        hdu.header.cards['CADENCEN'].comment = 'first cadence number of the stack'
+        hdu.header['CADENCEL'] = int(self.cadencenos[-1])
+        hdu.header.cards['CADENCEL'].comment = 'last cadence number of the stack'
+        hdu.header['NCADENCE'] = self.ncadences
+        hdu.header.cards['NCADENCE'].comment = 'number of good cadences stacked'
+        hdu.header['STACKMET'] = self.method
+        hdu.header.cards['STACKMET'].comment = 'method used to stack the cadences'
+        return hdu
+
+
+class SparseChannelMosaic(KeplerChannelMosaic):
+    """Factory for a channel mosaic which only stores the covered pixels.
+
+    `data` and `uncert` are 1D arrays holding the values of the pixels
+    listed in the coverage index, in the order of the index.
+
+    Parameters
+    ----------
+    coverage_fn : str
+        Coverage index file listing the pixels covered by the TPFs,
+        see `k2mosaic.sparse.CoverageIndex`.  The mosaic must be written
+        to the same directory as this file.
+    """
+    STRUCTURAL_KEYWORDS = ['XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                           'PCOUNT', 'GCOUNT']
+
+    def __init__(self, coverage_fn, **kwargs):
+        from .sparse import read_coverage
+        self.coverage_fn = coverage_fn
+        self.coverage = read_coverage(coverage_fn)
+        kwargs['shape'] = (len(self.coverage),)
+        super(SparseChannelMosaic, self).__init__(**kwargs)
+        self.channel_size = int(np.prod(self.coverage.shape))
+
+    def _scatter(self, row, col, mask, flux, flux_err):
+        positions = self.coverage.positions(row, col, mask)
+        self.data[positions] = flux
+        self.uncert[positions] = flux_err
+
+    def _pixel_coordinates(self, flags):
+        return np.unravel_index(self.coverage.pixels[flags], self.coverage.shape)
+
+    def _clean(self, row, col, excess):
+        positions = self.coverage.find(np.ravel_multi_index((row, col), self.coverage.shape))
+        self.data[positions] -= excess
+
+    def subtract_reference(self, reference_fn, data, uncert):
+        pixels = self.coverage.pixels
+        super(SparseChannelMosaic, self).subtract_reference(
+            reference_fn, data.ravel()[pixels], uncert.ravel()[pixels])
+
+    def to_dense(self):
+        """Returns the (data, uncert) of the mosaic as 2D NaN-padded images."""
+        return self.coverage.to_dense(self.data), self.coverage.to_dense(self.uncert)
+
+    def to_fits(self):
+        """Returns an astropy.io.fits.HDUList object."""
+        return fits.HDUList([self._make_primary_hdu(),
+                             self._make_sparse_extension('IMAGE', self.data),
+                             self._make_sparse_extension('UNCERTAINTY', self.uncert),
+                             self._make_cr_extension()])
+
+    def _make_sparse_extension(self, extname, values):
+        """Create a table extension holding the values of the covered pixels."""
+        hdu = fits.BinTableHDU.from_columns(
+                [fits.Column(name='VALUE', format='E', array=values)])
+        # Use the same keywords as a dense image extension
+        image_hdu = self._make_image_extension(extname, np.empty((1, 1), dtype=np.float32))
+        for card in image_hdu.header.cards:
+            if card.keyword not in self.STRUCTURAL_KEYWORDS:
+                hdu.header.append(card)
+        hdu.header['COVERAGE'] = os.path.basename(self.coverage_fn)
+        hdu.header.cards['COVERAGE'].comment = 'coverage index of the VALUE column'
+        hdu.header['DNAXIS1'] = self.coverage.shape[1]
+        hdu.header.cards['DNAXIS1'].comment = 'length of first dense array dimension'
+        hdu.header['DNAXIS2'] = self.coverage.shape[0]
+        hdu.header.cards['DNAXIS2'].comment = 'length of second dense array dimension'
+        return hdu
+
+
+def atomic_writeto(hdulist, output_fn, overwrite=True):
+    """Writes an HDUList under a temporary name, then renames it to `output_fn`.
+
+    An interrupted process thus never leaves a truncated file behind,
+    and `output_fn` exists if and only if it is complete.
+    """
+    if not overwrite and os.path.exists(output_fn):
+        raise OSError('File {} already exists.'.format(output_fn))
+    tmp_fn = '{}.tmp{}'.format(output_fn, os.getpid())
+    try:
+        hdulist.writeto(tmp_fn, overwrite=True, checksum=True)
+        os.replace(tmp_fn, output_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
 
 
 ###
 # Functions to export and retrieve WCS keywords from standard K2 FFIs
 ###
 
-def export_ffi_headers(output_fn=FFI_HEADERS_FILE, ffi_store=None):
+def export_ffi_headers(output_fn=FFI_HEADERS_FILE, ffi_store=None, processes=None,
+                       incremental=True):
     """Writes the headers of all available K2 FFI's to a csv table.
 
     This will enable us to inject WCS keywords from real FFI's into the sparse
-    FFI's created by k2mosaic."""
+    FFI's created by k2mosaic.
+
+    Only the headers of the FFIs are read, using a pool of `processes`.
+    If `incremental` is `True` and `output_fn` exists, only FFIs which are
+    not yet listed in the table are read, and their rows are appended.
+    """
     if ffi_store is None:
         ffi_store = os.path.join(os.getenv("K2DATA"), 'ffi')
+    ffi_filenames = sorted(glob.glob(os.path.join(ffi_store, '*cal.fits')))
+    columns = ['campaign', 'filename', 'extension'] + WCS_KEYS  # Keep column order as in FITS files
+    append = incremental and os.path.exists(output_fn)
+    if append:
+        known = set(pd.read_csv(output_fn, usecols=['filename'])['filename'])
+        ffi_filenames = [fn for fn in ffi_filenames if os.path.basename(fn) not in known]
+    if len(ffi_filenames) == 0:
+        print('{} is up to date.'.format(output_fn))
+        return
+
+    from multiprocessing import Pool
     ffi_headers = []
-    ffi_filenames = glob.glob(os.path.join(ffi_store, '*cal.fits'))
-    with click.progressbar(ffi_filenames, label="Reading FFI files",
-                           show_pos=True) as bar:
-        for filename in bar:
-            basename = os.path.basename(filename)
-            # Extract the campaign number from the FFI filename
-            campaign = int(re.match(".*c([0-9]+)_.*", basename).group(1))
-            fts = fits.open(filename)
-            for ext in range(1, 85):
-                try:
-                    keywords = OrderedDict()
-                    keywords['campaign'] = campaign
-                    keywords['filename'] = basename
-                    keywords['extension'] = ext
-                    for kw in WCS_KEYS:
-                        keywords[kw] = fts[ext].header[kw]
-                    ffi_headers.append(keywords)
-                except KeyError:
-                    pass
+    with Pool(processes=processes) as pool:
+        with click.progressbar(pool.imap_unordered(_read_ffi_wcs_keywords, ffi_filenames),
+                               length=len(ffi_filenames), label="Reading FFI headers",
+                               show_pos=True) as bar:
+            for keywords in bar:
+                ffi_headers.extend(keywords)
     # Convert to a pandas dataframe and then export to csv
-    df = pd.DataFrame(ffi_headers)
-    df = df.sort_values(["campaign", "filename"])
-    columns = list(ffi_headers[0].keys())  # Keep column order as in FITS files
-    df[columns].to_csv(output_fn, index=False)
+    df = pd.DataFrame(ffi_headers, columns=columns)
+    df = df.sort_values(["campaign", "filename", "extension"])
+    df.to_csv(output_fn, index=False, mode='a' if append else 'w', header=not append)
+
+
+def _read_ffi_wcs_keywords(filename):
+    """Returns the WCS keywords of each channel of an FFI, without reading any data."""
+    basename = os.path.basename(filename)
+    # Extract the campaign number from the FFI filename
+    campaign = int(re.match(".*c([0-9]+)_.*", basename).group(1))
+    ffi_headers = []
+    with fitsio.FITS(filename) as fts:
+        for ext in range(1, min(len(fts), 85)):
+            header = fts[ext].read_header()
+            try:
+                keywords = OrderedDict()
+                keywords['campaign'] = campaign
+                keywords['filename'] = basename
+                keywords['extension'] = ext
+                for kw in WCS_KEYS:
+                    keywords[kw] = header[kw]
+                ffi_headers.append(keywords)
+            except KeyError:
+                pass
+    return ffi_headers
 
 
 def get_ffi_header(campaign=0, channel=1, FFI_HEADERS_FILE=FFI_HEADERS_FILE):
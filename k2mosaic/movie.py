@@ -1,23 +1,33 @@
 """Convert a set of mosaics into a video or animated gif."""
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as pl
-
+import math
 import os
 import click
 
-from astropy import visualization
-import fitsio
-import imageio
 import numpy as np
 
 from . import KEPLER_CHANNEL_SHAPE
+from .sparse import read_mosaic_image
+
+MOVIE_WIDTH = 440  # Minimum width of the movies in screen pixels
+# Palette indices of the gif movies which are not used by the colormap
+NAN_INDEX, UNCHANGED_INDEX = 254, 255
+NAN_COLOR = (51, 51, 51)  # #333333, like the background of the exported frames
 
 
 class InvalidFrameException(Exception):
     pass
 
 
+def _pyplot():
+    """Returns matplotlib.pyplot using the non-interactive Agg backend.
+
+    Matplotlib is imported on first use because it is slow to import."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as pl
+    return pl
+
+
 class KeplerMosaicMovieFrame(object):
 
     def __init__(self, fits_filename):
@@ -25,11 +35,12 @@ class KeplerMosaicMovieFrame(object):
 
     def to_fig(self, rowrange, colrange, extension=1, cmap='Greys_r', cut=None, dpi=50):
         """Turns a fits file into a cropped and contrast-stretched matplotlib figure."""
-        fts = fitsio.FITS(self.fits_filename)
-        if (np.isfinite(fts[extension].read())).sum() == 0:
+        from astropy import visualization
+        pl = _pyplot()
+        image = read_mosaic_image(self.fits_filename, extension)
+        if (np.isfinite(image)).sum() == 0:
             raise InvalidFrameException()
-        image = fts[extension].read()[rowrange[0]:rowrange[1], colrange[0]:colrange[1]]
-        fts.close()
+        image = image[rowrange[0]:rowrange[1], colrange[0]:colrange[1]]
         if cut is None:
             cut = np.percentile(image[np.isfinite(image)], [10, 99.5])
         transform = visualization.LogStretch() + visualization.ManualInterval(vmin=cut[0], vmax=cut[1])
@@ -53,18 +64,28 @@ class KeplerMosaicMovieFrame(object):
 
 
 class KeplerMosaicMovie(object):
+    """Movie of a list of mosaics, cropped to `rowrange` and `colrange`.
 
+    If given, `statistics` is the `k2mosaic.framestats.FrameStatistics`
+    of the mosaics: the mosaics it flags as not containing data are left
+    out, and unless the movie crops the data, the cut levels are taken
+    from it rather than from the pixels of a sample of mosaics.
+    """
     def __init__(self, mosaic_filenames,
                  rowrange=(0, KEPLER_CHANNEL_SHAPE[0]),
-                 colrange=(0, KEPLER_CHANNEL_SHAPE[1])):
+                 colrange=(0, KEPLER_CHANNEL_SHAPE[1]), statistics=None):
+        if statistics is not None:
+            mosaic_filenames = statistics.valid_filenames(mosaic_filenames)
         self.mosaic_filenames = mosaic_filenames
         self.rowrange = rowrange
         self.colrange = colrange
+        self.statistics = statistics
 
     def get_frame(self, frame_number=0):
         return KeplerMosaicMovieFrame(self.mosaic_filenames[frame_number])
 
     def export_frames(self, extension=1, cut=None):
+        pl = _pyplot()
         for fn in click.progressbar(self.mosaic_filenames, label="Reading mosaics", show_pos=True):
             try:
                 frame = KeplerMosaicMovieFrame(fn)
@@ -75,26 +96,150 @@ class KeplerMosaicMovie(object):
             except InvalidFrameException:
                 print("InvalidFrameException for {}".format(fn))
 
-    def to_movie(self, output_fn, fps=15., dpi=50, cut=None, cmap='gray', extension=1):
-        viz = []
+    def cut_levels(self, min_percent=10., max_percent=99.5, extension=1, sample=10):
+        """Returns the (min, max) cut levels of a stretch shared by all frames,
+        from the percentiles of the pixels of `sample` evenly spaced frames."""
+        if self._statistics_cover(extension, (min_percent, max_percent)):
+            levels = self.statistics.cut_levels()
+            if levels is not None:
+                return levels
+        idx = np.unique(np.linspace(0, len(self.mosaic_filenames) - 1, sample).astype(int))
+        values = []
+        for i in idx:
+            image = read_mosaic_image(self.mosaic_filenames[i], extension)
+            image = image[self.rowrange[0]:self.rowrange[1], self.colrange[0]:self.colrange[1]]
+            values.append(image[np.isfinite(image)])
+        values = np.concatenate(values)
+        if len(values) == 0:
+            raise InvalidFrameException('The mosaics do not contain any data.')
+        return tuple(np.percentile(values, [min_percent, max_percent]))
+
+    def _statistics_cover(self, extension, percentiles):
+        """Can the cut levels be taken from the statistics of the mosaics?"""
+        from .framestats import CUT_PERCENTILES
+        if self.statistics is None or extension != 1 or tuple(percentiles) != CUT_PERCENTILES:
+            return False
+        bounds = self.statistics.bounds()
+        return bounds is not None and all(
+            crop[0] <= bound[0] and crop[1] >= bound[1]
+            for crop, bound in zip([self.rowrange, self.colrange], bounds))
+
+    def export_pyramids(self, output_dir='.', extension=1, cut=None, cmap='gray',
+                        zoom=16, tile_size=256, workers=None):
+        """Writes a Deep Zoom tile pyramid for every frame.
+
+        Parameters
+        ----------
+        output_dir : str
+            Directory in which a `.dzi` file and a `_files` directory
+            of tiles are written for each mosaic.
+
+        cut : (float, float), optional
+            Cut levels of the stretch, defaults to `cut_levels()`.
+
+        zoom : int
+            Screen pixels per Kepler pixel at the finest level; a power of two.
+
+        workers : int, optional
+            Number of threads encoding and writing tiles.
+
+        Returns
+        -------
+        dzi_filenames : list of str
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from .pyramid import write_pyramid
+        if cut is None:
+            cut = self.cut_levels(extension=extension)
+        dzi_filenames = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            with click.progressbar(self.mosaic_filenames, label="Writing pyramids",
+                                   show_pos=True) as bar:
+                for fn in bar:
+                    image = read_mosaic_image(fn, extension)
+                    image = image[self.rowrange[0]:self.rowrange[1],
+                                  self.colrange[0]:self.colrange[1]]
+                    output_base = os.path.join(output_dir,
+                                               os.path.splitext(os.path.basename(fn))[0])
+                    write_pyramid(image, output_base, cut=cut, cmap=cmap, zoom=zoom,
+                                  tile_size=tile_size, executor=executor)
+                    dzi_filenames.append(output_base + '.dzi')
+        return dzi_filenames
+
+    def render_frames(self, dpi=50, cut=None, cmap='gray', extension=1):
+        """Yields the frames rendered by matplotlib as RGB arrays."""
+        pl = _pyplot()
         with click.progressbar(self.mosaic_filenames, label="Reading mosaics", show_pos=True) as bar:
             for fn in bar:
                 try:
                     frame = KeplerMosaicMovieFrame(fn)
                     fig = frame.to_fig(rowrange=self.rowrange, colrange=self.colrange,
                                        dpi=dpi, cut=cut, cmap=cmap, extension=extension,)
-                    img = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep='')
-                    img = img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
+                    img = np.array(fig.canvas.buffer_rgba())[:, :, :3]
                     pl.close(fig)  # Avoid memory leak!
-                    viz.append(img)
+                    yield img
                 except InvalidFrameException:
                     print("InvalidFrameException for {}".format(fn))
-                    # Save the output as a movie
+
+    def to_movie(self, output_fn, fps=15., dpi=50, cut=None, cmap='gray', extension=1):
+        """Writes a movie; gifs are written by `to_gif`, other formats
+        (e.g. mp4) from the frames rendered by matplotlib."""
         if output_fn.endswith('.gif'):
-            kwargs = {'duration': 1. / fps}
-        else:
-            kwargs = {'fps': fps}
-        imageio.mimsave(output_fn, viz, **kwargs)
+            return self.to_gif(output_fn, fps=fps, cut=cut, cmap=cmap, extension=extension)
+        import imageio
+        with imageio.get_writer(output_fn, fps=fps) as writer:
+            for img in self.render_frames(dpi=dpi, cut=cut, cmap=cmap, extension=extension):
+                writer.append_data(img)
+
+    def to_gif(self, output_fn, fps=15., cut=None, cmap='gray', extension=1, scale=None):
+        """Writes an animated gif, streaming the frames to disk.
+
+        All frames share one stretch and the palette of the colormap, so
+        their pixels are mapped directly onto palette indices rather than
+        quantized frame by frame, and only the pixels which changed since
+        the previous frame are encoded (see `k2mosaic.gif.GifWriter`).
+
+        Parameters
+        ----------
+        cut : (float, float), optional
+            Cut levels of the stretch, defaults to `cut_levels()`.
+
+        scale : int, optional
+            Screen pixels per Kepler pixel, by default the smallest scale
+            which makes the movie at least `MOVIE_WIDTH` pixels wide.
+
+        Returns
+        -------
+        n_frames : int
+            Number of distinct frames written.
+        """
+        from .gif import GifWriter
+        from .pyramid import Colorizer
+        if cut is None:
+            cut = self.cut_levels(extension=extension)
+        if scale is None:
+            width = self.colrange[1] - self.colrange[0]
+            scale = max(1, int(math.ceil(MOVIE_WIDTH / float(width))))
+        colorize = Colorizer(cut, cmap=cmap, n_colors=NAN_INDEX)
+        palette = np.vstack([colorize.lut[:, :3], NAN_COLOR])
+        with GifWriter(output_fn, palette, duration=1000. / fps,
+                       transparent_index=UNCHANGED_INDEX) as gif:
+            with click.progressbar(self.mosaic_filenames, label="Reading mosaics",
+                                   show_pos=True) as bar:
+                for fn in bar:
+                    image = read_mosaic_image(fn, extension)
+                    image = image[self.rowrange[0]:self.rowrange[1],
+                                  self.colrange[0]:self.colrange[1]]
+                    if not np.isfinite(image).any():
+                        print("InvalidFrameException for {}".format(fn))
+                        continue
+                    frame, finite = colorize.index(image)
+                    frame[~finite] = NAN_INDEX
+                    frame = np.flipud(frame)  # Row 0 at the bottom, like `to_fig`
+                    if scale > 1:
+                        frame = frame.repeat(scale, axis=0).repeat(scale, axis=1)
+                    gif.append(frame)
+        return gif.n_frames
 
     def save_movie(self, output_fn=None, start=None, stop=None, step=None,
                    fps=15., dpi=None, min_percent=1., max_percent=95.,
@@ -153,6 +298,8 @@ class KeplerMosaicMovie(object):
              If `True`, any frames which cannot be rendered will be ignored
              without raising a ``BadKeplerFrame`` exception. Default: `True`.
         """
+        import imageio
+        pl = _pyplot()
         if output_fn is None:
             output_fn = self.mosaic_filenames[0].split('/')[-1] + '.gif'
         # Determine cut levels for contrast stretching from a sample of pixels
@@ -188,9 +335,3 @@ class KeplerMosaicMovie(object):
         else:
             kwargs = {'fps': fps}
         imageio.mimsave(output_fn, viz, **kwargs)
-
-    def to_gif(self):
-        pass
-
-    def to_mp4(self):
-        pass
@@ -0,0 +1,205 @@
+"""Decides which TPF supplies each pixel of a channel where apertures overlap.
+
+Without an ownership map, `KeplerChannelMosaic` writes every aperture pixel
+of every TPF, so that pixels covered by several apertures are written once
+per TPF and the last TPF in the list wins.  An ownership map assigns each
+covered pixel of the channel to exactly one TPF beforehand, following a
+policy:
+
+* 'first': the first TPF in the list which covers the pixel;
+* 'last': the last one, which reproduces the mosaics made without a map;
+* 'snr': the TPF in which the pixel has the highest median signal-to-noise
+  ratio over a sample of cadences, with ties going to the TPF whose file
+  name sorts first, so that the result does not depend on the file order.
+
+The mosaics then only write the pixels each TPF owns, and skip the TPFs
+which own no pixels at all.
+
+Example usage
+-------------
+ownership = OwnershipMap.from_tpfs(tpf_filenames, policy='snr')
+print(ownership.summary())
+ownership.writeto('k2mosaic-c05-ch15-ownership.fits')
+mosaic = KeplerChannelMosaic(ownership=read_ownership('k2mosaic-c05-ch15-ownership.fits'))
+"""
+import os
+import warnings
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE, QUALITY_NO_DATA
+
+OWNERSHIP_POLICIES = ['first', 'last', 'snr']
+SNR_SAMPLE = 10  # Number of cadences read from each TPF by the 'snr' policy
+
+
+class OwnershipException(Exception):
+    pass
+
+
+class OwnershipMap(object):
+    """The index of the TPF which supplies each pixel of a channel.
+
+    Parameters
+    ----------
+    owner : 2D array of int
+        Index into `tpf_filenames` of the owner of each pixel, -1 where
+        no TPF covers the pixel.
+
+    tpf_filenames : list of str
+
+    boxes : array of shape (n_tpfs, 4)
+        (row, col, height, width) of the aperture of each TPF.
+
+    depth : 2D array of int, optional
+        Number of apertures covering each pixel.
+
+    policy : str
+    """
+    def __init__(self, owner, tpf_filenames, boxes, depth=None, policy='last'):
+        self.owner = owner
+        self.tpf_filenames = list(tpf_filenames)
+        self.boxes = np.asarray(boxes, dtype=int).reshape(-1, 4)
+        self.depth = depth
+        self.policy = policy
+        self._index = {fn: idx for idx, fn in enumerate(self.tpf_filenames)}
+
+    @classmethod
+    def from_tpfs(cls, tpf_filenames, policy='last', shape=KEPLER_CHANNEL_SHAPE):
+        """Builds the map from the aperture masks (and, for the 'snr'
+        policy, a sample of the pixels) of a set of TPFs."""
+        from .geometry import read_tpf_geometry
+        return cls.from_geometry([read_tpf_geometry(fn) for fn in tpf_filenames],
+                                 policy=policy, shape=shape)
+
+    @classmethod
+    def from_geometry(cls, geometry, policy='last', shape=KEPLER_CHANNEL_SHAPE):
+        """Builds the map from a list of `k2mosaic.geometry.TPFGeometry`."""
+        if policy not in OWNERSHIP_POLICIES:
+            raise OwnershipException('Unknown ownership policy: {}'.format(policy))
+        owner = np.full(shape, -1, dtype=np.int32)
+        depth = np.zeros(shape, dtype=np.int16)
+        order = range(len(geometry))
+        if policy == 'first':
+            order = reversed(order)
+        elif policy == 'snr':
+            order = sorted(order, key=lambda idx: os.path.basename(geometry[idx].filename))
+            best = np.full(shape, -np.inf)
+        for idx in order:
+            geo = geometry[idx]
+            box = (slice(geo.row, geo.row + geo.height), slice(geo.col, geo.col + geo.width))
+            depth[box] += geo.mask
+            claimed = geo.mask.copy()
+            if policy == 'snr':
+                snr = median_snr(geo.filename)
+                claimed &= (snr > best[box]) | (owner[box] < 0)
+                best[box][claimed] = snr[claimed]
+            owner[box][claimed] = idx
+        boxes = [(geo.row, geo.col, geo.height, geo.width) for geo in geometry]
+        return cls(owner, [geo.filename for geo in geometry], boxes, depth=depth,
+                   policy=policy)
+
+    def __len__(self):
+        return len(self.tpf_filenames)
+
+    def mask(self, tpf):
+        """Returns the pixels of the aperture box of a TPF (given by filename
+        or index) which it owns."""
+        if isinstance(tpf, str):
+            if tpf not in self._index:
+                raise OwnershipException('{} is not in the ownership map.'.format(tpf))
+            tpf = self._index[tpf]
+        idx = int(tpf)
+        row, col, height, width = self.boxes[idx]
+        return self.owner[row:row + height, col:col + width] == idx
+
+    def masks(self):
+        """Returns the owned pixels of every TPF."""
+        return [self.mask(idx) for idx in range(len(self))]
+
+    def stats(self):
+        """Returns a dict of overlap statistics."""
+        owned = np.bincount(self.owner[self.owner >= 0], minlength=len(self))
+        stats = {'tpfs': len(self), 'covered_pixels': int((self.owner >= 0).sum()),
+                 'owned_pixels': owned.tolist(),
+                 'tpfs_without_pixels': int((owned == 0).sum())}
+        if self.depth is not None:
+            aperture_pixels = int(self.depth.sum())
+            stats.update({'overlapping_pixels': int((self.depth > 1).sum()),
+                          'max_depth': int(self.depth.max()) if self.depth.size else 0,
+                          'redundant_writes': aperture_pixels - stats['covered_pixels']})
+        return stats
+
+    def summary(self):
+        """Returns a human-readable description of the overlaps."""
+        stats = self.stats()
+        line = 'Pixel ownership ({}): {} pixels covered by {} TPFs'.format(
+               self.policy, stats['covered_pixels'], stats['tpfs'])
+        if self.depth is not None:
+            line += (', {overlapping_pixels} covered by several apertures (up to '
+                     '{max_depth}), saving {redundant_writes} pixel writes per '
+                     'cadence'.format(**stats))
+        return line + '; {} TPFs own no pixels.'.format(stats['tpfs_without_pixels'])
+
+    def writeto(self, output_fn, overwrite=True):
+        from astropy.io import fits
+        primary = fits.PrimaryHDU(self.owner.astype(np.int32))
+        primary.header['EXTNAME'] = 'OWNER'
+        primary.header['POLICY'] = (self.policy, 'how overlapping pixels are assigned')
+        hdus = [primary]
+        if self.depth is not None:
+            hdus.append(fits.ImageHDU(self.depth, name='DEPTH'))
+        tpfs = fits.BinTableHDU.from_columns([
+            fits.Column(name='FILENAME', format='{}A'.format(
+                max([len(fn) for fn in self.tpf_filenames] + [1])),
+                        array=np.array(self.tpf_filenames)),
+            fits.Column(name='ROW', format='J', array=self.boxes[:, 0]),
+            fits.Column(name='COL', format='J', array=self.boxes[:, 1]),
+            fits.Column(name='HEIGHT', format='J', array=self.boxes[:, 2]),
+            fits.Column(name='WIDTH', format='J', array=self.boxes[:, 3])])
+        tpfs.header['EXTNAME'] = 'TPFS'
+        hdus.append(tpfs)
+        fits.HDUList(hdus).writeto(output_fn, overwrite=overwrite, checksum=True)
+
+    @classmethod
+    def read(cls, filename):
+        import fitsio
+        with fitsio.FITS(filename) as fts:
+            owner = fts['OWNER'].read()
+            policy = fts['OWNER'].read_header()['POLICY']
+            depth = fts['DEPTH'].read() if 'DEPTH' in fts else None
+            tpfs = fts['TPFS'].read()
+        boxes = np.stack([tpfs[column] for column in ['ROW', 'COL', 'HEIGHT', 'WIDTH']],
+                         axis=-1)
+        filenames = [fn.decode() if isinstance(fn, bytes) else str(fn)
+                     for fn in tpfs['FILENAME']]
+        return cls(owner, [fn.strip() for fn in filenames], boxes, depth=depth, policy=policy)
+
+
+def median_snr(tpf_filename, sample=SNR_SAMPLE):
+    """Returns the median FLUX / FLUX_ERR of each aperture pixel over
+    `sample` evenly spaced cadences with data; -inf where it is undefined."""
+    import fitsio
+    from .geometry import pinned_path
+    with pinned_path(tpf_filename) as path, fitsio.FITS(path) as tpf:
+        quality = tpf[1].read(columns=['QUALITY'])['QUALITY']
+        rows = np.nonzero((quality & QUALITY_NO_DATA) == 0)[0]
+        if len(rows) == 0:
+            return np.full(tpf[2].read().shape, -np.inf)
+        rows = rows[np.unique(np.linspace(0, len(rows) - 1, sample).astype(int))]
+        tbl = tpf[1].read(columns=['FLUX', 'FLUX_ERR'], rows=rows)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN pixels
+        snr = np.nanmedian(tbl['FLUX'] / tbl['FLUX_ERR'], axis=0)
+    return np.where(np.isfinite(snr), snr, -np.inf)
+
+
+_OWNERSHIP_CACHE = {}
+
+
+def read_ownership(filename):
+    """Returns the `OwnershipMap` stored in `filename`, cached per process."""
+    filename = os.path.abspath(filename)
+    if filename not in _OWNERSHIP_CACHE:
+        _OWNERSHIP_CACHE[filename] = OwnershipMap.read(filename)
+    return _OWNERSHIP_CACHE[filename]
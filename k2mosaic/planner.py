@@ -0,0 +1,158 @@
+"""Decides which cadences are worth mosaicking before any pixels are read.
+
+Every cadence of a channel mosaic requires all the TPFs to be opened,
+so it pays off to discard cadences without data (or with unwanted quality
+flags) up front using the QUALITY column of a single TPF.
+
+Example usage
+-------------
+plan = plan_cadences(tpf_filenames, cadencelist, quality_bitmask=1130799)
+print(plan.summary())
+plan.kept  # cadences to mosaic
+"""
+import os
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE, QUALITY_NO_DATA
+
+
+class CadencePlan(object):
+    """The outcome of filtering a list of cadences on their quality flags.
+
+    Parameters
+    ----------
+    kept : list of int
+        Cadence numbers which will be mosaicked.
+
+    skipped : dict
+        Maps the cadence numbers which will not be mosaicked onto their
+        QUALITY flag value (or `None` if the cadence is absent from the TPFs).
+
+    bytes_per_cadence : int or None
+        Number of bytes read from the TPFs to mosaic one cadence, i.e. one
+        table row per TPF (or the whole of a gzipped TPF), or `None` if the
+        TPFs are not available locally (e.g. urls).
+    """
+    def __init__(self, kept, skipped, bytes_per_cadence=None,
+                 shape=KEPLER_CHANNEL_SHAPE):
+        self.kept = kept
+        self.skipped = skipped
+        self.bytes_per_cadence = bytes_per_cadence
+        self.shape = shape
+
+    @property
+    def bytes_read(self):
+        """Estimated number of bytes read from the TPFs."""
+        if self.bytes_per_cadence is None:
+            return None
+        return self.bytes_per_cadence * len(self.kept)
+
+    @property
+    def bytes_written(self):
+        """Estimated number of bytes written, i.e. two float32 images per mosaic."""
+        return 2 * 4 * int(np.prod(self.shape)) * len(self.kept)
+
+    def summary(self):
+        """Returns a human-readable description of the plan."""
+        flags = list(self.skipped.values())
+        n_missing = flags.count(None)
+        n_nodata = len([q for q in flags if q is not None and q & QUALITY_NO_DATA])
+        n_flagged = len(flags) - n_missing - n_nodata
+        lines = ['Cadence plan: {} to mosaic, {} skipped ({} without data, '
+                 '{} flagged by the quality bitmask, {} not found).'.format(
+                    len(self.kept), len(flags), n_nodata, n_flagged, n_missing)]
+        if self.bytes_read is None:
+            lines.append('Estimated I/O: unknown read volume (remote files), '
+                         '{} written.'.format(_format_bytes(self.bytes_written)))
+        else:
+            lines.append('Estimated I/O: {} read, {} written.'.format(
+                         _format_bytes(self.bytes_read),
+                         _format_bytes(self.bytes_written)))
+        return '\n'.join(lines)
+
+
+def read_quality_table(filename):
+    """Returns the (CADENCENO, QUALITY) columns of a TPF or of an index table.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a Target Pixel File, or to a csv index file with
+        CADENCENO and QUALITY columns (e.g. written by `write_quality_index`).
+    """
+    if filename.endswith('.csv'):
+        import pandas as pd
+        df = pd.read_csv(filename)
+        return df['CADENCENO'].values, df['QUALITY'].values
+    import fitsio
+    from .geometry import pinned_path
+    with pinned_path(filename) as path:
+        tbl = fitsio.read(path, ext=1, columns=['CADENCENO', 'QUALITY'])
+    return tbl['CADENCENO'], tbl['QUALITY']
+
+
+def write_quality_index(tpf_filename, output_fn):
+    """Saves the CADENCENO/QUALITY columns of a TPF to a small csv index."""
+    import pandas as pd
+    cadenceno, quality = read_quality_table(tpf_filename)
+    pd.DataFrame({'CADENCENO': cadenceno, 'QUALITY': quality}).to_csv(output_fn, index=False)
+
+
+def plan_cadences(tpf_filenames, cadencelist, quality_bitmask=0, index=None,
+                  shape=KEPLER_CHANNEL_SHAPE):
+    """Drops the cadences which are empty or flagged by `quality_bitmask`.
+
+    Parameters
+    ----------
+    tpf_filenames : list of str
+        The TPFs to be mosaicked.  Only the first one is read.
+
+    cadencelist : list of int
+        The cadence numbers requested by the user.
+
+    quality_bitmask : int
+        Cadences for which ``QUALITY & quality_bitmask`` is non-zero are
+        skipped.  Cadences without data (flag 65536) are always skipped.
+
+    index : str, optional
+        A quality index file to read instead of the first TPF.
+
+    Returns
+    -------
+    plan : `CadencePlan`
+    """
+    cadenceno, quality = read_quality_table(index or tpf_filenames[0])
+    flags = dict(zip(np.asarray(cadenceno).tolist(), np.asarray(quality).tolist()))
+    bitmask = int(quality_bitmask) | QUALITY_NO_DATA
+    kept, skipped = [], {}
+    for cad in cadencelist:
+        flag = flags.get(int(cad))
+        if flag is None or flag & bitmask:
+            skipped[int(cad)] = flag
+        else:
+            kept.append(int(cad))
+    return CadencePlan(kept, skipped,
+                       bytes_per_cadence=_bytes_per_cadence(tpf_filenames),
+                       shape=shape)
+
+
+def _bytes_per_cadence(filenames):
+    """Bytes read from a list of local TPFs to mosaic one cadence, or `None`
+    if any are remote.  A row of the pixel table is read from each TPF,
+    except from gzipped TPFs, which cfitsio decompresses entirely."""
+    from .resources import tpf_table_sizes
+    if any(not os.path.exists(fn) for fn in filenames):
+        return None
+    nbytes = 0
+    for fn, (row_bytes, n_rows) in zip(filenames, tpf_table_sizes(filenames)):
+        nbytes += os.path.getsize(fn) if fn.endswith('.gz') else row_bytes
+    return nbytes
+
+
+def _format_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024.:
+            return '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024.
+    return '{:.1f} TB'.format(nbytes)
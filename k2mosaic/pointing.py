@@ -0,0 +1,197 @@
+"""Tracks the pointing drift of a channel from the flux of its apertures.
+
+K2's roll, corrected by thruster firings every few hours, moves the stars
+across their apertures.  The drift of a channel is measured from the
+flux-weighted centroids of its bright apertures: the centroid of each
+aperture is computed for all the cadences of a chunk of its TPF at once,
+its median over the cadences is subtracted, and the offsets of all the
+apertures brighter than `MIN_FLUX` are averaged, weighted by their
+median flux.  The median POS_CORR1 and POS_CORR2 estimates of the
+pipeline are recorded alongside, where the TPFs provide them.
+
+`PointingTracker` is fed one chunk of a TPF at a time, so that the
+centroids can be measured in the same pass over the TPFs as the cosmic
+ray detection (see `k2mosaic.cosmicrays.detect_in_tpf`), or on their own
+by `track_pointing`.
+
+Example usage
+-------------
+tracker = PointingTracker(times.cadenceno, time=times.time)
+track_pointing(tpf_filenames, tracker)
+write_pointing(tracker.table(), 'k2mosaic-c05-ch15-pointing.fits')
+"""
+import warnings
+
+import numpy as np
+
+from . import QUALITY_NO_DATA
+
+MIN_FLUX = 1000.  # Median flux of an aperture, in e-/s, for its centroid to be used
+POINTING_COLUMNS = [('CADENCENO', 'J'), ('TIME', 'D'), ('ROW_OFFSET', 'E'),
+                    ('COL_OFFSET', 'E'), ('NAPERTURES', 'J'),
+                    ('POS_CORR1', 'E'), ('POS_CORR2', 'E')]
+
+
+def flux_centroids(flux):
+    """Returns the flux-weighted centroids of a stack of aperture images.
+
+    Parameters
+    ----------
+    flux : array of shape (n_cadences, height, width)
+        NaN and negative values are ignored.
+
+    Returns
+    -------
+    row, col, total : arrays of shape (n_cadences,)
+        Centroid relative to the corner of the aperture, NaN where the
+        aperture has no flux, and the summed flux.
+    """
+    flux = np.where(np.isfinite(flux) & (flux > 0), flux, 0.).astype(np.float64)
+    total = flux.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row = flux.sum(axis=2).dot(np.arange(flux.shape[1])) / total
+        col = flux.sum(axis=1).dot(np.arange(flux.shape[2])) / total
+    row[total == 0] = np.nan
+    col[total == 0] = np.nan
+    return row, col, total
+
+
+class PointingTracker(object):
+    """Accumulates the pointing offsets of a channel, one TPF at a time.
+
+    Parameters
+    ----------
+    cadenceno : array of int
+        Cadences of the table, sorted.
+
+    time : array of float, optional
+        Their times, copied into the table.
+
+    min_flux : float
+        Apertures with a lower median flux are not used.
+    """
+    def __init__(self, cadenceno, time=None, min_flux=MIN_FLUX):
+        self.cadenceno = np.asarray(cadenceno)
+        self.time = np.full(len(self.cadenceno), np.nan) if time is None else np.asarray(time)
+        self.min_flux = min_flux
+        self.n_tpfs = 0
+        n = len(self.cadenceno)
+        self._row_sum, self._col_sum, self._weight = np.zeros(n), np.zeros(n), np.zeros(n)
+        self._n_apertures = np.zeros(n, dtype=np.int32)
+        self._pos_corr = {column: [] for column in ['POS_CORR1', 'POS_CORR2']}
+        self._chunks = []
+
+    def add_chunk(self, cadenceno, flux, quality=None, pos_corr1=None, pos_corr2=None):
+        """Measures the centroids of consecutive cadences of the current TPF.
+
+        `flux` has shape (n_cadences, height, width), with NaN outside the
+        aperture; cadences flagged as without data in `quality` are ignored.
+        """
+        flux = np.asarray(flux)
+        if quality is not None:
+            flux = np.where(((quality & QUALITY_NO_DATA) > 0)[:, None, None], np.nan, flux)
+        row, col, total = flux_centroids(flux)
+        self._chunks.append((np.asarray(cadenceno), row, col, total, pos_corr1, pos_corr2))
+
+    def finish_tpf(self):
+        """Adds the offsets of the TPF whose chunks were just added."""
+        if len(self._chunks) == 0:
+            return
+        cadenceno, row, col, total, pos_corr1, pos_corr2 = [
+            None if values[0] is None else np.concatenate(values)
+            for values in zip(*self._chunks)]
+        self._chunks = []
+        self.n_tpfs += 1
+        idx = np.searchsorted(self.cadenceno, cadenceno)
+        known = (idx < len(self.cadenceno))
+        known[known] = self.cadenceno[idx[known]] == cadenceno[known]
+        idx = idx[known]
+        for column, values in [('POS_CORR1', pos_corr1), ('POS_CORR2', pos_corr2)]:
+            if values is not None:
+                series = np.full(len(self.cadenceno), np.nan, dtype=np.float32)
+                series[idx] = values[known]
+                self._pos_corr[column].append(series)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # No valid cadences
+            weight = np.nanmedian(total[total > 0]) if (total > 0).any() else 0.
+            if not weight >= self.min_flux:
+                return
+            row_offset = (row - np.nanmedian(row))[known]
+            col_offset = (col - np.nanmedian(col))[known]
+        good = np.isfinite(row_offset) & np.isfinite(col_offset)
+        self._row_sum[idx[good]] += weight * row_offset[good]
+        self._col_sum[idx[good]] += weight * col_offset[good]
+        self._weight[idx[good]] += weight
+        self._n_apertures[idx[good]] += 1
+
+    def table(self):
+        """Returns the pointing table as a dict of the `POINTING_COLUMNS`."""
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN cadences
+            table = {'CADENCENO': self.cadenceno, 'TIME': self.time,
+                     'ROW_OFFSET': self._row_sum / self._weight,
+                     'COL_OFFSET': self._col_sum / self._weight,
+                     'NAPERTURES': self._n_apertures}
+            for column, series in self._pos_corr.items():
+                table[column] = (np.nanmedian(series, axis=0) if len(series) > 0
+                                 else np.full(len(self.cadenceno), np.nan))
+        return table
+
+
+def tpf_columns(tpf, pointing):
+    """Returns the extra table columns read to feed a `PointingTracker`."""
+    if pointing is None:
+        return []
+    return [column for column in ['POS_CORR1', 'POS_CORR2'] if column in tpf[1].get_colnames()]
+
+
+def feed_chunk(pointing, cadenceno, tbl, mask):
+    """Passes a chunk of TPF table rows, restricted to the aperture `mask`,
+    on to a `PointingTracker`."""
+    flux = np.where(mask, tbl['FLUX'], np.nan)
+    names = tbl.dtype.names
+    pointing.add_chunk(cadenceno, flux, quality=tbl['QUALITY'],
+                       pos_corr1=tbl['POS_CORR1'] if 'POS_CORR1' in names else None,
+                       pos_corr2=tbl['POS_CORR2'] if 'POS_CORR2' in names else None)
+
+
+def track_pointing(tpf_filenames, tracker, chunk_size=256, cadence_range=None):
+    """Feeds a set of TPFs to a `PointingTracker`, reading each TPF
+    `chunk_size` cadences at a time, and returns the tracker.  Only the
+    cadences between the two numbers of `cadence_range` (inclusive) are read."""
+    import fitsio
+    from .geometry import pinned_path, geometry_from_fits
+    for tpf_filename in tpf_filenames:
+        with pinned_path(tpf_filename) as path, fitsio.FITS(path) as tpf:
+            geo = geometry_from_fits(tpf_filename, tpf)
+            tpf_cadenceno = tpf[1].read(columns=['CADENCENO'])['CADENCENO']
+            first, last = 0, len(tpf_cadenceno)
+            if cadence_range is not None:
+                first, last = np.searchsorted(tpf_cadenceno,
+                                              [cadence_range[0], cadence_range[1] + 1])
+            columns = ['FLUX', 'QUALITY'] + tpf_columns(tpf, tracker)
+            for start in range(first, last, chunk_size):
+                stop = min(start + chunk_size, last)
+                tbl = tpf[1].read(columns=columns, rows=np.arange(start, stop))
+                feed_chunk(tracker, tpf_cadenceno[start:stop], tbl, geo.mask)
+        tracker.finish_tpf()
+    return tracker
+
+
+def write_pointing(table, output_fn, min_flux=None):
+    """Saves the table returned by `PointingTracker.table` to a FITS file."""
+    from astropy.io import fits
+    from .mosaic import atomic_writeto
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name=name, format=fmt, array=table[name])
+                                         for name, fmt in POINTING_COLUMNS])
+    hdu.header['EXTNAME'] = 'POINTING'
+    if min_flux is not None:
+        hdu.header['MINFLUX'] = (min_flux, 'minimum median flux of the apertures [e-/s]')
+    atomic_writeto(fits.HDUList([fits.PrimaryHDU(), hdu]), output_fn)
+
+
+def read_pointing(filename):
+    """Reads a table written by `write_pointing`."""
+    import fitsio
+    tbl = fitsio.read(filename, ext='POINTING')
+    return {name: tbl[name] for name, _ in POINTING_COLUMNS}
@@ -0,0 +1,168 @@
+"""Exports mosaics as Deep Zoom image pyramids for fast browsing.
+
+A pyramid holds the image at a series of resolutions, each cut into
+fixed-size tiles, so that a viewer (e.g. OpenSeadragon) only loads the
+tiles it displays.  Levels coarser than one screen pixel per Kepler pixel
+are built by averaging blocks of pixels, finer levels by repeating pixels.
+The same stretch is applied to every frame so that they can be compared.
+
+Example usage
+-------------
+cut = KeplerMosaicMovie(mosaic_filenames).cut_levels()
+write_pyramid(image, 'frames/k2mosaic-c05-ch15-cad1000', cut=cut, zoom=16)
+# Writes frames/k2mosaic-c05-ch15-cad1000.dzi and the tiles in
+# frames/k2mosaic-c05-ch15-cad1000_files/<level>/<col>_<row>.png
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+
+import numpy as np
+
+DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                'Format="png" Overlap="0" TileSize="{tile_size}">\n'
+                '  <Size Width="{width}" Height="{height}"/>\n'
+                '</Image>\n')
+
+
+def block_average(total, count):
+    """Sums 2x2 blocks of a (sum, count) image pair, padding odd dimensions.
+
+    Keeping sums and counts rather than means makes the average over
+    several levels exact, even when some pixels are NaN."""
+    pad = [(0, total.shape[0] % 2), (0, total.shape[1] % 2)]
+    total, count = np.pad(total, pad), np.pad(count, pad)
+    shape = (total.shape[0] // 2, 2, total.shape[1] // 2, 2)
+    return total.reshape(shape).sum(axis=(1, 3)), count.reshape(shape).sum(axis=(1, 3))
+
+
+def pyramid_levels(image, zoom=16):
+    """Returns the levels of the Deep Zoom pyramid of an image.
+
+    Parameters
+    ----------
+    image : 2D array
+        NaN values mark pixels without data.
+
+    zoom : int
+        Screen pixels per image pixel at the finest level; a power of two.
+
+    Returns
+    -------
+    levels : list of (array, int)
+        For each level, from the single-pixel level 0 to the finest level,
+        the source image and the number of times its pixels are repeated.
+    """
+    height, width = image.shape
+    max_level = int(math.ceil(math.log2(max(height, width) * zoom)))
+    total = np.where(np.isfinite(image), image, 0.)
+    count = np.isfinite(image).astype(np.int32)
+    levels = []
+    for level in range(max_level, -1, -1):
+        repeat = zoom / 2.**(max_level - level)
+        if repeat < 1:
+            total, count = block_average(total, count)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                source = np.where(count > 0, total / count, np.nan)
+        else:
+            source = image
+        levels.append((source, max(int(repeat), 1)))
+    return levels[::-1]
+
+
+class Colorizer(object):
+    """Maps flux values onto RGBA colours using a fixed stretch and colormap.
+    Pixels without data are transparent."""
+    def __init__(self, cut, cmap='gray', n_colors=256):
+        from astropy import visualization
+        from .movie import _pyplot
+        self.vmin = cut[0]
+        self.transform = (visualization.LogStretch() +
+                          visualization.ManualInterval(vmin=cut[0], vmax=cut[1]))
+        self.lut = (_pyplot().get_cmap(cmap)(np.linspace(0, 1, n_colors)) * 255).astype(np.uint8)
+
+    def index(self, values):
+        """Returns the index into `lut` of each value, and a mask of the finite values."""
+        finite = np.isfinite(values)
+        scaled = self.transform(np.where(finite, values, self.vmin), clip=True)
+        return (scaled * (len(self.lut) - 1)).astype(np.uint8), finite
+
+    def __call__(self, values):
+        idx, finite = self.index(values)
+        rgba = self.lut[idx]
+        rgba[~finite, 3] = 0
+        return rgba
+
+
+def write_pyramid(image, output_base, cut, cmap='gray', zoom=16, tile_size=256,
+                  executor=None, max_pending=64):
+    """Writes the Deep Zoom pyramid of an image.
+
+    The image is flipped vertically, so that row 0 is at the bottom like in
+    the movie frames.  Only tiles which contain data are written.  The `.dzi`
+    file is written last, so that it only exists once all tiles do.
+
+    Parameters
+    ----------
+    image : 2D array
+
+    output_base : str
+        Writes `output_base`.dzi and the tiles in the `output_base`_files directory.
+
+    cut : (float, float)
+        Minimum and maximum cut levels of the stretch.
+
+    executor : `concurrent.futures.Executor`, optional
+        Used to encode and write the tiles in parallel.
+
+    max_pending : int
+        Maximum number of tiles submitted to `executor` but not yet written;
+        each holds a copy of its pixels.
+
+    Returns
+    -------
+    n_tiles : int
+        Number of tiles written.
+    """
+    colorize = Colorizer(cut, cmap=cmap)
+    image = np.flipud(image)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    pending = deque()
+    n_tiles = 0
+    for level, (source, repeat) in enumerate(pyramid_levels(image, zoom)):
+        level_dir = '{}_files/{}'.format(output_base, level)
+        # Colorizing each level once is much cheaper than colorizing its
+        # (up to `zoom`**2 times larger) tiles
+        rgba = colorize(source)
+        height, width = source.shape[0] * repeat, source.shape[1] * repeat
+        for ty in range(int(math.ceil(height / float(tile_size)))):
+            rows = np.arange(ty * tile_size, min((ty + 1) * tile_size, height)) // repeat
+            for tx in range(int(math.ceil(width / float(tile_size)))):
+                cols = np.arange(tx * tile_size, min((tx + 1) * tile_size, width)) // repeat
+                if not rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1, 3].any():
+                    continue  # No data in the tile
+                fn = os.path.join(level_dir, '{}_{}.png'.format(tx, ty))
+                if len(pending) >= max_pending:
+                    pending.popleft().result()  # Raises any exception of the writers
+                pending.append(executor.submit(_write_tile, fn,
+                                               rgba[rows[:, None], cols[None, :]]))
+                n_tiles += 1
+    while pending:
+        pending.popleft().result()
+    if own_executor:
+        executor.shutdown()
+    with open(output_base + '.dzi', 'w') as dzi:
+        dzi.write(DZI_TEMPLATE.format(tile_size=tile_size, width=image.shape[1] * zoom,
+                                      height=image.shape[0] * zoom))
+    return n_tiles
+
+
+def _write_tile(filename, tile):
+    from PIL import Image  # Installed with imageio
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Fast zlib compression; the tiles are small and mostly flat anyway
+    Image.fromarray(tile).save(filename, compress_level=1)
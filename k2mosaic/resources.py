@@ -0,0 +1,302 @@
+"""Chooses the number of worker processes, and how much work each one gets
+at a time, from a memory budget.
+
+Each worker holds a full-channel IMAGE and UNCERTAINTY array plus the TPF
+rows it is reading, on top of the memory of the Python process itself.
+The planner estimates this from the headers of the TPFs and starts as many
+workers as the budget allows.  While mosaicking, every batch of cadences
+reports the peak resident memory of its worker during the batch, and the
+memory the worker keeps when idle.  The number of batches in flight is
+lowered (or raised again) so that the busy workers, plus the idle ones,
+keep within the budget.  On Linux the peak is reset before every batch;
+elsewhere it is the peak over the life of the worker, which never drops.
+
+Example usage
+-------------
+plan = plan_resources(tpf_filenames, n_tasks=len(cadencelist), max_memory='8G')
+print(plan.summary())
+outputs = run_adaptive(task, cadencelist, plan)
+"""
+import os
+import queue
+import sys
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE
+from .planner import _format_bytes
+
+# Copies of the mosaic arrays made while writing (HDUs, compression, checksums)
+IMAGE_COPIES = 3
+# Bytes held per byte of TPF rows read by a stack (float32 flux, float64 variance, masks)
+STACK_COPIES = 4
+# Bytes per TPF table row assumed for files which are not available locally
+DEFAULT_ROW_BYTES = 100 * 1024
+# Number of batches each worker should receive, so that the load stays balanced
+BATCHES_PER_WORKER = 4
+MAX_BATCH_SIZE = 16
+
+
+class ResourceException(Exception):
+    pass
+
+
+class ResourcePlan(object):
+    """The number of workers and the size of their work units.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+
+    batch_size : int
+        Number of tasks (cadences or stacks) sent to a worker at once.
+
+    chunk_size : int or None
+        Number of cadences a stack reads from a TPF at once,
+        `None` to read all the cadences of a stack.
+
+    task_memory : int
+        Estimated peak memory of a worker in bytes.
+
+    max_memory : int
+        Memory budget of the workers in bytes.
+    """
+    def __init__(self, workers, batch_size, chunk_size, task_memory, max_memory):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.task_memory = task_memory
+        self.max_memory = max_memory
+        self.concurrency = workers
+        self.measured_memory = None
+        self.idle_memory = 0
+        self._measurements = {}
+
+    def adapt(self, measured_memory, idle_memory=0, worker=None):
+        """Updates the number of batches in flight from the memory measured
+        in a worker.  Returns `True` if it changed.
+
+        Parameters
+        ----------
+        measured_memory : int
+            Peak memory of the worker during its last batch, in bytes.
+
+        idle_memory : int
+            Memory the worker keeps between batches, in bytes.
+
+        worker : hashable, optional
+            Identifies the worker; the latest measurement of each worker
+            is kept, and the largest of them is used.
+        """
+        self._measurements[worker] = (measured_memory, idle_memory)
+        self.measured_memory = max(peak for peak, _ in self._measurements.values())
+        self.idle_memory = max(idle for _, idle in self._measurements.values())
+        # Each batch in flight needs its peak memory, each idle worker its idle memory
+        busy_memory = self.measured_memory - self.idle_memory
+        if busy_memory > 0:
+            available = self.max_memory - self.workers * self.idle_memory
+            concurrency = int(np.clip(available // busy_memory, 1, self.workers))
+        else:
+            concurrency = self.workers
+        changed = concurrency != self.concurrency
+        self.concurrency = concurrency
+        return changed
+
+    def summary(self):
+        """Returns a human-readable description of the plan."""
+        chunks = '' if self.chunk_size is None else \
+            ', reading {} cadences at a time'.format(self.chunk_size)
+        return ('Resource plan: {} workers using ~{} each (budget {}), '
+                'batches of {} tasks{}.'.format(
+                    self.workers, _format_bytes(self.task_memory),
+                    _format_bytes(self.max_memory), self.batch_size, chunks))
+
+
+def current_rss():
+    """Resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):  # Not Linux
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, since it started or
+    since `reset_peak_rss` was last called."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):  # Not Linux
+        pass
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak_rss():
+    """Resets the peak memory reported by `peak_rss` to the current memory,
+    where the kernel allows it (Linux >= 4.0)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def tpf_table_sizes(tpf_filenames):
+    """Returns the (row bytes, number of rows) of the pixel table of each TPF,
+    read from the headers; remote files are assumed to have `DEFAULT_ROW_BYTES`."""
+    import fitsio
+    sizes = []
+    for fn in tpf_filenames:
+        if fn.startswith('http'):
+            sizes.append((DEFAULT_ROW_BYTES, 1))
+            continue
+        hdr = fitsio.read_header(fn, ext=1)
+        sizes.append((int(hdr['NAXIS1']), int(hdr['NAXIS2'])))
+    return sizes
+
+
+def estimate_task_memory(tpf_filenames, base_memory=None, cadences_read=1,
+                         shape=KEPLER_CHANNEL_SHAPE):
+    """Estimates the peak memory of a worker mosaicking `tpf_filenames`.
+
+    Parameters
+    ----------
+    base_memory : int, optional
+        Memory of the worker before it starts, defaults to that of this process.
+
+    cadences_read : int
+        Number of TPF rows read at once, i.e. 1 for a single-cadence mosaic,
+        or the chunk size of a stack.
+
+    Returns
+    -------
+    memory : int
+        Bytes.
+    """
+    if base_memory is None:
+        base_memory = current_rss()
+    images = 2 * 4 * int(np.prod(shape)) * IMAGE_COPIES
+    tpf = 0
+    for fn, (row_bytes, n_rows) in zip(tpf_filenames, tpf_table_sizes(tpf_filenames)):
+        if fn.endswith('.gz'):
+            # cfitsio decompresses the whole file into memory
+            tpf = max(tpf, row_bytes * n_rows)
+        else:
+            copies = 1 if cadences_read == 1 else STACK_COPIES
+            tpf = max(tpf, row_bytes * min(cadences_read, n_rows) * copies)
+    return base_memory + images + tpf
+
+
+def plan_resources(tpf_filenames, n_tasks, max_memory, max_workers=None, bin_size=None):
+    """Chooses the number of workers and the size of their work units.
+
+    Parameters
+    ----------
+    tpf_filenames : list of str
+
+    n_tasks : int
+        Number of mosaics to make.
+
+    max_memory : int or str
+        Memory budget of all the workers, e.g. 8589934592 or '8G'.
+
+    max_workers : int, optional
+        Upper limit on the number of workers, defaults to the number of CPUs.
+
+    bin_size : int, optional
+        Number of cadences stacked into each mosaic.  If a full stack does
+        not fit in the budget, the stack is read in smaller chunks.
+
+    Returns
+    -------
+    plan : `ResourcePlan`
+    """
+    from .store import parse_size
+    max_memory = parse_size(max_memory)
+    max_workers = min(max_workers or os.cpu_count() or 1, max(n_tasks, 1))
+    base_memory = current_rss()
+    chunk_size = None
+    if bin_size is None:
+        task_memory = estimate_task_memory(tpf_filenames, base_memory)
+    else:
+        # Read the largest chunks which still let all the workers run
+        chunk_size = bin_size
+        while True:
+            task_memory = estimate_task_memory(tpf_filenames, base_memory,
+                                               cadences_read=chunk_size)
+            if chunk_size == 1 or task_memory * max_workers <= max_memory:
+                break
+            chunk_size = max(chunk_size // 2, 1)
+    if task_memory > max_memory:
+        raise ResourceException('A single worker needs ~{}, which exceeds the memory '
+                                'budget of {}.'.format(_format_bytes(task_memory),
+                                                       _format_bytes(max_memory)))
+    workers = int(min(max_workers, max_memory // task_memory))
+    batch_size = int(np.clip(n_tasks // (workers * BATCHES_PER_WORKER), 1, MAX_BATCH_SIZE))
+    return ResourcePlan(workers, batch_size, chunk_size, task_memory, max_memory)
+
+
+def run_adaptive(task, jobs, plan, label='Mosaicking', callback=None):
+    """Runs `task` on every job in a pool of `plan.workers` processes.
+
+    Jobs are sent to the workers in batches of `plan.batch_size`, and no
+    more than `plan.concurrency` batches are in flight at once; this limit
+    follows the peak memory which the workers report after every batch.
+    If given, `callback` is called with each result as soon as it arrives.
+
+    Returns
+    -------
+    results : list
+        The return values of `task`, in the order of `jobs`.
+    """
+    import click
+    from multiprocessing import Pool
+    results = [None] * len(jobs)
+    batches = [(start, jobs[start:start + plan.batch_size])
+               for start in range(0, len(jobs), plan.batch_size)]
+    done = queue.Queue()
+    pool = Pool(processes=plan.workers)
+    try:
+        with click.progressbar(length=len(jobs), label=label, show_pos=True) as bar:
+            next_batch, in_flight = 0, 0
+            while next_batch < len(batches) or in_flight > 0:
+                while in_flight < plan.concurrency and next_batch < len(batches):
+                    start, batch = batches[next_batch]
+                    pool.apply_async(_run_batch, (task, batch),
+                                     callback=lambda out, start=start: done.put((start, out)),
+                                     error_callback=lambda e, start=start: done.put((start, e)))
+                    next_batch += 1
+                    in_flight += 1
+                start, out = done.get()
+                in_flight -= 1
+                if isinstance(out, BaseException):
+                    raise out
+                outputs, (worker, memory, idle_memory) = out
+                results[start:start + len(outputs)] = outputs
+                if callback is not None:
+                    [callback(output) for output in outputs]
+                bar.update(len(outputs))
+                if plan.adapt(memory, idle_memory, worker):
+                    click.echo('\nWorkers use up to {}: running {} batches at once.'.format(
+                               _format_bytes(memory), plan.concurrency), err=True)
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def _run_batch(task, jobs):
+    """Runs a batch of jobs in a worker; returns the results, and the
+    worker's process id, peak memory during the batch and memory after it."""
+    reset_peak_rss()
+    results = [task(job) for job in jobs]
+    return results, (os.getpid(), peak_rss(), current_rss())
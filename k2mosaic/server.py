@@ -0,0 +1,376 @@
+"""Local HTTP service which mosaics and cuts out the pixels of a set of TPFs.
+
+Running the command line tool for every look at the data pays for
+importing astropy and decoding the TPFs each time.  `k2mosaic serve`
+instead opens the TPFs of a channel once, as a
+`k2mosaic.cube.KeplerChannelCube`, and answers requests from a pool of
+threads.  Decoded blocks of TPF table rows stay in the byte-limited LRU
+cache of the cube between requests, so that neighbouring cadences or boxes
+are served from memory.
+
+The service answers the following GET requests:
+
+* ``/image/<cadenceno>.fits``: the channel image of a cadence;
+* ``/cutout.fits?row=&col=&height=&width=[&start=&stop=]``: a cube of the
+  box with corner (row, col), from cadence `start` up to, but not
+  including, `stop` (default: all cadences), with a CADENCES table;
+* ``/frame/<cadenceno>.png[?row=&col=&height=&width=&cut=min..max&cmap=]``:
+  the image of a cadence, or of a box, rendered with a log stretch;
+* ``/stats``: request counts, latencies, and cache statistics as JSON;
+* ``/metrics``: the same statistics in the Prometheus text format.
+
+Boxes larger than the channel, and requests reading more than
+`MAX_REQUEST_PIXELS` pixels, are refused with status 400.
+
+Example usage
+-------------
+service = MosaicService(tpf_filenames, cache_size='1G')
+server = MosaicServer(('127.0.0.1', 8000), service, workers=4)
+server.serve_forever()
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from .metrics import PROMETHEUS_PREFIX
+
+DEFAULT_PORT = 8000
+LATENCY_SAMPLE = 1000  # Number of recent requests kept per endpoint for the percentiles
+# Largest number of pixels (cadences x height x width) a request may read, i.e. 256 MB
+MAX_REQUEST_PIXELS = 64 * 1024**2
+
+
+class ServiceException(Exception):
+    """A request which cannot be answered; `status` is the HTTP status code."""
+    def __init__(self, message, status=400):
+        super(ServiceException, self).__init__(message)
+        self.status = status
+
+
+class RequestStats(object):
+    """Thread-safe counts and latencies of the requests to each endpoint."""
+    def __init__(self, sample=LATENCY_SAMPLE):
+        self.sample = sample
+        self.counts = {}
+        self.errors = {}
+        self.seconds = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, failed=False):
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + int(failed)
+            self.seconds[endpoint] = self.seconds.get(endpoint, 0.) + seconds
+            self._latencies.setdefault(endpoint, deque(maxlen=self.sample)).append(seconds)
+
+    def stats(self):
+        """Returns a dict with the requests, errors, and mean, median, 95th
+        percentile, and maximum latency (in ms, over the recent requests)
+        of each endpoint."""
+        with self._lock:
+            stats = {}
+            for endpoint, latencies in self._latencies.items():
+                ms = np.array(latencies) * 1000.
+                stats[endpoint] = {'requests': self.counts[endpoint],
+                                   'errors': self.errors[endpoint],
+                                   'mean_ms': self.seconds[endpoint] * 1000. / self.counts[endpoint],
+                                   'p50_ms': float(np.percentile(ms, 50)),
+                                   'p95_ms': float(np.percentile(ms, 95)),
+                                   'max_ms': float(ms.max())}
+            return stats
+
+
+class MosaicService(object):
+    """Answers image, cutout, and frame requests for a set of TPFs.
+
+    Parameters
+    ----------
+    tpf_filenames : list of str
+        Paths or urls of the TPFs of a single channel.
+
+    cache_size : int or str
+        Size of the cache of decoded TPF data, e.g. '1G'.
+
+    add_background : bool
+        Add the background back to the flux.
+
+    max_pixels : int
+        Largest number of pixels (cadences x height x width) a single
+        request may read; larger requests are refused.
+    """
+    def __init__(self, tpf_filenames, cache_size='512M', add_background=False,
+                 max_pixels=MAX_REQUEST_PIXELS):
+        import fitsio
+        from .cube import KeplerChannelCube
+        from .geometry import pinned_path
+        from .store import parse_size
+        from .timing import CadenceTimes
+        self.cube = KeplerChannelCube(tpf_filenames, add_background=add_background,
+                                      cache=parse_size(cache_size))
+        with pinned_path(self.cube.geometry[0].filename) as path:
+            hdr = fitsio.read_header(path, ext=0)
+        self.campaign, self.channel = hdr.get('CAMPAIGN'), hdr.get('CHANNEL')
+        self.times = CadenceTimes.from_tpf(self.cube.geometry[0].filename)
+        self.requests = RequestStats()
+        self.max_pixels = max_pixels
+
+    def _index(self, cadenceno):
+        """Returns the position of a cadence along the cube."""
+        idx = int(cadenceno) - int(self.cube.cadenceno[0])
+        if not 0 <= idx < len(self.cube):
+            raise ServiceException('Cadence {} is not in the TPFs ({}..{}).'.format(
+                                   cadenceno, self.cube.cadenceno[0], self.cube.cadenceno[-1]),
+                                   status=404)
+        return idx
+
+    def _header(self, **keywords):
+        header = {'CREATOR': 'k2mosaic', 'CAMPAIGN': self.campaign, 'CHANNEL': self.channel}
+        header.update(keywords)
+        return header
+
+    def _read(self, first, last, box):
+        """Returns the pixels of cube planes `first` to `last` in a (row,
+        col, height, width) box, which may extend beyond the channel, but
+        not be larger than it."""
+        row, col, height, width = box
+        if height > self.cube.channel_shape[0] or width > self.cube.channel_shape[1]:
+            raise ServiceException('The box ({}x{}) is larger than the channel ({}x{}).'.format(
+                                   height, width, *self.cube.channel_shape))
+        if (last - first) * height * width > self.max_pixels:
+            raise ServiceException('{} cadences of a {}x{} box exceed the limit of {} pixels '
+                                   'per request; ask for fewer cadences.'.format(
+                                       last - first, height, width, self.max_pixels))
+        pixels = np.full((last - first, height, width), np.nan, dtype=np.float32)
+        # Only the part of the box which falls on the channel is read
+        row_lo, col_lo = max(row, 0), max(col, 0)
+        row_hi = min(row + height, self.cube.channel_shape[0])
+        col_hi = min(col + width, self.cube.channel_shape[1])
+        if row_lo < row_hi and col_lo < col_hi:
+            pixels[:, row_lo - row:row_hi - row, col_lo - col:col_hi - col] = \
+                self.cube[first:last, row_lo:row_hi, col_lo:col_hi]
+        return pixels
+
+    def image(self, cadenceno, box=None):
+        """Returns the channel image of a cadence, or the (row, col,
+        height, width) box of it."""
+        idx = self._index(cadenceno)
+        if box is None:
+            return self.cube[idx]
+        return self._read(idx, idx + 1, box)[0]
+
+    def cutout(self, box, start=None, stop=None):
+        """Returns the cadence numbers and the (cadence, row, col) pixels
+        of a box from cadence `start` up to, but not including, `stop`."""
+        first = 0 if start is None else self._index(start)
+        last = len(self.cube) if stop is None else self._index(int(stop) - 1) + 1
+        if last <= first:
+            raise ServiceException('No cadences between {} and {}.'.format(start, stop))
+        return self.cube.cadenceno[first:last], self._read(first, last, box)
+
+    def image_fits(self, cadenceno):
+        """Returns the channel image of a cadence as a FITS file."""
+        from astropy.io import fits
+        header = fits.Header(self._header(CADENCEN=int(cadenceno)))
+        header['EXTNAME'] = 'FLUX'
+        return _fits_bytes([fits.PrimaryHDU(self.image(cadenceno), header=header)])
+
+    def cutout_fits(self, box, start=None, stop=None):
+        """Returns a cutout cube as a FITS file with FLUX and CADENCES extensions."""
+        from astropy.io import fits
+        cadencenos, cube = self.cutout(box, start=start, stop=stop)
+        time = np.array([self.times.time[self.times.index(cad)] if cad in self.times else np.nan
+                         for cad in cadencenos])
+        primary = fits.PrimaryHDU(header=fits.Header(self._header()))
+        flux = fits.ImageHDU(cube, name='FLUX',
+                             header=fits.Header({'CUTROW': box[0], 'CUTCOL': box[1]}))
+        cadences = fits.BinTableHDU.from_columns(
+            [fits.Column(name='CADENCENO', format='J', array=cadencenos),
+             fits.Column(name='TIME', format='D', array=time)], name='CADENCES')
+        return _fits_bytes([primary, flux, cadences])
+
+    def frame_png(self, cadenceno, box=None, cut=None, cmap='gray'):
+        """Returns the image of a cadence, or of a box, as a PNG with row 0
+        at the bottom.  The cut levels default to the 10th and 99.5th
+        percentiles of the image."""
+        from PIL import Image  # Installed with imageio
+        from .pyramid import Colorizer
+        image = self.image(cadenceno, box=box)
+        if cut is None:
+            values = image[np.isfinite(image)]
+            cut = tuple(np.percentile(values, [10., 99.5])) if len(values) > 0 else (0., 1.)
+        try:
+            rgba = Colorizer(cut, cmap=cmap)(image[::-1])
+        except ValueError as e:  # Unknown colormap
+            raise ServiceException(str(e))
+        out = io.BytesIO()
+        Image.fromarray(rgba).save(out, format='png', compress_level=1)
+        return out.getvalue()
+
+    def stats(self):
+        """Returns the request and cache statistics."""
+        return {'campaign': self.campaign, 'channel': self.channel,
+                'tpfs': len(self.cube.tpf_filenames),
+                'cadences': [int(self.cube.cadenceno[0]), int(self.cube.cadenceno[-1])],
+                'requests': self.requests.stats(), 'cache': self.cube.cache.stats()}
+
+    def prometheus(self):
+        """Returns the request and cache statistics in the Prometheus text format."""
+        stats = self.stats()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {}{} {}'.format(PROMETHEUS_PREFIX, name, help))
+            lines.append('# TYPE {}{} {}'.format(PROMETHEUS_PREFIX, name, kind))
+            for labels, value in samples:
+                label_str = ','.join('{}="{}"'.format(key, value)
+                                     for key, value in sorted(labels.items()))
+                lines.append('{}{}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                '{' + label_str + '}' if label_str else '',
+                                                float(value)))
+
+        requests = sorted(stats['requests'].items())
+        metric('serve_requests_total', 'counter', 'Number of requests, by endpoint.',
+               [({'endpoint': name}, s['requests']) for name, s in requests])
+        metric('serve_errors_total', 'counter', 'Number of failed requests, by endpoint.',
+               [({'endpoint': name}, s['errors']) for name, s in requests])
+        metric('serve_latency_seconds', 'gauge',
+               'Median and 95th percentile latency of recent requests, by endpoint.',
+               [({'endpoint': name, 'quantile': q}, s[key] / 1000.) for name, s in requests
+                for q, key in [('0.5', 'p50_ms'), ('0.95', 'p95_ms')]])
+        cache = stats['cache']
+        metric('cache_hits_total', 'counter', 'Cache lookups of decoded TPF blocks which hit.',
+               [({}, cache['hits'])])
+        metric('cache_misses_total', 'counter', 'Cache lookups of decoded TPF blocks which missed.',
+               [({}, cache['misses'])])
+        metric('cache_hit_ratio', 'gauge', 'Fraction of cache lookups which hit.',
+               [({}, cache['hit_rate'])])
+        metric('cache_bytes', 'gauge', 'Bytes of decoded TPF data in the cache.',
+               [({}, cache['bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def handle(self, path):
+        """Answers a GET request, returning (content type, body) and
+        recording its latency."""
+        url = urlparse(path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        endpoint = parts[0].split('.')[0] if parts else ''
+        start, failed = time.time(), True
+        try:
+            if endpoint == 'image' and len(parts) == 2 and parts[1].endswith('.fits'):
+                response = ('application/fits', self.image_fits(_int(parts[1][:-5], 'cadenceno')))
+            elif endpoint == 'cutout' and len(parts) == 1:
+                response = ('application/fits',
+                            self.cutout_fits(_box(query), start=_optional_int(query, 'start'),
+                                             stop=_optional_int(query, 'stop')))
+            elif endpoint == 'frame' and len(parts) == 2 and parts[1].endswith('.png'):
+                box = _box(query) if 'row' in query else None
+                cut = None
+                if 'cut' in query:
+                    try:
+                        cut = [float(c) for c in query['cut'].split('..')]
+                    except ValueError:
+                        raise ServiceException('cut must be min..max, not {}'.format(query['cut']))
+                response = ('image/png',
+                            self.frame_png(_int(parts[1][:-4], 'cadenceno'), box=box, cut=cut,
+                                           cmap=query.get('cmap', 'gray')))
+            elif endpoint == 'stats' and len(parts) == 1:
+                response = ('application/json', json.dumps(self.stats(), indent=1).encode())
+            elif endpoint == 'metrics' and len(parts) == 1:
+                response = ('text/plain; version=0.0.4', self.prometheus().encode())
+            else:
+                endpoint = 'unknown'
+                raise ServiceException('Unknown request: {}'.format(url.path), status=404)
+            failed = False
+            return response
+        finally:
+            self.requests.record(endpoint, time.time() - start, failed=failed)
+
+
+def _int(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise ServiceException('{} must be an integer, not {}'.format(name, value))
+
+
+def _optional_int(query, name):
+    return _int(query[name], name) if name in query else None
+
+
+def _box(query):
+    """Returns the (row, col, height, width) box of a request."""
+    missing = [key for key in ['row', 'col', 'height', 'width'] if key not in query]
+    if missing:
+        raise ServiceException('Missing parameters: {}'.format(', '.join(missing)))
+    box = tuple(_int(query[key], key) for key in ['row', 'col', 'height', 'width'])
+    if box[2] < 1 or box[3] < 1:
+        raise ServiceException('height and width must be positive')
+    return box
+
+
+def _fits_bytes(hdus):
+    from astropy.io import fits
+    out = io.BytesIO()
+    fits.HDUList(hdus).writeto(out)
+    return out.getvalue()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Passes GET requests on to the `MosaicService` of the server."""
+    def do_GET(self):
+        try:
+            content_type, body = self.server.service.handle(self.path)
+        except ServiceException as e:
+            self.send_error(e.status, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, '{}: {}'.format(type(e).__name__, e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(_RequestHandler, self).log_message(format, *args)
+
+
+class MosaicServer(HTTPServer):
+    """HTTP server which handles the requests to a `MosaicService` in a
+    pool of `workers` threads."""
+    def __init__(self, address, service, workers=4, verbose=False):
+        HTTPServer.__init__(self, address, _RequestHandler)
+        self.service = service
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
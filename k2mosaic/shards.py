@@ -0,0 +1,251 @@
+"""Splits mosaicking work into shards which can run on many machines.
+
+A *shard manifest* is a JSON file which lists independent units of work.
+Each shard covers a range of cadences of one channel (a *job*) and a
+group of its TPFs.  Shards can be executed in any order, on any machine
+which shares a filesystem with the others, and re-running a completed
+shard is a no-op.  When the TPFs of a job are split into several groups,
+each shard writes partial mosaics to a work directory, and the partials
+of all groups are combined by `merge_shards`.
+
+Example usage
+-------------
+manifest = ShardManifest.create(jobs, workdir='c05-work', cadences_per_shard=100)
+manifest.writeto('c05-manifest.json')
+# On any node:
+manifest = ShardManifest.read('c05-manifest.json')
+manifest.shards[3]  # {'id': 3, 'job': 0, 'group': 1, 'tpfs': [...], 'cadences': [...]}
+# Once every shard is done:
+merge_shards(manifest)
+"""
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+class ShardException(Exception):
+    pass
+
+
+class ShardManifest(object):
+    """Description of the shards of one or more mosaicking jobs.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        One entry per channel, with keys mission, campaign, channel,
+        tpf_filenames, output_prefix, reference_fn, coverage_fn,
+        cosmic_ray_fn, ownership_fn, and pointing_fn.
+
+    shards : list of dict
+        One entry per unit of work, with keys id, job (index into `jobs`),
+        group (index of the TPF group), tpfs (indices into the
+        tpf_filenames of the job), and cadences.
+
+    workdir : str
+        Directory holding the completion markers and partial mosaics.
+
+    options : dict
+        Keyword arguments passed on to `k2mosaic.ui.k2mosaic_mosaic`
+        for every shard, e.g. add_background or bin_size.
+    """
+    def __init__(self, jobs, shards, workdir, options=None):
+        self.jobs = jobs
+        self.shards = shards
+        self.workdir = workdir
+        self.options = options or {}
+
+    @classmethod
+    def create(cls, jobs, workdir, options=None, cadences_per_shard=100, tpf_groups=1):
+        """Splits jobs into shards of `cadences_per_shard` cadences and
+        `tpf_groups` groups of TPFs.
+
+        Each job must have a `cadences` key listing the cadences to mosaic.
+        If the options contain a `bin_size`, shards are rounded up to hold
+        whole bins, so that no bin is split across shards.
+        """
+        bin_size = (options or {}).get('bin_size') or 1
+        per_shard = bin_size * -(-cadences_per_shard // bin_size)
+        jobs = [dict(job) for job in jobs]
+        shards = []
+        for job_id, job in enumerate(jobs):
+            n_tpfs = len(job['tpf_filenames'])
+            n_groups = max(1, min(tpf_groups, n_tpfs))
+            # Contiguous groups preserve the order in which TPFs overwrite each other
+            bounds = [n_tpfs * g // n_groups for g in range(n_groups + 1)]
+            job['groups'] = n_groups
+            cadences = job.pop('cadences')
+            for start in range(0, len(cadences), per_shard):
+                for group in range(n_groups):
+                    shards.append({'id': len(shards), 'job': job_id, 'group': group,
+                                   'tpfs': list(range(bounds[group], bounds[group + 1])),
+                                   'cadences': [int(cad) for cad in
+                                                cadences[start:start + per_shard]]})
+        return cls(jobs, shards, os.path.abspath(workdir), options)
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as manifest:
+            content = json.load(manifest)
+        if content.get('version') != MANIFEST_VERSION:
+            raise ShardException('{} is not a version {} shard manifest.'.format(
+                                 filename, MANIFEST_VERSION))
+        return cls(content['jobs'], content['shards'], content['workdir'], content['options'])
+
+    def writeto(self, filename):
+        content = {'version': MANIFEST_VERSION, 'workdir': self.workdir,
+                   'options': self.options, 'jobs': self.jobs, 'shards': self.shards}
+        _write_json_atomic(content, filename)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def tpf_filenames(self, shard_id):
+        """Returns the TPFs read by a shard."""
+        shard = self.shards[shard_id]
+        job = self.jobs[shard['job']]
+        return [job['tpf_filenames'][idx] for idx in shard['tpfs']]
+
+    def output_prefix(self, shard_id):
+        """Returns the output prefix of a shard.
+
+        Jobs with a single TPF group write their final mosaics directly;
+        otherwise each group writes partial mosaics to its own directory."""
+        shard = self.shards[shard_id]
+        job = self.jobs[shard['job']]
+        if job['groups'] == 1:
+            return job['output_prefix']
+        return os.path.join(self.workdir, 'job{}-group{}'.format(shard['job'], shard['group']),
+                            os.path.basename(job['output_prefix']))
+
+    def marker_fn(self, shard_id):
+        return os.path.join(self.workdir, 'shard-{:05d}.done'.format(shard_id))
+
+    def outputs(self, shard_id):
+        """Returns the files written by a completed shard, or `None`."""
+        try:
+            with open(self.marker_fn(shard_id)) as marker:
+                return json.load(marker)['outputs']
+        except (IOError, ValueError):
+            return None
+
+    def merged(self, shard_id):
+        """Returns the final mosaics into which `merge_shards` combined the
+        partial mosaics of a shard, or `None` if they have not been merged."""
+        try:
+            with open(self.marker_fn(shard_id)) as marker:
+                return json.load(marker).get('merged')
+        except (IOError, ValueError):
+            return None
+
+    def is_done(self, shard_id):
+        """Has the shard completed, with all its output files (or the
+        merged mosaics which replaced them) still in place?"""
+        for outputs in [self.outputs(shard_id), self.merged(shard_id)]:
+            if outputs is not None and all(os.path.exists(fn) for fn in outputs):
+                return True
+        return False
+
+    def mark_done(self, shard_id, outputs):
+        _write_json_atomic({'shard': shard_id, 'outputs': outputs}, self.marker_fn(shard_id))
+
+    def mark_merged(self, shard_id, merged):
+        """Records the final mosaics made from the partial mosaics of a shard,
+        so that the shard stays done once the partials are removed."""
+        _write_json_atomic({'shard': shard_id, 'outputs': self.outputs(shard_id),
+                            'merged': merged}, self.marker_fn(shard_id))
+
+    def pending(self):
+        """Returns the ids of the shards which have not completed."""
+        return [shard['id'] for shard in self.shards if not self.is_done(shard['id'])]
+
+
+def merge_shards(manifest, clean=False):
+    """Verifies that all shards are complete and combines partial mosaics.
+
+    The shards whose partial mosaics have been merged before are not merged
+    again, so that `merge_shards` can be re-run, even after `clean`.
+
+    Parameters
+    ----------
+    manifest : `ShardManifest`
+
+    clean : bool
+        Remove the partial mosaics once they have been merged.
+
+    Returns
+    -------
+    outputs : list of str
+        Final mosaic filenames.
+    """
+    pending = manifest.pending()
+    if len(pending) > 0:
+        raise ShardException('{} of {} shards have not completed: {}'.format(
+                             len(pending), len(manifest), ', '.join(map(str, pending))))
+    outputs = []
+    for job_id, job in enumerate(manifest.jobs):
+        shards = [shard for shard in manifest.shards if shard['job'] == job_id]
+        if job['groups'] == 1:
+            outputs.extend(fn for shard in shards for fn in manifest.outputs(shard['id']))
+            continue
+        merged = [manifest.merged(shard['id']) for shard in shards]
+        if None not in merged:
+            outputs.extend(sorted(set(fn for fns in merged for fn in fns)))
+            continue
+        # Gather the partials of each mosaic, in group order
+        partials = {}
+        for shard in sorted(shards, key=lambda shard: shard['group']):
+            for fn in manifest.outputs(shard['id']):
+                partials.setdefault(os.path.basename(fn), []).append(fn)
+        output_dir = os.path.dirname(job['output_prefix'])
+        for basename in sorted(partials):
+            if len(partials[basename]) != job['groups']:
+                raise ShardException('{} has {} partial mosaics, {} expected.'.format(
+                                     basename, len(partials[basename]), job['groups']))
+            output_fn = os.path.join(output_dir, basename)
+            merge_partials(partials[basename], output_fn)
+            outputs.append(output_fn)
+        for shard in shards:
+            manifest.mark_merged(shard['id'], [os.path.join(output_dir, os.path.basename(fn))
+                                               for fn in manifest.outputs(shard['id'])])
+    if clean:
+        for shard in manifest.shards:
+            if manifest.jobs[shard['job']]['groups'] > 1:
+                for fn in manifest.outputs(shard['id']):
+                    if os.path.exists(fn):
+                        os.remove(fn)
+    return outputs
+
+
+def merge_partials(partial_fns, output_fn):
+    """Combines mosaics made from disjoint groups of TPFs into one mosaic.
+
+    The headers are taken from the first partial.  Pixels covered by
+    several partials take the value of the last one, as if all the
+    TPFs had been added to a single mosaic in order.  Both dense and
+    sparse mosaics are supported.
+    """
+    import numpy as np
+    from astropy.io import fits
+    from .mosaic import atomic_writeto
+    with fits.open(partial_fns[0]) as merged:
+        for extname in ['IMAGE', 'UNCERTAINTY']:
+            merged[extname].data  # Load the data before the file is closed
+        for fn in partial_fns[1:]:
+            with fits.open(fn) as partial:
+                for extname in ['IMAGE', 'UNCERTAINTY']:
+                    if isinstance(merged[extname], fits.BinTableHDU):  # Sparse mosaic
+                        target, values = merged[extname].data['VALUE'], partial[extname].data['VALUE']
+                    else:
+                        target, values = merged[extname].data, partial[extname].data
+                    covered = np.isfinite(values)
+                    target[covered] = values[covered]
+        atomic_writeto(merged, output_fn)
+
+
+def _write_json_atomic(content, filename):
+    tmp_fn = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_fn, 'w') as out:
+        json.dump(content, out, indent=1)
+    os.replace(tmp_fn, filename)
@@ -0,0 +1,205 @@
+"""Finds the campaigns, channels, and TPFs which cover a position on the sky.
+
+The WCS of every channel of every campaign is evaluated at once using the
+TAN-SIP keywords stored in `k2-ffi-headers.csv`, so a lookup across all
+campaigns takes well under a millisecond.
+
+Example usage
+-------------
+index = SkyIndex()
+index.locate(ra=132.8, dec=11.8)  # M67
+"""
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE
+
+# (p, q) exponents of the SIP distortion terms stored in the FFI header table
+SIP_TERMS = [(2, 0), (0, 2), (1, 1)]
+INVERSE_SIP_TERMS = [(1, 0), (0, 1), (2, 0), (0, 2), (1, 1)]
+
+
+class SIPWCS(object):
+    """Vectorized TAN-SIP world coordinate system of many channels.
+
+    Every attribute is an array with one entry per channel, so that a
+    position can be transformed into the frame of all channels at once.
+    Pixel coordinates follow the array convention of the mosaics,
+    i.e. (row, col) are zero-based, whereas CRPIX is one-based.
+
+    Parameters
+    ----------
+    table : `pandas.DataFrame`
+        Rows of the FFI header table (see `k2mosaic.mosaic.export_ffi_headers`).
+    """
+    def __init__(self, table):
+        self.crval = np.radians(table[['CRVAL1', 'CRVAL2']].values.T)
+        self.crpix = table[['CRPIX1', 'CRPIX2']].values.T
+        self.cd = table[['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']].values.T.reshape(2, 2, -1)
+        det = self.cd[0, 0] * self.cd[1, 1] - self.cd[0, 1] * self.cd[1, 0]
+        self.cd_inv = np.array([[self.cd[1, 1], -self.cd[0, 1]],
+                                [-self.cd[1, 0], self.cd[0, 0]]]) / det
+        self.a = {pq: table['A_{}_{}'.format(*pq)].values for pq in SIP_TERMS}
+        self.b = {pq: table['B_{}_{}'.format(*pq)].values for pq in SIP_TERMS}
+        self.ap = {pq: table['AP_{}_{}'.format(*pq)].values for pq in INVERSE_SIP_TERMS}
+        self.bp = {pq: table['BP_{}_{}'.format(*pq)].values for pq in INVERSE_SIP_TERMS}
+        self.pixel_scale = np.sqrt(np.abs(det)) * 3600.  # arcsec per pixel
+
+    def __len__(self):
+        return self.crpix.shape[1]
+
+    def subset(self, idx):
+        """Returns a copy restricted to the channels `idx`."""
+        subset = SIPWCS.__new__(SIPWCS)
+        subset.crval, subset.crpix = self.crval[:, idx], self.crpix[:, idx]
+        subset.cd, subset.cd_inv = self.cd[:, :, idx], self.cd_inv[:, :, idx]
+        for name in ['a', 'b', 'ap', 'bp']:
+            setattr(subset, name, {pq: coeff[idx] for pq, coeff in getattr(self, name).items()})
+        subset.pixel_scale = self.pixel_scale[idx]
+        return subset
+
+    def pix2world(self, row, col):
+        """Returns the (ra, dec) in degrees of pixel positions in each channel."""
+        u = np.asarray(col, dtype=float) + 1 - self.crpix[0]
+        v = np.asarray(row, dtype=float) + 1 - self.crpix[1]
+        du, dv = _polynomial(self.a, u, v), _polynomial(self.b, u, v)
+        xi = np.radians(self.cd[0, 0] * (u + du) + self.cd[0, 1] * (v + dv))
+        eta = np.radians(self.cd[1, 0] * (u + du) + self.cd[1, 1] * (v + dv))
+        # Inverse gnomonic projection
+        ra0, dec0 = self.crval
+        denom = np.cos(dec0) - eta * np.sin(dec0)
+        ra = ra0 + np.arctan2(xi, denom)
+        dec = np.arctan2((np.sin(dec0) + eta * np.cos(dec0)) * np.cos(ra - ra0), denom)
+        return np.degrees(ra) % 360., np.degrees(dec)
+
+    def world2pix(self, ra, dec):
+        """Returns the zero-based (row, col) of a sky position in each channel.
+
+        Positions more than 90 degrees from the reference point of a channel
+        are returned as NaN."""
+        ra, dec = np.radians(ra), np.radians(dec)
+        ra0, dec0 = self.crval
+        # Gnomonic projection
+        cos_c = (np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xi = np.degrees(np.cos(dec) * np.sin(ra - ra0) / cos_c)
+            eta = np.degrees((np.cos(dec0) * np.sin(dec)
+                              - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c)
+        xi[cos_c <= 0] = np.nan
+        u = self.cd_inv[0, 0] * xi + self.cd_inv[0, 1] * eta
+        v = self.cd_inv[1, 0] * xi + self.cd_inv[1, 1] * eta
+        du, dv = _polynomial(self.ap, u, v), _polynomial(self.bp, u, v)
+        return v + dv + self.crpix[1] - 1, u + du + self.crpix[0] - 1
+
+
+def _polynomial(coefficients, u, v):
+    """Evaluates a SIP polynomial given a {(p, q): coefficient} dictionary."""
+    return sum(coeff * u**p * v**q for (p, q), coeff in coefficients.items())
+
+
+class SkyIndex(object):
+    """Footprints of the CCD channels of all campaigns in the FFI header table.
+
+    Parameters
+    ----------
+    ffi_headers_file : str
+        Table of FFI WCS keywords, defaults to the table bundled with k2mosaic.
+
+    shape : tuple
+        (rows, cols) of a channel.
+    """
+    def __init__(self, ffi_headers_file=None, shape=KEPLER_CHANNEL_SHAPE):
+        import pandas as pd
+        from .mosaic import FFI_HEADERS_FILE
+        table = pd.read_csv(ffi_headers_file or FFI_HEADERS_FILE)
+        # Some campaigns have several FFIs; use the first one, like `get_ffi_header`
+        table = table.drop_duplicates(['campaign', 'extension']).reset_index(drop=True)
+        self.campaign = table['campaign'].values
+        self.channel = table['extension'].values
+        self.shape = shape
+        self.wcs = SIPWCS(table)
+        # Precompute a bounding circle around each channel for a fast first pass
+        rows = np.array([0, 0, shape[0], shape[0], shape[0] / 2.])[:, None]
+        cols = np.array([0, shape[1], 0, shape[1], shape[1] / 2.])[:, None]
+        ra, dec = self.wcs.pix2world(rows, cols)
+        corners = _unit_vector(ra[:4], dec[:4])
+        self.center = _unit_vector(ra[4], dec[4])
+        self.footprint = np.stack([ra[:4], dec[:4]], axis=-1)  # (corner, channel, ra/dec)
+        self.cos_radius = np.min(np.sum(corners * self.center, axis=-1), axis=0)
+
+    def locate(self, ra, dec, radius=0.):
+        """Returns the channels which contain a sky position.
+
+        Parameters
+        ----------
+        ra, dec : float
+            Position in degrees.
+
+        radius : float
+            Also return channels which lie within `radius` arcsec.
+
+        Returns
+        -------
+        matches : list of dict
+            With keys campaign, channel, row, col (zero-based pixel position
+            of the target, which may lie just off the channel if `radius` > 0),
+            and pixel_scale (arcsec per pixel).
+        """
+        target = _unit_vector(ra, dec)
+        margin = np.radians(radius / 3600.)
+        candidates = np.nonzero(np.sum(self.center * target, axis=-1)
+                                >= np.cos(np.arccos(np.clip(self.cos_radius, -1, 1)) + margin))[0]
+        wcs = self.wcs.subset(candidates)
+        row, col = wcs.world2pix(ra, dec)
+        pad = radius / wcs.pixel_scale
+        inside = ((row >= -pad) & (row < self.shape[0] + pad) &
+                  (col >= -pad) & (col < self.shape[1] + pad))
+        return [{'campaign': int(self.campaign[i]), 'channel': int(self.channel[i]),
+                 'row': float(r), 'col': float(c), 'pixel_scale': float(scale)}
+                for i, r, c, scale in zip(candidates[inside], row[inside], col[inside],
+                                          wcs.pixel_scale[inside])]
+
+
+def _unit_vector(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+###
+# Index of the pixel boxes of a set of TPFs
+###
+
+TPF_INDEX_COLUMNS = ['filename', 'campaign', 'channel', 'row', 'col', 'height', 'width']
+
+
+def build_tpf_index(tpf_filenames):
+    """Returns a `pandas.DataFrame` describing the position of each TPF,
+    with columns `TPF_INDEX_COLUMNS`.  Only the headers are read."""
+    import pandas as pd
+    import fitsio
+    from .geometry import pinned_path
+    rows = []
+    for fn in tpf_filenames:
+        with pinned_path(fn) as path, fitsio.FITS(path) as tpf:
+            hdr0, hdr1 = tpf[0].read_header(), tpf[1].read_header()
+            height, width = tpf[2].get_dims()
+        campaign = hdr0['CAMPAIGN'] if 'CAMPAIGN' in hdr0 else hdr0['QUARTER']
+        rows.append([fn, campaign, hdr0['CHANNEL'], hdr1['2CRV5P'], hdr1['1CRV5P'],
+                     height, width])
+    return pd.DataFrame(rows, columns=TPF_INDEX_COLUMNS)
+
+
+def find_tpfs(tpf_index, matches, radius=0.):
+    """Returns the rows of `tpf_index` whose pixel box lies within
+    `radius` arcsec of any of the positions returned by `SkyIndex.locate`."""
+    keep = np.zeros(len(tpf_index), dtype=bool)
+    for match in matches:
+        # Distance from the target to the edge of each box; pixel centers
+        # have integer coordinates, so a box extends half a pixel beyond them
+        drow = np.maximum(0, np.maximum(tpf_index['row'] - 0.5 - match['row'],
+                                        match['row'] - (tpf_index['row'] + tpf_index['height'] - 0.5)))
+        dcol = np.maximum(0, np.maximum(tpf_index['col'] - 0.5 - match['col'],
+                                        match['col'] - (tpf_index['col'] + tpf_index['width'] - 0.5)))
+        keep |= ((tpf_index['campaign'] == match['campaign']).values &
+                 (tpf_index['channel'] == match['channel']).values &
+                 (np.hypot(drow, dcol) <= radius / match['pixel_scale']).values)
+    return tpf_index[keep]
@@ -0,0 +1,127 @@
+"""Sparse storage for channel mosaics which are mostly empty.
+
+The TPF apertures of a channel typically cover only a small fraction of
+the CCD.  A sparse mosaic therefore stores the list of covered pixels once
+per set of TPFs (the *coverage index*), and only the values of the covered
+pixels for each cadence.
+
+A sparse mosaic file has the same extensions as a dense mosaic (IMAGE,
+UNCERTAINTY, COSMIC_RAY), but the IMAGE and UNCERTAINTY extensions are
+binary tables with a single VALUE column, and their COVERAGE keyword
+names the coverage index file.
+
+Example usage
+-------------
+coverage = CoverageIndex.from_tpfs(tpf_filenames)
+coverage.writeto("k2mosaic-c05-ch15-coverage.fits")
+image = read_mosaic_image("k2mosaic-c05-ch15-cad1000.fits")  # dense array
+"""
+from functools import lru_cache
+import os
+
+import numpy as np
+
+from . import KEPLER_CHANNEL_SHAPE
+from .geometry import read_tpf_geometry, pixel_indices
+
+# Number of coverage indexes kept in memory by `read_coverage`
+COVERAGE_CACHE_SIZE = 4
+
+
+class CoverageException(Exception):
+    pass
+
+
+class CoverageIndex(object):
+    """The sorted flattened indices of the channel pixels covered by a set of TPFs."""
+    def __init__(self, pixels, shape=KEPLER_CHANNEL_SHAPE):
+        self.pixels = np.asarray(pixels, dtype=np.int64)
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @property
+    def fraction(self):
+        """Fraction of the channel covered by the index."""
+        return len(self) / float(np.prod(self.shape))
+
+    @classmethod
+    def from_tpfs(cls, tpf_filenames, shape=KEPLER_CHANNEL_SHAPE):
+        """Builds the index from the aperture masks of a set of TPFs."""
+        pixels = [pixel_indices(geo.row, geo.col, geo.mask, shape)
+                  for geo in map(read_tpf_geometry, tpf_filenames)]
+        return cls(np.unique(np.concatenate(pixels)), shape=shape)
+
+    def positions(self, row, col, mask):
+        """Returns the positions in the index of the pixels flagged in `mask`."""
+        return self.find(pixel_indices(row, col, mask, self.shape))
+
+    def find(self, indices):
+        """Returns the positions in the index of flattened pixel indices.
+
+        Raises a `CoverageException` if any of the pixels is not covered,
+        e.g. because the index was made for another set of TPFs."""
+        indices = np.asarray(indices)
+        positions = np.searchsorted(self.pixels, indices)
+        covered = positions < len(self.pixels)
+        covered[covered] = self.pixels[positions[covered]] == indices[covered]
+        if not covered.all():
+            raise CoverageException('{} pixels are not in the coverage index; was it '
+                                    'made for other TPFs?'.format((~covered).sum()))
+        return positions
+
+    def to_dense(self, values):
+        """Expands the values of the covered pixels into a NaN-padded image."""
+        dense = np.full(int(np.prod(self.shape)), np.nan, dtype=np.float32)
+        dense[self.pixels] = values
+        return dense.reshape(self.shape)
+
+    def writeto(self, output_fn, overwrite=True):
+        from astropy.io import fits
+        hdu = fits.BinTableHDU.from_columns(
+                [fits.Column(name='PIXEL', format='K', array=self.pixels)])
+        hdu.header['EXTNAME'] = 'COVERAGE'
+        hdu.header['DNAXIS1'] = (self.shape[1], 'number of columns of the dense image')
+        hdu.header['DNAXIS2'] = (self.shape[0], 'number of rows of the dense image')
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(output_fn, overwrite=overwrite,
+                                                        checksum=True)
+
+    @classmethod
+    def read(cls, filename):
+        import fitsio
+        with fitsio.FITS(filename) as fts:
+            hdr = fts['COVERAGE'].read_header()
+            pixels = fts['COVERAGE'].read(columns=['PIXEL'])['PIXEL']
+        return cls(pixels, shape=(hdr['DNAXIS2'], hdr['DNAXIS1']))
+
+
+def read_coverage(filename):
+    """Returns the `CoverageIndex` stored in `filename`, cached per process."""
+    return _read_coverage(os.path.abspath(filename))
+
+
+@lru_cache(maxsize=COVERAGE_CACHE_SIZE)
+def _read_coverage(filename):
+    return CoverageIndex.read(filename)
+
+
+def is_sparse(header):
+    """Returns `True` if an extension header belongs to a sparse mosaic."""
+    return 'COVERAGE' in header
+
+
+def read_mosaic_image(filename, extension=1):
+    """Returns an image extension of a dense or sparse mosaic as a 2D array.
+
+    The covered pixel values of a sparse mosaic are only expanded
+    into a dense image when this function is called.
+    """
+    import fitsio
+    with fitsio.FITS(filename) as fts:
+        hdr = fts[extension].read_header()
+        if not is_sparse(hdr):
+            return fts[extension].read()
+        values = fts[extension].read(columns=['VALUE'])['VALUE']
+    coverage_fn = os.path.join(os.path.dirname(os.path.abspath(filename)), hdr['COVERAGE'])
+    return read_coverage(coverage_fn).to_dense(values)
@@ -0,0 +1,278 @@
+"""A local store of downloaded Target Pixel Files shared by many processes.
+
+Files are stored under the SHA-1 hash of their dataset name (the basename
+of the url), so that the same TPF obtained from different mirrors is only
+stored once.  A small SQLite manifest records the size and last access time
+of every file, which allows fast existence checks and the eviction of the
+least recently used files once the store exceeds its size limit.  A file
+lock per dataset ensures that concurrent workers asking for the same url
+download it only once.  A file is pinned, by a shared lock, while it is
+being used (see `TPFStore.pinned`), and eviction skips pinned files, so
+that no process removes a file which another one is about to read.
+The lock files of a dataset are removed together with it.  Locking
+relies on `fcntl`; where it is not available (Windows), files are not
+locked, and the store should not be shared by concurrent processes.
+
+The location and size of the default store can be set using the
+K2MOSAIC_STORE and K2MOSAIC_STORE_SIZE environment variables.
+
+Example usage
+-------------
+store = TPFStore('/scratch/k2mosaic-store', max_bytes='50G')
+with store.pinned('https://archive.stsci.edu/.../ktwo200000862-c00_lpd-targ.fits.gz') as path:
+    tpf = fitsio.FITS(path)
+print(store.stats_summary())
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import time
+import warnings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.k2mosaic', 'store')
+DEFAULT_STORE_SIZE = '20G'
+
+
+class StoreException(Exception):
+    pass
+
+
+class TPFStore(object):
+    """Size-capped, content-addressed cache of TPFs on the local filesystem.
+
+    Parameters
+    ----------
+    directory : str
+        Location of the store, which may be shared by several processes.
+
+    max_bytes : int or str
+        Size limit of the store, in bytes or with a K, M, G, or T suffix.
+        The least recently used files are removed when it is exceeded.
+    """
+    def __init__(self, directory=DEFAULT_STORE_DIR, max_bytes=DEFAULT_STORE_SIZE):
+        self.directory = directory
+        self.max_bytes = parse_size(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_downloaded = 0
+        self._used = {}  # Size of the files used by this process, by key
+        self._warned = False
+        os.makedirs(os.path.join(directory, 'locks'), exist_ok=True)
+        with self._manifest() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, '
+                       'name TEXT, url TEXT, nbytes INTEGER, last_access REAL)')
+
+    @staticmethod
+    def key(url):
+        """Returns the store key of a url, i.e. the hash of its dataset name."""
+        return hashlib.sha1(os.path.basename(url).encode('utf-8')).hexdigest()
+
+    def path(self, url):
+        """Returns the location of a url in the store, whether it exists or not."""
+        key = self.key(url)
+        return os.path.join(self.directory, key[:2], '{}-{}'.format(key, os.path.basename(url)))
+
+    def __contains__(self, url):
+        with self._manifest() as db:
+            row = db.execute('SELECT 1 FROM files WHERE key = ?', (self.key(url),)).fetchone()
+        return row is not None
+
+    def fetch(self, url):
+        """Returns the local path of a url, downloading it if needed.
+
+        Local paths are returned unchanged.  The file is not pinned, so
+        that another process may evict it before it is opened: use
+        `pinned` to read it."""
+        if not url.startswith('http'):
+            return url
+        key, path = self.key(url), self.path(url)
+        if url not in self or not os.path.exists(path):
+            with self._lock(key):
+                # Another process may have downloaded the file while we waited
+                if url not in self or not os.path.exists(path):
+                    nbytes = self._download(url, path)
+                    with self._manifest() as db:
+                        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                   (key, os.path.basename(url), url, nbytes, time.time()))
+                    self.misses += 1
+                    self.bytes_downloaded += nbytes
+                    self._use(key, nbytes)
+                    self.evict(keep=key)
+                    return path
+        self.hits += 1
+        with self._manifest() as db:
+            db.execute('UPDATE files SET last_access = ? WHERE key = ?', (time.time(), key))
+            row = db.execute('SELECT nbytes FROM files WHERE key = ?', (key,)).fetchone()
+        self._use(key, 0 if row is None else row[0])
+        return path
+
+    @contextmanager
+    def pinned(self, url):
+        """Yields the local path of a url, like `fetch`, and keeps the file
+        from being evicted, by any process, until the block exits."""
+        if not url.startswith('http'):
+            yield url
+            return
+        with self._lock(self.key(url) + '.pin', shared=True):
+            yield self.fetch(url)
+
+    def _use(self, key, nbytes):
+        """Records that this process uses a file, and warns once if the
+        files it uses do not fit in the store together."""
+        self._used[key] = nbytes
+        if not self._warned and sum(self._used.values()) > self.max_bytes:
+            from .planner import _format_bytes
+            warnings.warn('The {} TPFs used by this process ({}) exceed the size limit '
+                          'of the TPF store ({}), so that they will be downloaded again '
+                          'and again; raise K2MOSAIC_STORE_SIZE.'.format(
+                              len(self._used), _format_bytes(sum(self._used.values())),
+                              _format_bytes(self.max_bytes)))
+            self._warned = True
+
+    def _download(self, url, path):
+        import requests
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        try:
+            with requests.get(url, stream=True, timeout=60) as response:
+                if response.status_code != 200:
+                    raise StoreException('Could not download {} (HTTP status {}).'.format(
+                                         url, response.status_code))
+                with open(tmp_path, 'wb') as out:
+                    for chunk in response.iter_content(chunk_size=1024**2):
+                        out.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return os.path.getsize(path)
+
+    @property
+    def nbytes(self):
+        """Total size of the files in the store."""
+        with self._manifest() as db:
+            return db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM files').fetchone()[0]
+
+    def evict(self, keep=None):
+        """Removes the least recently used files until the store fits in
+        `max_bytes`.  Pinned files are kept, even if the store does not fit."""
+        with self._lock('evict'), self._manifest() as db:
+            total = db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM files').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, name, nbytes in db.execute('SELECT key, name, nbytes FROM files '
+                                                'ORDER BY last_access').fetchall():
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                with self._lock(key + '.pin', blocking=False) as unpinned:
+                    if not unpinned:
+                        continue  # Being read by a process
+                    path = os.path.join(self.directory, key[:2], '{}-{}'.format(key, name))
+                    if os.path.exists(path):
+                        os.remove(path)
+                    db.execute('DELETE FROM files WHERE key = ?', (key,))
+                    with self._lock(key, blocking=False) as idle:
+                        if idle:  # Not being downloaded again
+                            self._remove_lock(key)
+                    self._remove_lock(key + '.pin')
+                total -= nbytes
+                self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'bytes_downloaded': self.bytes_downloaded}
+
+    def stats_summary(self):
+        """Returns a one-line description of the cache hits and misses."""
+        from .planner import _format_bytes
+        total = self.hits + self.misses
+        return ('TPF store: {} hits, {} misses ({:.0%} hit rate), {} downloaded, '
+                '{} files evicted.'.format(self.hits, self.misses,
+                                           self.hits / float(total) if total else 0.,
+                                           _format_bytes(self.bytes_downloaded),
+                                           self.evictions))
+
+    @contextmanager
+    def _manifest(self):
+        """Yields a connection to the manifest, committing on exit."""
+        db = sqlite3.connect(os.path.join(self.directory, 'manifest.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _lock(self, name, shared=False, blocking=True):
+        """Holds a lock shared with the other processes using the store:
+        an exclusive lock, or a shared one which only excludes exclusive
+        locks.  If not `blocking`, yields whether the lock was obtained.
+        Without `fcntl`, nothing is locked."""
+        if fcntl is None:
+            yield True
+            return
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        lock_fn = os.path.join(self.directory, 'locks', name)
+        while True:
+            lockfile = open(lock_fn, 'a')
+            try:
+                fcntl.flock(lockfile, operation)
+            except BlockingIOError:
+                lockfile.close()
+                yield False
+                return
+            # Another process may have removed the lock file (see `_remove_lock`)
+            # while we waited, in which case the lock is not shared with anyone
+            try:
+                if os.stat(lock_fn).st_ino == os.fstat(lockfile.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lockfile.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def _remove_lock(self, name):
+        """Removes a lock file; the lock must be held exclusively, so that
+        the processes waiting for it open a new one (see `_lock`)."""
+        try:
+            os.remove(os.path.join(self.directory, 'locks', name))
+        except FileNotFoundError:
+            pass
+
+
+def parse_size(size):
+    """Converts a size such as 500000, '500K', or '20G' into bytes."""
+    if isinstance(size, str):
+        size = size.strip().upper().rstrip('B')
+        for power, suffix in enumerate(['K', 'M', 'G', 'T'], start=1):
+            if size.endswith(suffix):
+                return int(float(size[:-1]) * 1024**power)
+    return int(size)
+
+
+_default_store = None
+
+
+def default_store():
+    """Returns the store configured by K2MOSAIC_STORE and K2MOSAIC_STORE_SIZE,
+    creating it on first use in each process."""
+    global _default_store
+    if _default_store is None:
+        _default_store = TPFStore(os.getenv('K2MOSAIC_STORE', DEFAULT_STORE_DIR),
+                                  os.getenv('K2MOSAIC_STORE_SIZE', DEFAULT_STORE_SIZE))
+    return _default_store
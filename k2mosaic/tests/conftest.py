@@ -0,0 +1,87 @@
+"""Synthetic Target Pixel Files shared by the tests."""
+import numpy as np
+import pytest
+from astropy.io import fits
+
+N_CADENCES = 12
+FIRST_CADENCENO = 1000
+# (row, col, height, width) of the synthetic apertures
+APERTURES = [(100, 200, 5, 6), (102, 203, 4, 4), (500, 700, 7, 3)]
+
+
+def make_tpf(filename, row, col, height, width, n_cadences=N_CADENCES,
+             first_cadenceno=FIRST_CADENCENO, seed=0, no_data=(3,),
+             quality=None, channel=15, campaign=5):
+    """Writes a small but structurally valid K2 Target Pixel File."""
+    rng = np.random.RandomState(seed)
+    shape = (n_cadences, height, width)
+    flux = rng.normal(100., 5., size=shape).astype(np.float32)
+    flux_err = np.abs(rng.normal(2., .1, size=shape)).astype(np.float32)
+    flux_bkg = rng.normal(10., 1., size=shape).astype(np.float32)
+    flux_bkg_err = np.abs(rng.normal(1., .1, size=shape)).astype(np.float32)
+    time = 2300. + np.arange(n_cadences) * 0.0204
+    if quality is None:
+        quality = np.zeros(n_cadences, dtype=np.int32)
+    quality = np.asarray(quality, dtype=np.int32)
+    for idx in no_data:
+        quality[idx] |= 65536
+        time[idx] = np.nan
+        flux[idx] = np.nan
+    pos_corr = rng.normal(0., .05, size=n_cadences).astype(np.float32)
+
+    hdr0 = fits.Header()
+    hdr0['CAMPAIGN'] = campaign
+    hdr0['CHANNEL'] = channel
+    hdr0['MODULE'] = (6, 'CCD module')
+    hdr0['OUTPUT'] = (3, 'CCD output')
+    primary = fits.PrimaryHDU(header=hdr0)
+
+    dim = '({},{})'.format(width, height)
+    cols = [fits.Column(name='TIME', format='D', array=time),
+            fits.Column(name='CADENCENO', format='J',
+                        array=first_cadenceno + np.arange(n_cadences)),
+            fits.Column(name='FLUX', format='{}E'.format(height * width), dim=dim, array=flux),
+            fits.Column(name='FLUX_ERR', format='{}E'.format(height * width), dim=dim, array=flux_err),
+            fits.Column(name='FLUX_BKG', format='{}E'.format(height * width), dim=dim, array=flux_bkg),
+            fits.Column(name='FLUX_BKG_ERR', format='{}E'.format(height * width), dim=dim,
+                        array=flux_bkg_err),
+            fits.Column(name='QUALITY', format='J', array=quality),
+            fits.Column(name='POS_CORR1', format='E', array=pos_corr),
+            fits.Column(name='POS_CORR2', format='E', array=-pos_corr)]
+    table = fits.BinTableHDU.from_columns(cols)
+    hdr1 = table.header
+    hdr1['1CRV5P'] = (col, 'physical WCS axis 1 table column reference')
+    hdr1['2CRV5P'] = (row, 'physical WCS axis 2 table column reference')
+    for keyword, value in [('TIMEREF', 'SOLARSYSTEM'), ('TASSIGN', 'SPACECRAFT'),
+                           ('TIMESYS', 'TDB'), ('BJDREFI', 2454833), ('BJDREFF', 0.),
+                           ('TIMEUNIT', 'd'), ('DEADC', 0.92), ('TIMEPIXR', 0.5),
+                           ('TIERRELA', 5.78E-07), ('INT_TIME', 6.02), ('READTIME', 0.52),
+                           ('FRAMETIM', 6.54), ('NUM_FRM', 270), ('TIMEDEL', 0.0204),
+                           ('DEADAPP', True), ('VIGNAPP', True), ('GAIN', 112.),
+                           ('READNOIS', 83.), ('NREADOUT', 270), ('MEANBLCK', 738),
+                           ('RADESYS', 'ICRS'), ('EQUINOX', 2000.0)]:
+        hdr1[keyword] = (value, 'synthetic {}'.format(keyword.lower()))
+
+    aperture = fits.ImageHDU(np.full((height, width), 3, dtype=np.int32))
+    fits.HDUList([primary, table, aperture]).writeto(filename, overwrite=True)
+    return str(filename)
+
+
+def make_mosaic(tpf_filenames, cadenceno=FIRST_CADENCENO, mosaic_class=None, **kwargs):
+    """Returns a mosaic of one cadence of a list of TPFs.
+
+    The mosaic is a `KeplerChannelMosaic` unless another `mosaic_class`
+    is given, e.g. `SparseChannelMosaic`; the keyword arguments are passed
+    on to it."""
+    from k2mosaic import KeplerChannelMosaic
+    mosaic_class = KeplerChannelMosaic if mosaic_class is None else mosaic_class
+    mosaic = mosaic_class(campaign=5, channel=15, cadenceno=cadenceno, **kwargs)
+    [mosaic.add_tpf(tpf) for tpf in tpf_filenames]
+    return mosaic
+
+
+@pytest.fixture
+def tpf_filenames(tmp_path):
+    """A list of synthetic TPFs, two of which overlap."""
+    return [make_tpf(tmp_path / 'tpf{}.fits'.format(i), *aperture, seed=i)
+            for i, aperture in enumerate(APERTURES)]
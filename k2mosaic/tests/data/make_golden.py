@@ -0,0 +1,50 @@
+"""Writes the golden mosaics of the equivalence harness.
+
+The golden mosaics must come from the code the optimized paths are checked
+against, i.e. k2mosaic 3.0.2, which is imported from the checkout given on
+the command line, while the synthetic TPFs and `write_golden` come from
+this tree.  k2mosaic 3.0.2 predates numpy 1.24, which removed `np.float`.
+
+Example usage
+-------------
+python k2mosaic/tests/data/make_golden.py /path/to/k2mosaic-3.0.2
+"""
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+GOLDEN_CADENCES = [1000, 1001, 1005, 1011]
+TREE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..')
+
+
+def main(old_checkout):
+    sys.path.insert(0, TREE)
+    from k2mosaic.tests.conftest import make_tpf
+    from k2mosaic.tests.equivalence import write_golden
+    from k2mosaic.tests.test_equivalence import APERTURES
+    tmp_dir = tempfile.mkdtemp()
+    tpf_filenames = [make_tpf(os.path.join(tmp_dir, 'tpf{}.fits'.format(i)), *aperture, seed=i)
+                     for i, aperture in enumerate(APERTURES)]
+    # Swap the package for the old version
+    for name in [name for name in sys.modules if name.startswith('k2mosaic')]:
+        del sys.modules[name]
+    sys.path[0] = os.path.abspath(old_checkout)
+    np.float = float
+    from k2mosaic import ui
+    outputs = {}
+    for add_background in [False, True]:
+        prefix = os.path.join(tmp_dir, 'background' if add_background else 'flux', 'k2mosaic-c')
+        os.makedirs(os.path.dirname(prefix))
+        outputs[add_background] = {}
+        for cadenceno in GOLDEN_CADENCES:
+            ui.k2mosaic_mosaic_one(cadenceno, tpf_filenames, 5, 15, add_background,
+                                   output_prefix=prefix)
+            outputs[add_background][cadenceno] = '{}05-ch15-cad{}.fits'.format(prefix, cadenceno)
+    assert ui.__file__.startswith(sys.path[0])
+    write_golden(outputs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
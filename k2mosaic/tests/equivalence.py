@@ -0,0 +1,258 @@
+"""Golden-output equivalence harness for the mosaicking paths.
+
+Every way of producing mosaics (in parallel, sparse, compressed, sharded
+across machines, ...) has to reproduce the output of the reference path,
+which mosaics one cadence at a time in a single process using
+`KeplerChannelMosaic.add_tpf` and `writeto`.  The harness runs a path on a
+set of TPFs through the command-line interface, and compares each of its
+mosaics with the reference mosaic of the same cadence: the NaN coverage and
+values of the IMAGE and UNCERTAINTY extensions, the COSMIC_RAY table, and
+the header keywords.
+
+To check a new path, add a function which writes its mosaics into a
+directory to `PATHS`, together with the tolerance its values must meet.
+
+The reference path itself runs today's code, so a regression shared by all
+paths would go unnoticed.  It is therefore also compared with golden
+mosaics written by k2mosaic 3.0.2, before any of the optimized paths
+existed, which are frozen in `GOLDEN_FN` (see `data/make_golden.py`).
+
+Example usage
+-------------
+reference = run_path('reference', tpf_filenames, str(tmp_path / 'ref'))
+assert compare_golden(read_golden()[False], reference) == []
+candidate = run_path('sparse', tpf_filenames, str(tmp_path / 'sparse'))
+assert compare_outputs(reference, candidate, PATHS['sparse'].tolerance) == []
+"""
+from collections import namedtuple
+import glob
+import gzip
+import json
+import os
+import re
+
+import numpy as np
+from astropy.io import fits
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.sparse import read_mosaic_image
+
+Tolerance = namedtuple('Tolerance', ['rtol', 'atol'])
+EXACT = Tolerance(rtol=0., atol=0.)
+Path = namedtuple('Path', ['run', 'tolerance'])
+
+# Header keywords which may differ between two runs of the same path
+VOLATILE_KEYWORDS = ['DATE', 'CHECKSUM', 'DATASUM']
+# Keywords describing the layout of an extension rather than its content
+STRUCTURAL_KEYWORDS = re.compile(r'^(XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|TFIELDS|'
+                                 r'(TTYPE|TFORM|TDIM|TUNIT)\d+)$')
+IMAGE_EXTENSIONS = [1, 2]  # IMAGE and UNCERTAINTY
+CR_EXTENSION = 3
+GOLDEN_FN = os.path.join(os.path.dirname(__file__), 'data', 'golden-mosaics.json.gz')
+
+
+def _invoke(args):
+    result = CliRunner().invoke(ui.k2mosaic, args, catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+
+
+def _mosaic(*options):
+    """Returns a path running `k2mosaic mosaic` with extra `options`."""
+    def run(filelist, output_dir, extra_args):
+        _invoke(['mosaic', filelist, '-o', os.path.join(output_dir, 'k2mosaic-c')] +
+                list(options) + extra_args)
+    return run
+
+
+def _sharded(filelist, output_dir, extra_args):
+    """Plans shards of 4 cadences and 2 TPF groups, runs them, and merges them."""
+    manifest = os.path.join(output_dir, 'shards.json')
+    _invoke(['plan', filelist, '-o', os.path.join(output_dir, 'k2mosaic-c'),
+             '-m', manifest, '-n', '4', '-g', '2'] + extra_args)
+    from k2mosaic.shards import ShardManifest
+    for shard_id in range(len(ShardManifest.read(manifest))):
+        _invoke(['run-shard', manifest, str(shard_id), '-p', '1'])
+    _invoke(['merge', manifest, '--clean'])
+
+
+PATHS = {
+    'reference': Path(_mosaic('-p', '1'), EXACT),
+    'parallel': Path(_mosaic('-p', '2'), EXACT),
+    'parallel-budget': Path(_mosaic('--max-memory', '4G', '--max-workers', '2'), EXACT),
+    'sparse': Path(_mosaic('-p', '1', '--sparse'), EXACT),
+    'compressed-lossless': Path(_mosaic('-p', '1', '--compress', 'gzip2',
+                                        '--quantize-level', '0'), EXACT),
+    # Quantization errors are a fraction of the noise, i.e. <1% of the ~100 e-/s flux
+    'compressed-rice': Path(_mosaic('-p', '1', '--compress', 'rice'),
+                            Tolerance(rtol=1e-2, atol=0.)),
+    'sharded': Path(_sharded, EXACT),
+    # The 'last' ownership policy reproduces the default overwriting order
+    'ownership-last': Path(_mosaic('-p', '1', '--overlap', 'last'), EXACT),
+}
+
+
+def run_path(name, tpf_filenames, output_dir, add_background=False, extra_args=()):
+    """Runs one of the `PATHS` on a list of TPFs.
+
+    Returns
+    -------
+    outputs : dict
+        Maps the cadence numbers onto the mosaics written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    filelist = os.path.join(output_dir, 'tpfs.txt')
+    with open(filelist, 'w') as out:
+        out.write('\n'.join(tpf_filenames))
+    extra_args = list(extra_args) + (['--add-background'] if add_background else [])
+    PATHS[name].run(filelist, output_dir, extra_args)
+    outputs = {}
+    for fn in glob.glob(os.path.join(output_dir, '*-cad*.fits')):
+        match = re.search(r'-cad(\d+)\.fits$', fn)
+        if match:
+            outputs[int(match.group(1))] = fn
+    return outputs
+
+
+def compare_outputs(reference, candidate, tolerance=EXACT):
+    """Compares the mosaics of two runs, as returned by `run_path`.
+
+    Returns a list of differences, which is empty if the runs are equivalent.
+    """
+    differences = []
+    if sorted(reference) != sorted(candidate):
+        differences.append('cadences {} were written instead of {}'.format(
+                           sorted(candidate), sorted(reference)))
+    for cadenceno in sorted(set(reference) & set(candidate)):
+        differences += ['cadence {}: {}'.format(cadenceno, difference)
+                        for difference in compare_mosaics(reference[cadenceno],
+                                                          candidate[cadenceno], tolerance)]
+    return differences
+
+
+def compare_mosaics(reference_fn, candidate_fn, tolerance=EXACT):
+    """Compares two mosaics, dense or sparse, compressed or not.
+
+    The NaN coverage, COSMIC_RAY table, and header keywords must be
+    identical; the finite image values must agree within `tolerance`.
+
+    Returns a list of differences, which is empty if the mosaics are equivalent.
+    """
+    differences = []
+    for ext in IMAGE_EXTENSIONS:
+        expected = read_mosaic_image(reference_fn, ext)
+        actual = read_mosaic_image(candidate_fn, ext)
+        if expected.shape != actual.shape:
+            differences.append('ext {}: shape {} instead of {}'.format(
+                               ext, actual.shape, expected.shape))
+            continue
+        finite = np.isfinite(expected)
+        n_coverage = (finite != np.isfinite(actual)).sum()
+        if n_coverage > 0:
+            differences.append('ext {}: NaN coverage differs at {} pixels'.format(ext, n_coverage))
+        close = np.isclose(actual, expected, rtol=tolerance.rtol, atol=tolerance.atol,
+                           equal_nan=True)
+        if not close.all():
+            error = np.abs(actual - expected)[finite & ~close]
+            differences.append('ext {}: {} values differ, by up to {:.3g}'.format(
+                               ext, len(error), np.nanmax(error)))
+    with fits.open(reference_fn) as expected, fits.open(candidate_fn) as actual:
+        for ext in range(len(expected)):
+            differences += ['ext {}: {}'.format(ext, difference)
+                            for difference in compare_headers(expected[ext].header,
+                                                              actual[ext].header)]
+        expected_cr, actual_cr = expected[CR_EXTENSION].data, actual[CR_EXTENSION].data
+        for column in expected_cr.names:
+            if not np.array_equal(expected_cr[column], actual_cr[column]):
+                differences.append('ext {}: column {} differs'.format(CR_EXTENSION, column))
+    return differences
+
+
+def compare_headers(expected, actual):
+    """Compares the content keywords of a reference header with another header.
+
+    Extra keywords in `actual`, e.g. those describing a sparse or compressed
+    layout, are allowed.
+    """
+    differences = []
+    for keyword in expected:
+        if keyword in VOLATILE_KEYWORDS or STRUCTURAL_KEYWORDS.match(keyword) or keyword == '':
+            continue
+        if keyword not in actual:
+            differences.append('keyword {} is missing'.format(keyword))
+        elif actual[keyword] != expected[keyword]:
+            differences.append('keyword {} is {!r} instead of {!r}'.format(
+                               keyword, actual[keyword], expected[keyword]))
+    return differences
+
+
+def write_golden(outputs, filename=GOLDEN_FN):
+    """Freezes the content of mosaics into a small golden file.
+
+    `outputs` maps `add_background` onto the dict returned by `run_path`
+    (or any dict of cadence numbers and mosaics).  Only the covered pixels
+    and the content keywords of the headers are kept.
+    """
+    golden = {}
+    for add_background, mosaics in outputs.items():
+        golden[str(add_background)] = entries = {}
+        for cadenceno, fn in mosaics.items():
+            entry = {'headers': []}
+            image = read_mosaic_image(fn, IMAGE_EXTENSIONS[0])
+            rows, cols = np.nonzero(np.isfinite(image))
+            entry['pixels'] = [rows.tolist(), cols.tolist()]
+            entry['values'] = [[float(value) for value in read_mosaic_image(fn, ext)[rows, cols]]
+                               for ext in IMAGE_EXTENSIONS]
+            with fits.open(fn) as hdulist:
+                for hdu in hdulist:
+                    entry['headers'].append({keyword: hdu.header[keyword] for keyword in hdu.header
+                                             if keyword not in VOLATILE_KEYWORDS and
+                                             not STRUCTURAL_KEYWORDS.match(keyword) and
+                                             keyword not in ['', 'COMMENT', 'HISTORY']})
+                entry['cosmic_rays'] = {column: hdulist[CR_EXTENSION].data[column].tolist()
+                                        for column in hdulist[CR_EXTENSION].data.names}
+            entries[str(cadenceno)] = entry
+    with gzip.open(filename, 'wt') as out:
+        json.dump(golden, out, sort_keys=True)
+
+
+def read_golden(filename=GOLDEN_FN):
+    """Returns the golden mosaics of `write_golden`, keyed by `add_background`
+    and cadence number."""
+    with gzip.open(filename, 'rt') as golden:
+        return {add_background == 'True': {int(cadenceno): entry
+                                           for cadenceno, entry in entries.items()}
+                for add_background, entries in json.load(golden).items()}
+
+
+def compare_golden(golden, candidate):
+    """Compares the golden mosaics of some cadences with the mosaics of a run.
+
+    Returns a list of differences, which is empty if the run reproduces
+    the golden mosaics exactly.
+    """
+    differences = []
+    for cadenceno, entry in sorted(golden.items()):
+        if cadenceno not in candidate:
+            differences.append('cadence {}: not written'.format(cadenceno))
+            continue
+        fn = candidate[cadenceno]
+        rows, cols = entry['pixels']
+        for ext, values in zip(IMAGE_EXTENSIONS, entry['values']):
+            actual = read_mosaic_image(fn, ext)
+            expected = np.full(actual.shape, np.nan, dtype=actual.dtype)
+            expected[rows, cols] = values
+            if not np.array_equal(actual, expected, equal_nan=True):
+                differences.append('cadence {}: ext {}: {} pixels differ'.format(
+                                   cadenceno, ext, (~np.isclose(actual, expected,
+                                                                rtol=0., atol=0.,
+                                                                equal_nan=True)).sum()))
+        with fits.open(fn) as hdulist:
+            for ext, header in enumerate(entry['headers']):
+                differences += ['cadence {}: ext {}: {}'.format(cadenceno, ext, difference)
+                                for difference in compare_headers(header, hdulist[ext].header)]
+            for column, values in entry['cosmic_rays'].items():
+                if hdulist[CR_EXTENSION].data[column].tolist() != values:
+                    differences.append('cadence {}: ext {}: column {} differs'.format(
+                                       cadenceno, CR_EXTENSION, column))
+    return differences
@@ -0,0 +1,99 @@
+import glob
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.cosmicrays import (detect_cosmic_rays, detect_in_tpf, rolling_median_mad,
+                                 read_cosmic_rays, write_cosmic_rays)
+
+from .conftest import make_tpf
+
+# (cadence index, row, col) of the injected cosmic rays, in aperture coordinates
+HITS = [(0, 1, 1), (7, 2, 3), (8, 0, 0), (20, 4, 5), (39, 3, 2)]
+
+
+@pytest.fixture
+def tpf_with_hits(tmp_path):
+    fn = make_tpf(tmp_path / 'hits.fits', 100, 200, 5, 6, n_cadences=40)
+    with fits.open(fn, mode='update') as hdulist:
+        for idx, row, col in HITS:
+            hdulist[1].data['FLUX'][idx, row, col] += 1000.
+    return fn
+
+
+def test_rolling_median_mad():
+    rng = np.random.RandomState(0)
+    flux = rng.normal(size=(30, 4))
+    flux[5, 2] = np.nan
+    median, mad = rolling_median_mad(flux, 3)
+    for idx in [0, 5, 12, 29]:
+        window = flux[max(idx - 3, 0):idx + 4]
+        assert np.allclose(median[idx], np.nanmedian(window, axis=0))
+        assert np.allclose(mad[idx], np.nanmedian(np.abs(window - median[idx]), axis=0))
+
+
+@pytest.mark.parametrize("chunk_size", [7, 256])
+def test_detect_in_tpf(tpf_with_hits, chunk_size):
+    events = detect_in_tpf(tpf_with_hits, nsigma=8., chunk_size=chunk_size)
+    found = sorted(zip(events['CADENCENO'] - 1000, events['RAWY'] - 100, events['RAWX'] - 200))
+    assert found == HITS
+    assert np.all(np.abs(events['COSMIC_RAY'] - 1000.) < 50.)
+    # Restricting the cadences does not change the events in the range
+    events = detect_in_tpf(tpf_with_hits, nsigma=8., chunk_size=chunk_size,
+                           cadence_range=(1007, 1020))
+    assert list(events['CADENCENO']) == [1007, 1008, 1020]
+
+
+def test_overwritten_pixels_are_ignored(tmp_path, tpf_with_hits):
+    # A later TPF covering the first rows hides the hits at (0, 1, 1) and (8, 0, 0)
+    cover = make_tpf(tmp_path / 'cover.fits', 100, 200, 2, 6, n_cadences=40, seed=1)
+    events = detect_cosmic_rays([tpf_with_hits, cover], nsigma=8.)
+    assert list(events['CADENCENO']) == [1007, 1020, 1039]
+
+
+def test_mosaic_cosmic_ray_extension(tmp_path, tpf_with_hits):
+    events = detect_cosmic_rays([tpf_with_hits], nsigma=8.)
+    cr_fn = str(tmp_path / 'cosmicrays.fits')
+    write_cosmic_rays(events, cr_fn)
+    assert np.array_equal(read_cosmic_rays(cr_fn)['RAWX'], events['RAWX'])
+    outputs = {}
+    for clean in [False, True]:
+        outputs[clean] = ui.k2mosaic_mosaic_one(1007, [tpf_with_hits], 5, 15, False,
+                                                output_prefix=str(tmp_path / str(clean)),
+                                                cosmic_ray_fn=cr_fn, clean_cosmic_rays=clean)
+    with fits.open(outputs[False]) as dirty, fits.open(outputs[True]) as clean:
+        assert list(dirty[3].data['RAWX']) == [203] and list(dirty[3].data['RAWY']) == [102]
+        assert dirty[1].data[102, 203] - clean[1].data[102, 203] == \
+            pytest.approx(dirty[3].data['COSMIC_RAY'][0])
+        assert abs(clean[1].data[102, 203] - 100.) < 30.
+        mask = np.ones(dirty[1].data.shape, dtype=bool)
+        mask[102, 203] = False
+        assert np.array_equal(dirty[1].data[mask], clean[1].data[mask], equal_nan=True)
+
+
+@pytest.mark.parametrize("overlap", ['first', 'last'])
+def test_cosmic_rays_follow_the_overlap_policy(tmp_path, tpf_with_hits, overlap):
+    # The hit at (7, 2, 3) falls on pixel (102, 203), which the covering
+    # TPF supplies to the mosaic under the 'last' policy only
+    cover = make_tpf(tmp_path / 'cover.fits', 102, 203, 4, 4, n_cadences=40, seed=1)
+    filelist = tmp_path / 'tpfs.txt'
+    filelist.write_text('\n'.join([tpf_with_hits, cover]))
+    prefix = str(tmp_path / 'k2mosaic-c')
+    result = CliRunner().invoke(ui.k2mosaic, ['mosaic', str(filelist), '-p', '1',
+                                              '--cadence', '1007', '--overlap', overlap,
+                                              '--clean-cosmic-rays', '--cr-threshold', '8',
+                                              '-o', prefix])
+    assert result.exit_code == 0, result.output
+    events = read_cosmic_rays(prefix + '05-ch15-cosmicrays.fits')
+    hit = (events['CADENCENO'] == 1007) & (events['RAWY'] == 102) & (events['RAWX'] == 203)
+    with fits.open(glob.glob(prefix + '*-cad*.fits')[0]) as mosaic:
+        if overlap == 'first':
+            assert hit.sum() == 1
+            assert abs(mosaic[1].data[102, 203] - 100.) < 30.
+        else:
+            assert hit.sum() == 0
+            with fits.open(cover) as tpf:
+                assert mosaic[1].data[102, 203] == tpf[1].data['FLUX'][7, 0, 0]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from k2mosaic.cube import KeplerChannelCube, LRUCache
+
+from .conftest import FIRST_CADENCENO, N_CADENCES, make_mosaic, make_tpf
+
+
+@pytest.mark.parametrize("add_background", [False, True])
+def test_cube_matches_mosaic(tpf_filenames, add_background):
+    cube = KeplerChannelCube(tpf_filenames, add_background=add_background, block_size=5)
+    assert cube.shape == (N_CADENCES, 1070, 1132)
+    assert cube.cadenceno[0] == FIRST_CADENCENO
+    for idx in [0, 7]:
+        mos = make_mosaic(tpf_filenames, FIRST_CADENCENO + idx, add_background=add_background)
+        box = cube[idx, 95:110, 195:212]
+        assert box.shape == (15, 17)
+        assert np.array_equal(box, mos.data[95:110, 195:212], equal_nan=True)
+        assert np.array_equal(cube[idx, 500:507, 700], mos.data[500:507, 700])
+
+
+def test_cube_indexing(tpf_filenames):
+    cube = KeplerChannelCube(tpf_filenames)
+    full = cube[:, 90:110, 190:215]
+    assert full.shape == (N_CADENCES, 20, 25)
+    assert np.array_equal(cube[2:9:3, 90:110:2, 190:215], full[2:9:3, ::2], equal_nan=True)
+    assert np.array_equal(cube[-1, 100:105, 200 - 1132], full[-1, 10:15, 10], equal_nan=True)
+    assert np.isnan(cube[:, 0:10, 0:10]).all()
+    assert cube[5:5, 100:105].shape == (0, 5, 1132)
+    with pytest.raises(IndexError):
+        cube[N_CADENCES]
+    with pytest.raises(TypeError):
+        cube[[1, 2]]
+
+
+def test_cube_reads_only_overlapping_blocks(tpf_filenames):
+    cube = KeplerChannelCube(tpf_filenames, block_size=4)
+    cube[0:3, 500:507, 700:703]
+    # Only the first block of the third TPF was decoded
+    assert len(cube.cache) == 1
+    assert cube.cache.misses == 1
+    cube[1:4, 500:507, 700:703]
+    assert cube.cache.hits == 1
+    cube[0:6, 100:105, 200:206]
+    assert len(cube.cache) == 5
+
+
+def test_cube_with_different_cadence_ranges(tmp_path):
+    fns = [make_tpf(tmp_path / 'a.fits', 10, 10, 3, 3, n_cadences=4, first_cadenceno=100),
+           make_tpf(tmp_path / 'b.fits', 20, 20, 3, 3, n_cadences=4, first_cadenceno=102,
+                    no_data=())]
+    cube = KeplerChannelCube(fns)
+    assert list(cube.cadenceno) == [100, 101, 102, 103, 104, 105]
+    assert np.isnan(cube[4, 10:13, 10:13]).all()
+    assert np.isnan(cube[0, 20:23, 20:23]).all()
+    assert np.isfinite(cube[4, 20:23, 20:23]).all()
+
+
+def test_lru_cache_byte_limit():
+    cache = LRUCache(max_bytes=100)
+    for key in range(4):
+        cache.put(key, np.zeros(4, dtype=np.float64))  # 32 bytes each
+    assert len(cache) == 3 and cache.nbytes == 96
+    assert cache.get(0) is None
+    cache.get(1)  # 1 is now the most recently used item
+    cache.put(4, np.zeros(4))
+    assert 1 in cache and 2 not in cache
+    cache.put(5, np.zeros(100))  # Larger than the cache itself
+    assert 5 not in cache
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
@@ -0,0 +1,57 @@
+import os
+
+import fitsio
+import numpy as np
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.cutouts import CutoutTarget, cut_out, read_targets
+from k2mosaic.sparse import read_mosaic_image
+
+from .conftest import FIRST_CADENCENO
+
+
+def test_cut_out():
+    image = np.arange(20, dtype=np.float32).reshape(4, 5)
+    cutout = cut_out(image, CutoutTarget('corner', -1, 3, 3, 4))
+    assert cutout.shape == (3, 4)
+    assert np.isnan(cutout[0]).all() and np.isnan(cutout[:, 2:]).all()
+    assert np.array_equal(cutout[1:, :2], image[:2, 3:])
+
+
+def test_cutouts_command(tmp_path, tpf_filenames):
+    cadences = [FIRST_CADENCENO, FIRST_CADENCENO + 1, FIRST_CADENCENO + 2]
+    mosaic_fns = [ui.k2mosaic_mosaic_one(cadenceno, tpf_filenames, 5, 15, False,
+                                         output_prefix=str(tmp_path / 'mos-c'))
+                  for cadenceno in cadences]
+    filelist = tmp_path / 'mosaics.txt'
+    filelist.write_text('\n'.join(mosaic_fns))
+    targets_fn = tmp_path / 'targets.csv'
+    targets_fn.write_text('name,row,col,size\nA,102,203,8\nB,503,701,6\n')
+    targets = read_targets(str(targets_fn))
+    assert targets[0] == CutoutTarget('A', 98, 199, 8, 8)
+
+    result = CliRunner().invoke(ui.cutouts, [str(filelist), str(targets_fn),
+                                             '-o', str(tmp_path / 'fits' / 'cut-'), '-f', 'fits'])
+    assert result.exit_code == 0, result.output
+    cube = fitsio.read(str(tmp_path / 'fits' / 'cut-A.fits'), ext=1)
+    assert cube.shape == (3, 8, 8)
+    for plane, fn in zip(cube, mosaic_fns):
+        np.testing.assert_array_equal(plane, read_mosaic_image(fn)[98:106, 199:207])
+    cadence_table = fitsio.read(str(tmp_path / 'fits' / 'cut-A.fits'), ext='CADENCES')
+    assert list(cadence_table['CADENCENO']) == cadences
+
+    # Reading the TPFs through a cube gives the same cutouts, for every cadence
+    tpf_list = tmp_path / 'tpfs.txt'
+    tpf_list.write_text('\n'.join(tpf_filenames))
+    result = CliRunner().invoke(ui.cutouts, [str(tpf_list), str(targets_fn), '--tpfs',
+                                             '-o', str(tmp_path / 'tpf-'), '-f', 'fits'])
+    assert result.exit_code == 0, result.output
+    tpf_cube = fitsio.read(str(tmp_path / 'tpf-A.fits'), ext=1)
+    np.testing.assert_array_equal(tpf_cube[:3], cube)
+
+    result = CliRunner().invoke(ui.cutouts, [str(filelist), str(targets_fn),
+                                             '-o', str(tmp_path / 'cut-')])
+    assert result.exit_code == 0, result.output
+    assert os.path.exists(str(tmp_path / 'cut-A.gif'))
+    assert os.path.exists(str(tmp_path / 'cut-B.gif'))
@@ -0,0 +1,66 @@
+"""Checks that every mosaicking path reproduces the reference path.
+
+Each path is a separate test, so that CI can run them as a matrix
+(e.g. `py.test k2mosaic/tests/test_equivalence.py -k sharded`).
+"""
+import os
+import re
+
+import pytest
+
+from .conftest import make_tpf
+from .equivalence import PATHS, compare_golden, compare_outputs, read_golden, run_path
+
+# Overlapping apertures, and one in the corner of the channel
+APERTURES = [(100, 200, 5, 6), (102, 203, 4, 4), (500, 700, 7, 3), (1062, 1124, 8, 8)]
+
+
+@pytest.fixture(scope='module')
+def tpf_set(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('tpfs')
+    return [make_tpf(directory / 'tpf{}.fits'.format(i), *aperture, seed=i)
+            for i, aperture in enumerate(APERTURES)]
+
+
+@pytest.fixture(scope='module')
+def reference_outputs(tpf_set, tmp_path_factory):
+    """The reference mosaics, without and with the background added."""
+    return {add_background: run_path('reference', tpf_set,
+                                     str(tmp_path_factory.mktemp('reference')),
+                                     add_background=add_background)
+            for add_background in [False, True]}
+
+
+@pytest.mark.parametrize('add_background', [False, True], ids=['flux', 'background'])
+@pytest.mark.parametrize('path', sorted(set(PATHS) - {'reference'}))
+def test_path_equivalence(path, add_background, tpf_set, reference_outputs, tmp_path):
+    reference = reference_outputs[add_background]
+    assert len(reference) > 0
+    candidate = run_path(path, tpf_set, str(tmp_path), add_background=add_background)
+    assert compare_outputs(reference, candidate, PATHS[path].tolerance) == []
+
+
+def test_differences_are_reported(reference_outputs):
+    differences = compare_outputs(reference_outputs[False], reference_outputs[True])
+    assert any('ext 1: ' in d and 'values differ' in d for d in differences)
+    assert any('keyword BACKAPP' in d for d in differences)
+
+
+def test_ci_runs_every_path():
+    """Every path is selected by one of the EQUIVALENCE jobs of the CI matrix."""
+    travis_fn = os.path.join(os.path.dirname(__file__), '..', '..', '.travis.yml')
+    if not os.path.exists(travis_fn):
+        pytest.skip('not running from a source checkout')
+    selectors = re.findall(r'^\s*-\s*EQUIVALENCE=(\S+)\s*$', open(travis_fn).read(), re.M)
+    selectors = [selector for selector in selectors if selector != 'none']
+    missing = [path for path in sorted(set(PATHS) - {'reference'})
+               if not any(selector in path for selector in selectors)]
+    assert missing == []
+
+
+@pytest.mark.parametrize('add_background', [False, True], ids=['flux', 'background'])
+def test_reference_matches_golden(add_background, reference_outputs):
+    """The reference path reproduces the mosaics of k2mosaic 3.0.2."""
+    golden = read_golden()[add_background]
+    assert len(golden) > 0
+    assert compare_golden(golden, reference_outputs[add_background]) == []
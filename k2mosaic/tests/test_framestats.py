@@ -0,0 +1,74 @@
+import glob
+import os
+
+import numpy as np
+from click.testing import CliRunner
+from PIL import Image
+
+from k2mosaic import ui
+from k2mosaic.framestats import FrameStatistics
+from k2mosaic.sparse import read_mosaic_image
+
+
+def test_statistics_sidecar(tmp_path, tpf_filenames):
+    filelist = tmp_path / 'tpfs.txt'
+    filelist.write_text('\n'.join(tpf_filenames))
+    for name, options in [('dense', []), ('sparse', ['--sparse'])]:
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        result = CliRunner().invoke(ui.k2mosaic, ['mosaic', str(filelist), '-p', '1',
+                                                  '-o', str(output_dir / 'k2mosaic-c')] + options)
+        assert result.exit_code == 0, result.output
+        stats = FrameStatistics.read(str(output_dir / 'k2mosaic-c05-ch15-stats.fits'))
+        mosaic_fns = sorted(glob.glob(str(output_dir / '*-cad*.fits')))
+        assert len(stats) == len(mosaic_fns)
+        assert list(stats['CADENCENO']) == sorted(stats['CADENCENO'])
+        for fn in mosaic_fns:
+            row = list(stats['FILENAME']).index(os.path.basename(fn))
+            image = read_mosaic_image(fn)
+            finite = np.isfinite(image)
+            assert stats['NPIXELS'][row] == finite.sum()
+            assert np.isclose(stats['COVERAGE'][row], finite.mean())
+            assert np.isclose(stats['FLUX_MEDIAN'][row], np.median(image[finite]))
+            rows, cols = np.nonzero(finite)
+            assert (stats['ROW_MIN'][row], stats['COL_MAX'][row]) == (rows.min(), cols.max())
+            assert np.isfinite(stats['BACKGROUND'][row])
+
+    # A frame flagged as empty is left out of the movie, whose stretch and
+    # crop come from the table
+    stats.columns['NPIXELS'][0] = 0
+    assert stats.valid_filenames(mosaic_fns) == mosaic_fns[1:]
+    assert stats.cut_levels() == (np.median(stats['FLUX_LOW'][1:]),
+                                  np.median(stats['FLUX_HIGH'][1:]))
+    stats_fn = str(tmp_path / 'stats-first-empty.fits')
+    stats.writeto(stats_fn)
+    movie_list = tmp_path / 'mosaics.txt'
+    movie_list.write_text('\n'.join(mosaic_fns))
+    for name, options in [('all', []), ('valid', ['--stats', stats_fn])]:
+        output_fn = str(tmp_path / '{}.gif'.format(name))
+        result = CliRunner().invoke(ui.movie, [str(movie_list), '-o', output_fn] + options)
+        assert result.exit_code == 0, result.output
+        with Image.open(output_fn) as gif:
+            n_frames = gif.n_frames
+        assert n_frames == len(mosaic_fns) - (name == 'valid')
+
+
+def test_statistics_of_later_runs_are_merged(tmp_path, tpf_filenames):
+    filelist = tmp_path / 'tpfs.txt'
+    filelist.write_text('\n'.join(tpf_filenames))
+    output = str(tmp_path / 'k2mosaic-c')
+    stats_fn = str(tmp_path / 'k2mosaic-c05-ch15-stats.fits')
+    for cadences in ['1000..1002', '1002..1005']:
+        result = CliRunner().invoke(ui.k2mosaic, ['mosaic', str(filelist), '-p', '1',
+                                                  '-o', output, '-c', cadences])
+        assert result.exit_code == 0, result.output
+        assert 'Wrote the statistics' in result.output
+    # Cadence 1003 has no data, and 1002 was mosaicked twice
+    stats = FrameStatistics.read(stats_fn)
+    assert list(stats['CADENCENO']) == [1000, 1001, 1002, 1004, 1005]
+    # No statistics are written when no mosaic is made
+    os.remove(stats_fn)
+    result = CliRunner().invoke(ui.k2mosaic, ['mosaic', str(filelist), '-p', '1',
+                                              '-o', output, '-c', '1003'])
+    assert 'Wrote the statistics' not in result.output
+    assert not os.path.exists(stats_fn)
@@ -0,0 +1,46 @@
+import numpy as np
+from click.testing import CliRunner
+from PIL import Image, ImageSequence
+
+from k2mosaic import ui
+from k2mosaic.gif import GifWriter
+
+from .conftest import FIRST_CADENCENO
+
+
+def read_gif(filename):
+    """Returns the (composited) frames of a gif as grayscale arrays, and their durations."""
+    with Image.open(filename) as im:
+        return zip(*[(np.array(frame.convert('L')), frame.info['duration'])
+                     for frame in ImageSequence.Iterator(im)])
+
+
+def test_gif_writer(tmp_path):
+    palette = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+    first = np.arange(48, dtype=np.uint8).reshape(6, 8)
+    second = first.copy()
+    second[2:4, 5] = 200
+    fn = str(tmp_path / 'test.gif')
+    with GifWriter(fn, palette[:255], duration=100, transparent_index=255) as gif:
+        for frame in [first, first, second, first]:
+            gif.append(frame)
+    assert gif.n_frames == 3
+    frames, durations = read_gif(fn)
+    assert list(durations) == [200, 100, 100]  # Repeated frames are merged
+    for frame, expected in zip(frames, [first, second, first]):
+        assert np.array_equal(frame, expected)
+
+
+def test_movie_gif(tmp_path, tpf_filenames):
+    mosaic_fns = [ui.k2mosaic_mosaic_one(cadenceno, tpf_filenames, 5, 15, False,
+                                         output_prefix=str(tmp_path / 'mos-c'))
+                  for cadenceno in [FIRST_CADENCENO, FIRST_CADENCENO + 1]]
+    filelist = tmp_path / 'mosaics.txt'
+    filelist.write_text('\n'.join(mosaic_fns))
+    output = str(tmp_path / 'movie.gif')
+    result = CliRunner().invoke(ui.movie, [str(filelist), '-o', output])
+    assert result.exit_code == 0, result.output
+    frames, _ = read_gif(output)
+    assert len(frames) == 2
+    # Cropped to the data and scaled up to at least 440 pixels wide
+    assert frames[0].shape[1] >= 440
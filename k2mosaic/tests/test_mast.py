@@ -1,4 +1,7 @@
-from k2mosaic import mast
+import pytest
+from click.testing import CliRunner
+
+from k2mosaic import mast, ui
 
 
 def test_kepler_tpf_url():
@@ -11,3 +14,103 @@ def test_k2_tpf_url():
     url = mast.tpf_url('KTWO210854069-C04')
     assert(url == 'https://archive.stsci.edu/missions/k2/target_pixel_files/'
                   'c4/210800000/54000/ktwo210854069-c04_lpd-targ.fits.gz')
+
+
+class _StandInMAST(object):
+    """Local stand-in for the MAST data search API which records the
+    maximum number of requests it served simultaneously."""
+    def __init__(self, delay=0.05):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import urlparse, parse_qs
+        self.active, self.max_active = 0, 0
+        lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                import json
+                import time
+                with lock:
+                    stand_in.active += 1
+                    stand_in.max_active = max(stand_in.max_active, stand_in.active)
+                time.sleep(delay)
+                query = parse_qs(urlparse(self.path).query)
+                campaign = int(query['sci_campaign'][0])
+                channel = int(query['sci_channel'][0])
+                status = 200
+                if channel == 84:  # Pretend there are no data
+                    body = b''
+                elif channel == 83:  # Pretend the service failed
+                    status, body = 500, b'Internal Server Error'
+                else:
+                    body = json.dumps([{'Dataset Name': 'KTWO2108{:02d}{:03d}-C{:02d}'.format(
+                                        campaign, channel, campaign)}]).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with lock:
+                    stand_in.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_get_tpf_urls_bulk(monkeypatch):
+    stand_in = _StandInMAST()
+    monkeypatch.setattr(mast, 'MAST_URL', stand_in.url)
+    try:
+        channels = list(range(70, 83)) + [84]
+        result = mast.get_tpf_urls_bulk(['C4', 'C5'], channels, concurrency=4)
+        # A failed query does not abort the others
+        with pytest.raises(mast.BulkQueryError) as excinfo:
+            mast.get_tpf_urls_bulk(['C5'], [82, 83, 84])
+    finally:
+        stand_in.close()
+    assert list(result.keys()) == [(c, ch) for c in ['C4', 'C5'] for ch in channels]
+    assert result[('C5', 84)] == []
+    assert result[('C4', 70)][0].endswith('/c4/210800000/04000/ktwo210804070-c04_lpd-targ.fits.gz')
+    assert 1 < stand_in.max_active <= 4
+    assert list(excinfo.value.failures.keys()) == [('C5', 83)]
+    assert [len(urls) for urls in excinfo.value.urls.values()] == [1, 0, 0]
+
+
+def test_get_tpf_urls_bulk_in_event_loop(monkeypatch):
+    """The bulk query also works where an event loop runs, e.g. in Jupyter."""
+    import asyncio
+    stand_in = _StandInMAST(delay=0.)
+    monkeypatch.setattr(mast, 'MAST_URL', stand_in.url)
+
+    async def notebook_cell():
+        return mast.get_tpf_urls_bulk(['C4'], [70, 71])
+
+    try:
+        result = asyncio.run(notebook_cell())
+    finally:
+        stand_in.close()
+    assert [len(urls) for urls in result.values()] == [1, 1]
+
+
+def test_tpflist_reports_failed_queries(monkeypatch):
+    stand_in = _StandInMAST(delay=0.)
+    monkeypatch.setattr(mast, 'MAST_URL', stand_in.url)
+    try:
+        result = CliRunner().invoke(ui.tpflist, ['C5', '82..83'])
+    finally:
+        stand_in.close()
+    assert result.exit_code == 1
+    assert result.stdout.strip().endswith('ktwo210805082-c05_lpd-targ.fits.gz')
+    assert 'campaign C5 channel 83 failed' in result.stderr
+    for channel in ['85', '0', '1..90', 'x']:
+        result = CliRunner().invoke(ui.tpflist, ['C5', channel])
+        assert result.exit_code == 2 and 'CHANNEL' in result.output
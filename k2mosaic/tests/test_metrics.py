@@ -0,0 +1,65 @@
+import json
+
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.metrics import MetricsRecorder, run_task
+
+from .conftest import make_tpf, FIRST_CADENCENO
+
+
+def _task(job, raise_errors=False):
+    if job < 0:
+        raise ValueError('negative cadence {}'.format(job))
+    return None if job == 0 else 'mosaic-{}.fits'.format(job)
+
+
+def test_metrics_recorder(tmp_path):
+    jsonl_fn, prom_fn = str(tmp_path / 'run.jsonl'), str(tmp_path / 'run.prom')
+    metrics = MetricsRecorder(jsonl_fn=jsonl_fn, prometheus_fn=prom_fn,
+                              labels={'channel': 15}, interval=0.)
+    metrics.start(n_tasks=4, n_tpfs=10)
+    for job in [1, -2, 0, 3]:
+        metrics.record(run_task(_task, job))
+    metrics.finish()
+    assert metrics.counts == {'done': 2, 'failed': 2}
+    assert [(f['job'], f['type']) for f in metrics.failures] == [(-2, 'ValueError'), (0, None)]
+    events = [json.loads(line) for line in open(jsonl_fn)]
+    assert [e['event'] for e in events][:3] == ['start', 'task', 'progress']
+    end = events[-1]
+    assert end['event'] == 'end' and end['tasks_failed'] == 2 and end['channel'] == '15'
+    assert end['eta'] == 0 and end['tpfs_per_second'] > 0
+    assert 'negative cadence -2' in end['failures'][0]['message']
+    prom = open(prom_fn).read()
+    assert 'k2mosaic_tasks_total{channel="15",status="failed"} 2.0' in prom
+    assert '# TYPE k2mosaic_cadences_per_second gauge' in prom
+    assert "ValueError: negative cadence -2" in metrics.summary()
+
+
+def test_mosaic_exits_nonzero_on_failures(tmp_path):
+    # The second TPF lacks the last six cadences, which therefore fail
+    tpfs = [make_tpf(tmp_path / 'a.fits', 10, 10, 3, 3),
+            make_tpf(tmp_path / 'b.fits', 20, 20, 3, 3, n_cadences=6, seed=1)]
+    filelist = tmp_path / 'filelist.txt'
+    filelist.write_text('\n'.join(tpfs))
+    jsonl_fn = str(tmp_path / 'run.jsonl')
+    result = CliRunner().invoke(
+        ui.mosaic, [str(filelist), '-p', '1', '-o', str(tmp_path / 'k2mosaic-c'),
+                    '--metrics-jsonl', jsonl_fn])
+    assert result.exit_code == 1
+    assert '5 of 11 mosaics written' in result.output
+    assert '6 mosaics failed' in result.output
+    end = [json.loads(line) for line in open(jsonl_fn)][-1]
+    assert sorted(f['job'] for f in end['failures']) == list(range(FIRST_CADENCENO + 6,
+                                                                   FIRST_CADENCENO + 12))
+
+
+def test_unreadable_first_tpf_fails_each_mosaic(tmp_path, tpf_filenames):
+    missing = str(tmp_path / 'missing.fits')
+    metrics = MetricsRecorder(interval=0.)
+    outputs = ui.k2mosaic_mosaic([missing] + tpf_filenames, 'k2', 5, 15,
+                                 [FIRST_CADENCENO, FIRST_CADENCENO + 1], False,
+                                 output_prefix=str(tmp_path / 'k2mosaic-c'), processes=1,
+                                 metrics=metrics)
+    assert outputs == [None, None]
+    assert [f['job'] for f in metrics.failures] == [FIRST_CADENCENO, FIRST_CADENCENO + 1]
@@ -0,0 +1,88 @@
+import gzip
+import os
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+from k2mosaic import mast, ui
+from k2mosaic.geometry import local_path
+from k2mosaic.mirror import MirrorException, MirrorIndex, dataset_name
+
+from .conftest import make_tpf
+
+URL = ('https://archive.stsci.edu/missions/k2/target_pixel_files/c5/211800000/'
+       '12000/ktwo211812000-c05_lpd-targ.fits.gz')
+
+
+@pytest.fixture
+def mirror_root(tmp_path):
+    """A mirror with a gzipped and an uncompressed copy of one TPF, and a second TPF."""
+    root = tmp_path / 'mirror'
+    directory = root / 'c5' / '211800000' / '12000'
+    directory.mkdir(parents=True)
+    fn = make_tpf(directory / 'ktwo211812000-c05_lpd-targ.fits', 10, 10, 3, 3)
+    with open(fn, 'rb') as src, gzip.open(fn + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    make_tpf(root / 'ktwo211812001-c05_lpd-targ.fits.gz', 20, 20, 3, 3, channel=16)
+    (root / 'README.txt').write_text('not a TPF')
+    return root
+
+
+def test_dataset_name():
+    assert dataset_name(URL) == 'ktwo211812000-c05_lpd-targ'
+    assert dataset_name('/data/KTWO211812000-C05_LPD-TARG.FITS') == 'ktwo211812000-c05_lpd-targ'
+    assert dataset_name('tpfs.txt') is None
+
+
+def test_resolve(mirror_root, tmp_path, monkeypatch):
+    index = MirrorIndex(str(mirror_root), index_fn=str(tmp_path / 'index.sqlite'))
+    with pytest.raises(MirrorException):
+        index.resolve(URL)
+    assert index.build() == 2
+    assert len(index) == 2
+    # The uncompressed copy is preferred, whatever the host and directories of the url
+    expected = str(mirror_root / 'c5' / '211800000' / '12000' / 'ktwo211812000-c05_lpd-targ.fits')
+    assert index.resolve(URL) == expected
+    assert index.resolve(URL.replace('https://archive.stsci.edu', 'http://example.org')) == expected
+    assert index.resolve('ktwo211812001-c05_lpd-targ') == str(
+        mirror_root / 'ktwo211812001-c05_lpd-targ.fits.gz')
+    assert 'ktwo211899999-c05_lpd-targ' not in index
+    with pytest.raises(MirrorException):
+        index.find('k2', 5)  # Built without reading the headers
+    # Urls are read from the mirror instead of being downloaded
+    monkeypatch.setenv('K2MOSAIC_MIRROR', str(mirror_root))
+    monkeypatch.setattr('k2mosaic.mirror.DEFAULT_INDEX_DIR', str(tmp_path / 'mirrors'))
+    MirrorIndex(str(mirror_root)).build()
+    assert local_path(URL) == expected
+
+
+def test_find(mirror_root, tmp_path):
+    index = MirrorIndex(str(mirror_root), index_fn=str(tmp_path / 'index.sqlite'))
+    index.build(read_headers=True)
+    assert index.find('k2', 5, channel=15) == [
+        str(mirror_root / 'c5' / '211800000' / '12000' / 'ktwo211812000-c05_lpd-targ.fits')]
+    assert [os.path.basename(fn) for fn in index.find('k2', 5)] == [
+        'ktwo211812000-c05_lpd-targ.fits', 'ktwo211812001-c05_lpd-targ.fits.gz']
+    assert index.find('k2', 5, channel=15, obsmode='SC') == []
+    assert index.find('kepler', 5) == []
+
+
+def test_tpflist_mirror(mirror_root, tmp_path, monkeypatch):
+    monkeypatch.setattr('k2mosaic.mirror.DEFAULT_INDEX_DIR', str(tmp_path / 'mirrors'))
+    MirrorIndex(str(mirror_root)).build(read_headers=True)
+    missing = URL.replace('12000-c05', '12999-c05')
+    monkeypatch.setattr(mast, 'get_tpf_urls', lambda *args, **kwargs: [URL, missing])
+    local = str(mirror_root / 'c5' / '211800000' / '12000' / 'ktwo211812000-c05_lpd-targ.fits')
+    # The TPFs which the mirror lacks are still listed, as urls
+    result = CliRunner().invoke(ui.tpflist, ['C5', '15', '--mirror', str(mirror_root)])
+    assert result.exit_code == 0, result.output
+    assert result.stdout.split() == [local, missing]
+    # Unless MAST is not queried at all
+    monkeypatch.setattr(mast, 'get_tpf_urls', None)
+    result = CliRunner().invoke(ui.tpflist, ['C5', '15', '--mirror', str(mirror_root),
+                                             '--offline'])
+    assert result.exit_code == 0, result.output
+    assert result.stdout.split() == [local]
+    result = CliRunner().invoke(ui.tpflist, ['C5', '15', '--offline'])
+    assert result.exit_code == 2
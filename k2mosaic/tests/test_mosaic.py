@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from k2mosaic import KeplerChannelStack
+from k2mosaic.mosaic import export_ffi_headers, get_ffi_header, WCS_KEYS
+
+from .conftest import FIRST_CADENCENO, make_mosaic
+
+
+@pytest.mark.parametrize("method", ['mean', 'sum', 'median'])
+def test_stack(tmp_path, tpf_filenames, method):
+    # Cadence #3 does not contain data and must be left out of the stack
+    cadences = [FIRST_CADENCENO + i for i in range(2, 6)]
+    stack = KeplerChannelStack(cadences, method=method, campaign=5, channel=15)
+    [stack.add_tpf(tpf) for tpf in tpf_filenames]
+    singles = [make_mosaic(tpf_filenames, cad) for cad in cadences if cad != FIRST_CADENCENO + 3]
+    data = np.array([mos.data for mos in singles])
+    uncert = np.array([mos.uncert for mos in singles])
+    covered = np.isfinite(data[0])
+    expected = {'mean': np.mean, 'sum': np.sum, 'median': np.median}[method](data, axis=0)
+    assert np.allclose(stack.data[covered], expected[covered], rtol=1e-5)
+    assert np.isnan(stack.data[~covered]).all()
+    expected_err = np.sqrt((uncert**2).sum(axis=0))
+    if method == 'mean':
+        expected_err /= 3
+    if method != 'median':
+        assert np.allclose(stack.uncert[covered], expected_err[covered], rtol=1e-5)
+    assert stack.ncadences == 3
+
+    output_fn = str(tmp_path / 'stack.fits')
+    stack.writeto(output_fn)
+    hdr = fits.getheader(output_fn, 1)
+    assert hdr['NCADENCE'] == 3
+    assert hdr['CADENCEL'] == cadences[-1]
+    assert hdr['TSTART'] < singles[0].time < singles[-1].time < hdr['TSTOP']
+
+
+def test_running_median_reference(tpf_filenames):
+    cadences = [FIRST_CADENCENO + i for i in range(12)]
+    exact = KeplerChannelStack(cadences, method='median', campaign=5, channel=15)
+    chunked = KeplerChannelStack(cadences, method='median', chunk_size=4, campaign=5, channel=15)
+    for stack in [exact, chunked]:
+        [stack.add_tpf(tpf) for tpf in tpf_filenames]
+    covered = np.isfinite(exact.data)
+    assert np.array_equal(covered, np.isfinite(chunked.data))
+    # The median of the chunk medians is a close estimate of the median
+    assert np.nanmax(np.abs(exact.data - chunked.data)) < 10.
+    assert np.allclose(exact.uncert[covered], chunked.uncert[covered])
+
+
+def test_subtract_reference(tpf_filenames):
+    mos = make_mosaic(tpf_filenames, FIRST_CADENCENO)
+    data, uncert = mos.data.copy(), mos.uncert.copy()
+    mos.subtract_reference('ref.fits', data, uncert)
+    covered = np.isfinite(data)
+    assert np.allclose(mos.data[covered], 0.)
+    assert np.allclose(mos.uncert[covered], np.sqrt(2) * uncert[covered])
+    mos.add_wcs()
+    assert mos.to_fits()[1].header['DIFFREF'] == 'ref.fits'
+
+
+@pytest.mark.parametrize("compression,quantize_level", [('RICE_1', 16.), ('GZIP_1', 0.)])
+def test_compressed_output(tmp_path, tpf_filenames, compression, quantize_level):
+    import fitsio
+    mos = make_mosaic(tpf_filenames, FIRST_CADENCENO, compression=compression,
+                  quantize_level=quantize_level)
+    output_fn = str(tmp_path / 'compressed.fits')
+    mos.writeto(output_fn)
+    with fits.open(output_fn) as hdulist:
+        assert hdulist[1].header['CADENCEN'] == FIRST_CADENCENO
+        images = [hdulist[1].data, fitsio.read(output_fn, ext=1)]
+    for image in images:
+        assert np.array_equal(np.isnan(image), np.isnan(mos.data))
+        if quantize_level == 0:
+            assert np.array_equal(image, mos.data, equal_nan=True)
+        else:
+            # The quantization step is the noise level divided by quantize_level
+            assert np.nanmax(np.abs(image - mos.data)) < 5.
+
+
+def _make_ffi(filename, campaign, n_channels=3):
+    template = get_ffi_header(campaign=0, channel=1)
+    hdus = [fits.PrimaryHDU()]
+    for channel in range(1, n_channels + 1):
+        hdu = fits.ImageHDU(np.zeros((2, 2), dtype=np.float32))
+        for kw in WCS_KEYS:
+            hdu.header[kw] = template[kw]
+        hdu.header['CHANNEL'] = channel
+        hdu.header['CRVAL1'] = 100. + campaign + channel
+        hdus.append(hdu)
+    hdus.append(fits.ImageHDU())  # e.g. a collateral extension without WCS
+    fits.HDUList(hdus).writeto(filename)
+
+
+def test_export_ffi_headers_incremental(tmp_path):
+    output_fn = str(tmp_path / 'ffi-headers.csv')
+    _make_ffi(str(tmp_path / 'ktwo2014-c01_ffi-cal.fits'), campaign=1)
+    export_ffi_headers(output_fn=output_fn, ffi_store=str(tmp_path), processes=2)
+    before = open(output_fn).read()
+    assert get_ffi_header(1, 3, FFI_HEADERS_FILE=output_fn)['CRVAL1'] == 104.
+    # Only the new FFI is read and appended
+    _make_ffi(str(tmp_path / 'ktwo2015-c02_ffi-cal.fits'), campaign=2)
+    export_ffi_headers(output_fn=output_fn, ffi_store=str(tmp_path), processes=2)
+    after = open(output_fn).read()
+    assert after.startswith(before)
+    assert len(after.splitlines()) == 1 + 2 * 3
+    assert get_ffi_header(2, 2, FFI_HEADERS_FILE=output_fn)['CRVAL1'] == 104.
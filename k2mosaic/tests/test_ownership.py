@@ -0,0 +1,46 @@
+import numpy as np
+
+from k2mosaic.ownership import OwnershipMap, read_ownership
+
+from .conftest import FIRST_CADENCENO, make_mosaic
+
+
+def test_ownership_policies(tmp_path, tpf_filenames):
+    last = OwnershipMap.from_tpfs(tpf_filenames, policy='last')
+    stats = last.stats()
+    # Apertures (100, 200, 5, 6) and (102, 203, 4, 4) share 3 x 3 pixels
+    assert stats['covered_pixels'] == 30 + 16 - 9 + 21
+    assert stats['overlapping_pixels'] == 9 and stats['max_depth'] == 2
+    assert stats['redundant_writes'] == 9
+    assert stats['owned_pixels'] == [21, 16, 21]
+
+    # The 'last' policy reproduces the default mosaic
+    default = make_mosaic(tpf_filenames, FIRST_CADENCENO + 1)
+    owned = make_mosaic(tpf_filenames, FIRST_CADENCENO + 1, ownership=last)
+    np.testing.assert_array_equal(owned.data, default.data)
+    np.testing.assert_array_equal(owned.uncert, default.uncert)
+
+    # The 'first' policy gives the overlap to the first TPF
+    first = OwnershipMap.from_tpfs(tpf_filenames, policy='first')
+    assert first.stats()['owned_pixels'] == [30, 7, 21]
+    mosaic = make_mosaic(tpf_filenames, FIRST_CADENCENO + 1, ownership=first)
+    overlap = np.s_[102:105, 203:206]
+    assert not np.array_equal(mosaic.data[overlap], default.data[overlap])
+    alone = make_mosaic(tpf_filenames[:1], FIRST_CADENCENO + 1)
+    np.testing.assert_array_equal(mosaic.data[overlap], alone.data[overlap])
+
+    # The map survives a round trip through a fits file
+    output_fn = str(tmp_path / 'ownership.fits')
+    first.writeto(output_fn)
+    copy = read_ownership(output_fn)
+    assert copy.policy == 'first' and copy.tpf_filenames == first.tpf_filenames
+    np.testing.assert_array_equal(copy.owner, first.owner)
+    np.testing.assert_array_equal(copy.mask(tpf_filenames[1]), first.mask(1))
+
+
+def test_snr_policy_ignores_the_order(tpf_filenames):
+    forward = OwnershipMap.from_tpfs(tpf_filenames, policy='snr')
+    backward = OwnershipMap.from_tpfs(tpf_filenames[::-1], policy='snr')
+    for fn in tpf_filenames:
+        np.testing.assert_array_equal(forward.mask(fn), backward.mask(fn))
+    assert sum(forward.stats()['owned_pixels']) == forward.stats()['covered_pixels']
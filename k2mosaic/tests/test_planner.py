@@ -0,0 +1,60 @@
+import gzip
+import os
+import shutil
+
+import fitsio
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.planner import plan_cadences, write_quality_index
+
+from .conftest import make_tpf, FIRST_CADENCENO, N_CADENCES
+
+
+def test_plan_drops_empty_and_flagged_cadences(tmp_path):
+    quality = [0] * N_CADENCES
+    quality[5] = 8
+    tpf = make_tpf(tmp_path / 'tpf.fits', 10, 10, 3, 3, quality=quality)
+    cadences = list(range(FIRST_CADENCENO, FIRST_CADENCENO + N_CADENCES))
+    plan = plan_cadences([tpf], cadences + [99999])
+    assert FIRST_CADENCENO + 3 not in plan.kept  # no data
+    assert FIRST_CADENCENO + 5 in plan.kept
+    assert plan.skipped[99999] is None
+    plan = plan_cadences([tpf], cadences, quality_bitmask=8)
+    assert sorted(plan.skipped) == [FIRST_CADENCENO + 3, FIRST_CADENCENO + 5]
+    assert len(plan.kept) == N_CADENCES - 2
+    assert "10 to mosaic, 2 skipped" in plan.summary()
+    # An index file gives the same plan
+    index = str(tmp_path / 'index.csv')
+    write_quality_index(tpf, index)
+    assert plan_cadences([tpf], cadences, quality_bitmask=8, index=index).kept == plan.kept
+
+
+def test_mosaic_dry_run(tmp_path, tpf_filenames):
+    filelist = tmp_path / 'filelist.txt'
+    filelist.write_text('\n'.join(tpf_filenames))
+    result = CliRunner().invoke(ui.mosaic, [str(filelist), '--dry-run'])
+    assert result.exit_code == 0
+    assert 'Cadence plan: 11 to mosaic, 1 skipped' in result.output
+    assert not list(tmp_path.glob('k2mosaic-*.fits'))
+    result = CliRunner().invoke(ui.mosaic, [str(filelist), '--dry-run', '-q', '0x10'])
+    assert result.exit_code == 0
+    for command in [ui.mosaic, ui.plan]:
+        for bitmask in ['foo', '-1']:
+            result = CliRunner().invoke(command, [str(filelist), '--quality-bitmask', bitmask])
+            assert result.exit_code == 2
+            assert "Invalid value for '-q' / '--quality-bitmask'" in result.output
+
+
+def test_plan_estimates_bytes_read(tmp_path):
+    tpf = make_tpf(tmp_path / 'tpf.fits', 10, 10, 3, 3)
+    cadences = list(range(FIRST_CADENCENO, FIRST_CADENCENO + 3))
+    # One table row of the TPF is read per cadence
+    row_bytes = fitsio.read_header(tpf, ext=1)['NAXIS1']
+    assert plan_cadences([tpf], cadences).bytes_read == 3 * row_bytes
+    # but cfitsio reads gzipped TPFs whole
+    with open(tpf, 'rb') as src, gzip.open(tpf + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    assert plan_cadences([tpf, tpf + '.gz'], cadences).bytes_per_cadence == \
+        row_bytes + os.path.getsize(tpf + '.gz')
+    assert plan_cadences([tpf, 'https://example.org/tpf.fits'], cadences).bytes_read is None
@@ -0,0 +1,66 @@
+import numpy as np
+from astropy.io import fits
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.pointing import (PointingTracker, flux_centroids, read_pointing,
+                               track_pointing)
+
+from .conftest import FIRST_CADENCENO, N_CADENCES, make_tpf
+
+# Pointing drift of the synthetic channel, in pixels
+DRIFT = 0.3 * np.sin(np.arange(N_CADENCES) / 2.)
+
+
+def _star(height, width, row, col, flux=5000.):
+    rows, cols = np.mgrid[:height, :width]
+    psf = np.exp(-((rows - row)**2 + (cols - col)**2) / 2.)
+    return flux * psf / psf.sum()
+
+
+def test_flux_centroids():
+    images = np.array([_star(9, 9, 4. + shift, 4. - shift) for shift in [-0.5, 0., 0.5]])
+    images[1, 0, 0] = np.nan
+    row, col, total = flux_centroids(images)
+    np.testing.assert_allclose(row, [3.5, 4., 4.5], atol=1e-3)
+    np.testing.assert_allclose(col, [4.5, 4., 3.5], atol=1e-3)
+    assert np.isnan(flux_centroids(np.zeros((1, 3, 3)))[0][0])
+
+
+def test_pointing_table(tmp_path):
+    tpf_filenames = []
+    for i, (row, col, star_row, star_col) in enumerate([(100, 200, 4.2, 3.9),
+                                                         (500, 700, 3.7, 4.4)]):
+        fn = make_tpf(tmp_path / 'star{}.fits'.format(i), row, col, 9, 9, seed=i)
+        with fits.open(fn, mode='update') as hdulist:
+            for idx, drift in enumerate(DRIFT):
+                hdulist[1].data['FLUX'][idx] = _star(9, 9, star_row + drift, star_col - drift)
+        tpf_filenames.append(fn)
+    # A faint aperture does not contribute
+    tpf_filenames.append(make_tpf(tmp_path / 'faint.fits', 300, 300, 2, 2, seed=5))
+
+    cadenceno = FIRST_CADENCENO + np.arange(N_CADENCES)
+    table = track_pointing(tpf_filenames, PointingTracker(cadenceno)).table()
+    with_data = np.arange(N_CADENCES) != 3  # Cadence #3 does not contain data
+    expected = DRIFT - np.median(DRIFT[with_data])
+    np.testing.assert_allclose(table['ROW_OFFSET'][with_data], expected[with_data], atol=0.02)
+    np.testing.assert_allclose(table['COL_OFFSET'][with_data], -expected[with_data], atol=0.02)
+    assert np.isnan(table['ROW_OFFSET'][3])
+    assert list(table['NAPERTURES']) == [2 if ok else 0 for ok in with_data]
+
+    # The pointing is measured in the same pass as the cosmic rays and
+    # written next to the mosaics
+    filelist = tmp_path / 'tpfs.txt'
+    filelist.write_text('\n'.join(tpf_filenames))
+    result = CliRunner().invoke(ui.k2mosaic, ['mosaic', str(filelist), '-p', '1', '--cadence',
+                                              '{}..{}'.format(FIRST_CADENCENO + 4,
+                                                              FIRST_CADENCENO + 9),
+                                              '--cosmic-rays', '--pointing',
+                                              '-o', str(tmp_path / 'k2mosaic-c')])
+    assert result.exit_code == 0, result.output
+    written = read_pointing(str(tmp_path / 'k2mosaic-c05-ch15-pointing.fits'))
+    assert list(written['CADENCENO']) == list(cadenceno[4:10])
+    # POS_CORR1 of the synthetic TPFs differs; the table has their median
+    assert np.all(np.isfinite(written['POS_CORR1']))
+    drift = DRIFT[4:10] - np.median(DRIFT[4:10])
+    np.testing.assert_allclose(written['ROW_OFFSET'], drift, atol=0.02)
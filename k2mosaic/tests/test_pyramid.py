@@ -0,0 +1,82 @@
+import os
+
+import imageio.v2 as imageio
+import numpy as np
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.pyramid import pyramid_levels, write_pyramid
+
+from .conftest import FIRST_CADENCENO
+
+
+def test_pyramid_levels():
+    image = np.full((10, 7), np.nan)
+    image[1:4, 2:5] = np.arange(9).reshape(3, 3)
+    levels = pyramid_levels(image, zoom=4)
+    # 10 pixels * 4 screen pixels fit in 2**6 pixels, i.e. 7 levels
+    assert len(levels) == 7
+    assert [repeat for _, repeat in levels] == [1, 1, 1, 1, 1, 2, 4]
+    assert levels[-1][0] is image
+    # Block averages ignore NaNs and are exact across levels
+    quarter = levels[2][0]
+    assert quarter.shape == (3, 2)
+    assert quarter[0, 0] == np.mean([0, 1, 3, 4, 6, 7])
+    assert quarter[0, 1] == np.mean([2, 5, 8])
+    assert np.isnan(quarter[2, 0])
+    assert levels[0][0].shape == (1, 1) and levels[0][0][0, 0] == 4.
+
+
+def test_write_pyramid(tmp_path):
+    image = np.full((40, 40), np.nan, dtype=np.float32)
+    image[2:6, 3:9] = np.linspace(10, 1000, 24).reshape(4, 6)
+    base = str(tmp_path / 'frame')
+    n_tiles = write_pyramid(image, base, cut=(10, 1000), zoom=2, tile_size=16)
+    with open(base + '.dzi') as dzi:
+        assert 'Width="80" Height="80"' in dzi.read()
+    # The finest level has 5x5 tiles, but the data only overlap two of them
+    assert sorted(os.listdir(base + '_files/7')) == ['0_4.png', '1_4.png']
+    assert n_tiles == sum(len(files) for _, _, files in os.walk(base + '_files'))
+    tile = imageio.imread(base + '_files/7/0_4.png')
+    assert tile.shape == (16, 16, 4)
+    # Row 2 of the image ends up 4 screen pixels from the bottom of the tile
+    assert tile[-5, 6, 3] == 255 and tile[-4, 6, 3] == 0
+    assert tile[-5, 6, 0] == 0  # Minimum of the stretch is black
+
+
+def test_pyramid_command(tmp_path, tpf_filenames):
+    mosaic_fn = ui.k2mosaic_mosaic_one(FIRST_CADENCENO, tpf_filenames, 5, 15, False,
+                                       output_prefix=str(tmp_path / 'mos-c'))
+    filelist = tmp_path / 'mosaics.txt'
+    filelist.write_text(mosaic_fn)
+    output = str(tmp_path / 'tiles')
+    result = CliRunner().invoke(ui.pyramid, [str(filelist), '-o', output, '--zoom', '4',
+                                             '-r', 'data', '-c', 'data'])
+    assert result.exit_code == 0, result.output
+    assert os.path.exists(os.path.join(output, 'mos-c05-ch15-cad1000.dzi'))
+
+
+def test_write_pyramid_bounds_pending_tiles(tmp_path):
+    """Tiles are written while the pyramid is cut, not all at the end."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    class CountingExecutor(ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super(CountingExecutor, self).__init__(*args, **kwargs)
+            self.submitted, self.max_pending = [], 0
+
+        def submit(self, *args):
+            pending = sum(not future.done() for future in self.submitted)
+            self.max_pending = max(self.max_pending, pending)
+            future = super(CountingExecutor, self).submit(*args)
+            self.submitted.append(future)
+            return future
+
+    image = np.linspace(10, 1000, 40 * 40).reshape(40, 40)
+    base = str(tmp_path / 'frame')
+    with CountingExecutor(max_workers=2) as executor:
+        n_tiles = write_pyramid(image, base, cut=(10, 1000), zoom=2, tile_size=8,
+                                executor=executor, max_pending=3)
+    assert n_tiles == len(executor.submitted) > 3
+    assert executor.max_pending <= 3
+    assert os.path.exists(base + '.dzi')
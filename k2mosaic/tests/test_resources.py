@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from k2mosaic.resources import (ResourceException, ResourcePlan, estimate_task_memory,
+                                plan_resources, run_adaptive)
+
+MB = 1024**2
+
+
+def test_plan_resources(tpf_filenames):
+    task_memory = estimate_task_memory(tpf_filenames)
+    plan = plan_resources(tpf_filenames, n_tasks=100, max_memory=3.5 * task_memory,
+                          max_workers=8)
+    assert plan.workers == 3
+    assert plan.batch_size == 100 // (3 * 4)
+    assert plan.chunk_size is None
+    # Never more workers than tasks
+    assert plan_resources(tpf_filenames, n_tasks=2, max_memory='100G',
+                          max_workers=8).workers == 2
+    with pytest.raises(ResourceException):
+        plan_resources(tpf_filenames, n_tasks=2, max_memory=task_memory // 2)
+
+
+def test_stacks_are_read_in_chunks(tpf_filenames):
+    full = plan_resources(tpf_filenames, n_tasks=4, max_memory='100G', max_workers=2,
+                          bin_size=8)
+    assert full.chunk_size == 8
+    # Two workers only fit if the stacks are read two cadences at a time
+    budget = 2 * estimate_task_memory(tpf_filenames, cadences_read=2)
+    tight = plan_resources(tpf_filenames, n_tasks=4, max_memory=budget, max_workers=2,
+                           bin_size=8)
+    assert tight.chunk_size == 2 and tight.workers == 2
+
+
+def test_adapt():
+    plan = ResourcePlan(workers=4, batch_size=1, chunk_size=None,
+                        task_memory=100 * MB, max_memory=400 * MB)
+    assert plan.concurrency == 4
+    assert plan.adapt(190 * MB) and plan.concurrency == 2
+    assert not plan.adapt(150 * MB)
+    # Concurrency recovers when the workers use less memory again
+    assert plan.adapt(90 * MB) and plan.concurrency == 4
+    assert plan.adapt(1000 * MB) and plan.concurrency == 1
+    # Idle workers hold memory too: 4 x 40MB + 2 x (140MB - 40MB) <= 400MB
+    assert plan.adapt(140 * MB, idle_memory=40 * MB) and plan.concurrency == 2
+    # The largest latest measurement of any worker counts
+    assert not plan.adapt(50 * MB, idle_memory=40 * MB, worker=1)
+    assert plan.adapt(50 * MB, idle_memory=40 * MB) and plan.concurrency == 4
+
+
+def test_peak_rss_is_reset():
+    import numpy as np
+    from k2mosaic.resources import peak_rss, reset_peak_rss
+    np.ones(50 * MB // 8).sum()
+    peak = peak_rss()
+    reset_peak_rss()
+    if not os.path.exists('/proc/self/clear_refs'):
+        pytest.skip('the peak memory can only be reset on Linux')
+    assert peak_rss() < peak
+
+
+def test_run_adaptive(tpf_filenames):
+    plan = plan_resources(tpf_filenames, n_tasks=7, max_memory='100G', max_workers=2)
+    plan.batch_size = 3
+    assert run_adaptive(abs, list(range(-7, 0)), plan) == list(range(7, 0, -1))
+    assert plan.measured_memory > 0
@@ -0,0 +1,75 @@
+import io
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from PIL import Image
+
+from k2mosaic.server import MosaicServer, MosaicService
+
+from .conftest import FIRST_CADENCENO, make_mosaic
+
+
+@pytest.fixture
+def server(tpf_filenames):
+    server = MosaicServer(('127.0.0.1', 0), MosaicService(tpf_filenames), workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _get(server, path):
+    with urlopen(server.url + path) as response:
+        return response.read()
+
+
+def test_server(server, tpf_filenames):
+    cadenceno = FIRST_CADENCENO + 1
+    mosaic = make_mosaic(tpf_filenames, cadenceno)
+    image = fits.getdata(io.BytesIO(_get(server, '/image/{}.fits'.format(cadenceno))))
+    np.testing.assert_array_equal(image, mosaic.data)
+
+    with fits.open(io.BytesIO(_get(server, '/cutout.fits?row=98&col=199&height=8&width=10'
+                                           '&start={}&stop={}'.format(cadenceno, cadenceno + 2)))
+                   ) as cutout:
+        assert cutout['FLUX'].data.shape == (2, 8, 10)
+        np.testing.assert_array_equal(cutout['FLUX'].data[0], mosaic.data[98:106, 199:209])
+        assert list(cutout['CADENCES'].data['CADENCENO']) == [cadenceno, cadenceno + 1]
+
+    png = Image.open(io.BytesIO(_get(server, '/frame/{}.png?row=98&col=199&height=8&width=10'
+                                             .format(cadenceno))))
+    assert png.size == (10, 8)
+
+    with pytest.raises(HTTPError) as error:
+        _get(server, '/image/5.fits')
+    assert error.value.code == 404
+    with pytest.raises(HTTPError) as error:
+        _get(server, '/cutout.fits?row=98')
+    assert error.value.code == 400
+
+    stats = json.loads(_get(server, '/stats'))
+    assert stats['requests']['image'] == dict(stats['requests']['image'], requests=2, errors=1)
+    # The cutout and frame were read from the blocks decoded for the image
+    assert stats['cache']['hits'] > 0
+    assert 'k2mosaic_cache_hit_ratio' in _get(server, '/metrics').decode()
+
+
+def test_oversized_requests_are_refused(server):
+    # Boxes larger than the channel, and too many cadences x pixels
+    for path in ['/frame/1000.png?row=0&col=0&height=100000&width=10',
+                 '/cutout.fits?row=0&col=0&height=10&width=2000']:
+        with pytest.raises(HTTPError) as error:
+            _get(server, path)
+        assert error.value.code == 400
+    server.service.max_pixels = 1000
+    with pytest.raises(HTTPError) as error:
+        _get(server, '/cutout.fits?row=0&col=0&height=10&width=10')
+    assert error.value.code == 400
+    assert len(_get(server, '/cutout.fits?row=0&col=0&height=2&width=2')) > 0
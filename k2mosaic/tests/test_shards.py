@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from click.testing import CliRunner
+
+from k2mosaic import ui
+from k2mosaic.shards import ShardManifest
+
+from .conftest import FIRST_CADENCENO, N_CADENCES
+
+
+def _plan(tmp_path, tpf_filenames, *args):
+    filelist = tmp_path / 'filelist.txt'
+    filelist.write_text('\n'.join(tpf_filenames))
+    manifest = str(tmp_path / 'shards.json')
+    result = CliRunner().invoke(ui.plan, [str(filelist), '-m', manifest,
+                                          '-o', str(tmp_path / 'out' / 'mos-c')] + list(args))
+    assert result.exit_code == 0, result.output
+    return manifest
+
+
+def _run_shards(manifest, shard_ids):
+    """Runs shards in separate processes, as on different nodes."""
+    procs = [subprocess.Popen([sys.executable, '-m', 'k2mosaic.ui', 'run-shard',
+                               manifest, str(shard_id), '-p', '1'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for shard_id in shard_ids]
+    return [proc.wait() for proc in procs]
+
+
+@pytest.mark.parametrize("tpf_groups", ['1', '2'])
+def test_sharded_run_matches_mosaic(tmp_path, tpf_filenames, tpf_groups):
+    os.makedirs(str(tmp_path / 'out'))
+    manifest = _plan(tmp_path, tpf_filenames, '-n', '4', '-g', tpf_groups)
+    shards = ShardManifest.read(manifest)
+    # Cadence #3 has no data, leaving 11 cadences in 3 chunks
+    assert len(shards) == 3 * int(tpf_groups)
+    assert sorted(cad for shard in shards.shards if shard['group'] == 0
+                  for cad in shard['cadences']) == \
+        [FIRST_CADENCENO + i for i in range(N_CADENCES) if i != 3]
+
+    result = CliRunner().invoke(ui.merge, [manifest])
+    assert result.exit_code != 0 and 'have not completed' in result.output
+    assert _run_shards(manifest, range(len(shards))) == [0] * len(shards)
+    result = CliRunner().invoke(ui.merge, [manifest, '--clean'])
+    assert result.exit_code == 0, result.output
+    # The merged shards stay done after their partial mosaics are removed
+    assert shards.pending() == []
+    result = CliRunner().invoke(ui.run_shard, [manifest, '0', '-p', '1'])
+    assert 'already completed' in result.output
+    result = CliRunner().invoke(ui.merge, [manifest, '--clean'])
+    assert result.exit_code == 0, result.output
+
+    for cadenceno in [FIRST_CADENCENO, FIRST_CADENCENO + 7]:
+        expected = ui.k2mosaic_mosaic_one(cadenceno, tpf_filenames, 5, 15, False,
+                                          output_prefix=str(tmp_path / 'direct-c'))
+        merged = str(tmp_path / 'out' / 'mos-c05-ch15-cad{}.fits'.format(cadenceno))
+        for ext in [1, 2]:
+            assert np.array_equal(fits.getdata(merged, ext), fits.getdata(expected, ext),
+                                  equal_nan=True)
+
+
+def test_run_shard_is_idempotent(tmp_path, tpf_filenames):
+    os.makedirs(str(tmp_path / 'out'))
+    manifest = _plan(tmp_path, tpf_filenames, '-n', '6', '-b', '3')
+    shards = ShardManifest.read(manifest)
+    # Shards hold whole bins
+    assert [len(shard['cadences']) for shard in shards.shards] == [6, 5]
+    result = CliRunner().invoke(ui.run_shard, [manifest, '1', '-p', '1'])
+    assert result.exit_code == 0, result.output
+    assert shards.pending() == [0]
+    outputs = shards.outputs(1)
+    mtimes = [os.path.getmtime(fn) for fn in outputs]
+    result = CliRunner().invoke(ui.run_shard, [manifest, '1', '-p', '1'])
+    assert 'already completed' in result.output
+    assert [os.path.getmtime(fn) for fn in outputs] == mtimes
+    # A shard whose output went missing is run again
+    os.remove(outputs[0])
+    assert shards.pending() == [0, 1]
+    with open(shards.marker_fn(1)) as marker:
+        assert json.load(marker)['outputs'] == outputs
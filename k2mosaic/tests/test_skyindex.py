@@ -0,0 +1,47 @@
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from k2mosaic.mosaic import get_ffi_header, WCS_KEYS
+from k2mosaic.skyindex import SkyIndex, build_tpf_index, find_tpfs
+
+
+def test_sipwcs_matches_astropy():
+    index = SkyIndex()
+    idx = np.nonzero((index.campaign == 5) & (index.channel == 13))[0]
+    wcs = index.wcs.subset(idx)
+    header = fits.Header()
+    ffi_header = get_ffi_header(5, 13)
+    for kw in WCS_KEYS:
+        header[kw] = ffi_header[kw]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference = WCS(header)
+    rows, cols = np.array([0., 500., 1069.]), np.array([0., 600., 1131.])
+    ra, dec = reference.all_pix2world(cols, rows, 0)
+    assert np.allclose(wcs.pix2world(rows[:, None], cols[:, None]), [ra[:, None], dec[:, None]],
+                       rtol=0, atol=1e-9)
+    # The inverse SIP polynomials are an approximation to within ~0.01 pixel
+    assert np.allclose(wcs.world2pix(ra[:, None], dec[:, None]), [rows[:, None], cols[:, None]],
+                       rtol=0, atol=0.01)
+
+
+def test_locate_m67():
+    matches = SkyIndex().locate(132.846, 11.814)
+    assert (5, 13) in [(m['campaign'], m['channel']) for m in matches]
+    assert SkyIndex().locate(0., -89.) == []
+
+
+def test_find_tpfs(tpf_filenames):
+    index = SkyIndex()
+    idx = np.nonzero((index.campaign == 5) & (index.channel == 15))[0]
+    # Position of pixel (row=102, col=204), which falls in two overlapping TPFs
+    ra, dec = index.wcs.subset(idx).pix2world(102, 204)
+    matches = [m for m in index.locate(ra[0], dec[0]) if m['campaign'] == 5]
+    assert len(matches) == 1
+    tpf_index = build_tpf_index(tpf_filenames)
+    assert list(find_tpfs(tpf_index, matches)['filename']) == tpf_filenames[:2]
+    # The third TPF lies ~650 pixels away
+    assert len(find_tpfs(tpf_index, matches, radius=2700.)) == 3
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from k2mosaic import SparseChannelMosaic
+from k2mosaic.sparse import (COVERAGE_CACHE_SIZE, CoverageException, CoverageIndex,
+                             read_coverage, read_mosaic_image)
+
+from .conftest import make_mosaic
+
+
+def test_sparse_mosaic_roundtrip(tmp_path, tpf_filenames):
+    coverage_fn = str(tmp_path / 'coverage.fits')
+    coverage = CoverageIndex.from_tpfs(tpf_filenames)
+    coverage.writeto(coverage_fn)
+    # Two of the synthetic apertures overlap
+    assert len(coverage) == 5*6 + 4*4 + 7*3 - 3*3
+
+    dense = make_mosaic(tpf_filenames)
+    sparse = make_mosaic(tpf_filenames, mosaic_class=SparseChannelMosaic, coverage_fn=coverage_fn)
+    assert sparse.data.shape == (len(coverage),)
+    data, uncert = sparse.to_dense()
+    assert np.array_equal(data, dense.data, equal_nan=True)
+    assert np.array_equal(uncert, dense.uncert, equal_nan=True)
+
+    dense_fn, sparse_fn = str(tmp_path / 'dense.fits'), str(tmp_path / 'sparse.fits')
+    dense.writeto(dense_fn)
+    sparse.writeto(sparse_fn)
+    assert os.path.getsize(sparse_fn) < os.path.getsize(dense_fn) / 20
+    for ext in [1, 2]:
+        assert np.array_equal(read_mosaic_image(sparse_fn, ext),
+                              read_mosaic_image(dense_fn, ext), equal_nan=True)
+
+
+def test_coverage_positions_are_checked(tmp_path, tpf_filenames):
+    coverage = CoverageIndex.from_tpfs(tpf_filenames[:1])
+    mask = np.ones((3, 3), dtype=bool)
+    row, col = np.unravel_index(coverage.pixels[0], coverage.shape)
+    assert list(coverage.positions(row, col, mask[:1, :1])) == [0]
+    # A pixel before, inside, or after the covered ones is not found
+    for row, col in [(0, 0), (row, col - 2), (1067, 1129)]:
+        with pytest.raises(CoverageException):
+            coverage.positions(row, col, mask)
+
+
+def test_coverage_cache_is_bounded(tmp_path, tpf_filenames):
+    coverage = CoverageIndex.from_tpfs(tpf_filenames)
+    filenames = [str(tmp_path / 'coverage{}.fits'.format(i))
+                 for i in range(COVERAGE_CACHE_SIZE + 1)]
+    for fn in filenames:
+        coverage.writeto(fn)
+    first = read_coverage(filenames[0])
+    assert read_coverage(filenames[0]) is first
+    for fn in filenames[1:]:
+        read_coverage(fn)
+    assert read_coverage(filenames[0]) is not first
@@ -0,0 +1,50 @@
+"""Guards the cold-start latency of the command-line interface."""
+import subprocess
+import sys
+import time
+
+import k2mosaic
+
+HEAVY_MODULES = ['astropy', 'numpy', 'pandas', 'fitsio', 'matplotlib', 'requests', 'imageio']
+# Importing the CLI takes ~40 ms; the budgets leave ample margin for slow CI machines
+IMPORT_BUDGET = 0.5  # seconds
+HELP_BUDGET = 2.  # seconds
+
+
+def _importtime(statement):
+    """Returns {module: cumulative import time in seconds} for `statement`."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1e6
+    return times
+
+
+def test_cli_import_is_lazy():
+    times = _importtime('import k2mosaic.ui')
+    heavy = [mod for mod in times if mod.split('.')[0] in HEAVY_MODULES]
+    assert heavy == []
+    assert times['k2mosaic.ui'] < IMPORT_BUDGET
+
+
+def test_cli_help_latency():
+    start = time.time()
+    subprocess.run([sys.executable, '-c', 'from k2mosaic.ui import k2mosaic; k2mosaic()', '--help'],
+                   stdout=subprocess.PIPE, check=True)
+    assert time.time() - start < HELP_BUDGET
+
+
+def test_lazy_attributes():
+    assert k2mosaic.KeplerChannelMosaic.__name__ == 'KeplerChannelMosaic'
+    assert callable(k2mosaic.get_ffi_header)
+
+
+def test_star_import():
+    namespace = {}
+    exec('from k2mosaic import *', namespace)
+    assert 'KeplerChannelMosaic' in namespace and 'KEPLER_CHANNEL_SHAPE' in namespace
+    assert 'SparseChannelMosaic' in dir(k2mosaic)
@@ -0,0 +1,130 @@
+import os
+from multiprocessing import Pool
+
+import pytest
+
+from k2mosaic.store import TPFStore, parse_size
+
+
+class _FileServer(object):
+    """Serves the files of a directory over http and counts the requests."""
+    def __init__(self, directory):
+        import functools
+        import threading
+        from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+        self.requests = 0
+        lock = threading.Lock()
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            def do_GET(self):
+                import time
+                with lock:
+                    server.requests += 1
+                time.sleep(0.2)  # Give concurrent clients time to race
+                super(Handler, self).do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          functools.partial(Handler, directory=str(directory)))
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    for i in range(4):
+        (remote / 'tpf{}.fits'.format(i)).write_bytes(bytes([i]) * 1000)
+    server = _FileServer(remote)
+    yield server
+    server.close()
+
+
+def _fetch(args):
+    directory, url = args
+    store = TPFStore(directory)
+    return store.fetch(url), store.misses
+
+
+def test_fetch_and_hit(tmp_path, file_server):
+    store = TPFStore(str(tmp_path / 'store'))
+    url = file_server.url + '/tpf1.fits'
+    assert url not in store
+    path = store.fetch(url)
+    assert open(path, 'rb').read() == bytes([1]) * 1000
+    assert url in store
+    # The same dataset from a mirror is a hit
+    assert store.fetch('https://mirror.example.org/k2/tpf1.fits') == path
+    assert store.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'bytes_downloaded': 1000}
+    assert file_server.requests == 1
+    assert store.fetch('/local/tpf.fits') == '/local/tpf.fits'
+
+
+def test_concurrent_workers_download_once(tmp_path, file_server):
+    directory = str(tmp_path / 'store')
+    TPFStore(directory)
+    url = file_server.url + '/tpf2.fits'
+    with Pool(6) as pool:
+        results = pool.map(_fetch, [(directory, url)] * 6)
+    assert len(set(path for path, _ in results)) == 1
+    assert sum(misses for _, misses in results) == 1
+    assert file_server.requests == 1
+
+
+def test_lru_eviction(tmp_path, file_server):
+    store = TPFStore(str(tmp_path / 'store'), max_bytes=2500)
+    urls = [file_server.url + '/tpf{}.fits'.format(i) for i in range(4)]
+    paths = [store.fetch(url) for url in urls[:2]]
+    store.fetch(urls[0])  # tpf1 is now the least recently used file
+    with pytest.warns(UserWarning, match='K2MOSAIC_STORE_SIZE'):
+        store.fetch(urls[2])  # The three files used do not fit in the store
+    assert store.evictions == 1
+    assert urls[1] not in store and not os.path.exists(paths[1])
+    assert urls[0] in store and os.path.exists(paths[0])
+    assert store.nbytes == 2000
+
+
+def test_pinned_files_are_not_evicted(tmp_path, file_server):
+    directory = str(tmp_path / 'store')
+    store, other = TPFStore(directory, max_bytes=1500), TPFStore(directory, max_bytes=1500)
+    urls = [file_server.url + '/tpf{}.fits'.format(i) for i in range(3)]
+    with store.pinned(urls[0]) as path:
+        # Another process fills the store while the file is being read
+        other.fetch(urls[1])
+        assert other.evictions == 0 and os.path.exists(path)
+        assert open(path, 'rb').read() == bytes([0]) * 1000
+    with pytest.warns(UserWarning):
+        other.fetch(urls[2])
+    assert other.evictions == 2 and not os.path.exists(path)
+    assert other.nbytes == 1000
+    # The lock files of the evicted datasets are removed too
+    assert sorted(os.listdir(os.path.join(directory, 'locks'))) == \
+        sorted(['evict', TPFStore.key(urls[2])])
+    with store.pinned('/local/tpf.fits') as path:
+        assert path == '/local/tpf.fits'
+
+
+def test_store_without_fcntl(tmp_path, file_server, monkeypatch):
+    from k2mosaic import store as store_module
+    monkeypatch.setattr(store_module, 'fcntl', None)
+    store = TPFStore(str(tmp_path / 'store'), max_bytes=1500)
+    urls = [file_server.url + '/tpf{}.fits'.format(i) for i in range(2)]
+    with store.pinned(urls[0]) as path:
+        assert os.path.exists(path)
+    with pytest.warns(UserWarning):
+        store.fetch(urls[1])
+    assert store.evictions == 1 and urls[1] in store
+
+
+def test_parse_size():
+    assert parse_size(1000) == 1000
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5GB') == int(1.5 * 1024**3)
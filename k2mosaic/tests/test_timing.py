@@ -0,0 +1,41 @@
+import numpy as np
+from astropy.time import Time
+
+from k2mosaic import KeplerChannelStack
+from k2mosaic.timing import CadenceTimes
+
+from .conftest import FIRST_CADENCENO, N_CADENCES, make_mosaic
+
+
+def test_cadence_times(tpf_filenames):
+    times = CadenceTimes.from_tpf(tpf_filenames[0])
+    assert len(times) == N_CADENCES
+    row = times.row(FIRST_CADENCENO + 1)
+    # The synthetic TPFs have FRAMETIM 6.54 s, NUM_FRM 270, and BJDREFI 2454833
+    half_frame = 6.54 / 3600. / 24. / 2. * 270
+    assert row['TSTART'] == row['TIME'] - half_frame
+    assert row['MJD-BEG'] == row['TIME'] + 2454833. - half_frame - 2400000.5
+    expected = str(Time(row['MJD-END'], format='mjd').datetime).replace(' ', 'T') + 'Z'
+    assert row['DATE-END'] == expected
+    # Cadence #3 does not contain data
+    assert times.row(FIRST_CADENCENO + 3)['DATE-OBS'] is None
+    assert FIRST_CADENCENO + N_CADENCES not in times
+
+
+def test_mosaics_use_the_table(tpf_filenames):
+    times = CadenceTimes.from_tpf(tpf_filenames[0])
+    cadenceno = FIRST_CADENCENO + 5
+    mosaics = [make_mosaic(tpf_filenames, cadenceno, times=table) for table in [None, times]]
+    without, with_table = [mos.to_fits() for mos in mosaics]
+    for ext in [0, 1]:
+        for keyword in ['DATE-OBS', 'DATE-END', 'MJD-BEG', 'MJD-END', 'TSTART', 'TSTOP',
+                        'MIDTIME', 'QUALITY']:
+            if keyword in without[ext].header:
+                assert with_table[ext].header[keyword] == without[ext].header[keyword]
+
+    stack = KeplerChannelStack([FIRST_CADENCENO + i for i in range(4, 8)],
+                               campaign=5, channel=15, times=times)
+    [stack.add_tpf(tpf) for tpf in tpf_filenames]
+    assert stack.tstart == times.tstart[4] and stack.tstop == times.tstop[7]
+    assert stack.dateobs == times.dateobs[4] and stack.dateend == times.dateend[7]
+    assert np.isclose(stack.time, times.time[4:8].mean())
@@ -0,0 +1,85 @@
+"""Time metadata of every cadence of a channel, computed in one pass.
+
+The header of each mosaic records when its cadence started and ended, in
+BJD-BJDREF (TSTART, TSTOP), as MJD (MJD-BEG, MJD-END), and as UTC dates
+(DATE-OBS, DATE-END).  Converting a single time with `astropy.time.Time`
+costs much more than converting a whole array, so the times of all the
+cadences are derived at once from the TIME column of one TPF, and every
+mosaic or stack of the channel looks its cadences up in the table.
+
+Example usage
+-------------
+times = CadenceTimes.from_tpf(tpf_filenames[0])
+times.row(1000)  # {'TIME': ..., 'TSTART': ..., 'DATE-OBS': '2015-...Z', ...}
+"""
+import numpy as np
+
+MJD_OFFSET = 2400000.5  # JD - MJD
+
+
+class CadenceTimes(object):
+    """Per-cadence time metadata of a channel.
+
+    Parameters
+    ----------
+    cadenceno, time, quality : arrays
+        The CADENCENO, TIME, and QUALITY columns of a TPF.
+
+    frametim, num_frm, bjdrefi : float
+        The FRAMETIM, NUM_FRM, and BJDREFI keywords of the TPF table.
+    """
+    def __init__(self, cadenceno, time, quality, frametim, num_frm, bjdrefi):
+        self.cadenceno = np.asarray(cadenceno)
+        self.time = np.asarray(time, dtype=np.float64)
+        self.quality = np.asarray(quality)
+        half_frame = frametim/3600./24./2. * num_frm
+        self.tstart = self.time - half_frame
+        self.tstop = self.time + half_frame
+        self.mjdbeg = self.time + bjdrefi - half_frame - MJD_OFFSET
+        self.mjdend = self.time + bjdrefi + half_frame - MJD_OFFSET
+        self.dateobs, self.dateend = iso_dates(np.concatenate([self.mjdbeg, self.mjdend])
+                                               ).reshape(2, -1)
+        self._index = {int(cad): i for i, cad in enumerate(self.cadenceno)}
+
+    @classmethod
+    def from_tpf(cls, tpf_filename):
+        """Reads the time columns and keywords of a TPF, which may be a url."""
+        import fitsio
+        from .geometry import pinned_path
+        with pinned_path(tpf_filename) as path, fitsio.FITS(path) as tpf:
+            hdr = tpf[1].read_header()
+            tbl = tpf[1].read(columns=['CADENCENO', 'TIME', 'QUALITY'])
+        return cls(tbl['CADENCENO'], tbl['TIME'], tbl['QUALITY'],
+                   float(hdr['FRAMETIM']), float(hdr['NUM_FRM']), float(hdr['BJDREFI']))
+
+    def __len__(self):
+        return len(self.cadenceno)
+
+    def __contains__(self, cadenceno):
+        return int(cadenceno) in self._index
+
+    def index(self, cadenceno):
+        """Returns the position of a cadence in the table."""
+        return self._index[int(cadenceno)]
+
+    def row(self, cadenceno):
+        """Returns the time metadata of a cadence as a dict of header keywords."""
+        i = self.index(cadenceno)
+        return {'TIME': self.time[i], 'QUALITY': self.quality[i],
+                'TSTART': self.tstart[i], 'TSTOP': self.tstop[i],
+                'MJD-BEG': self.mjdbeg[i], 'MJD-END': self.mjdend[i],
+                'DATE-OBS': self.dateobs[i], 'DATE-END': self.dateend[i]}
+
+
+def iso_dates(mjd):
+    """Converts an array of MJD into ISO 8601 UTC strings, e.g.
+    '2015-04-27T13:12:10.563483Z', with a single `astropy.time.Time` call.
+    Non-finite times (cadences without data) give `None`."""
+    from astropy.time import Time
+    mjd = np.asarray(mjd, dtype=np.float64)
+    dates = np.full(mjd.shape, None, dtype=object)
+    finite = np.isfinite(mjd)
+    if finite.any():
+        dates[finite] = [str(date).replace(' ', 'T') + 'Z'
+                         for date in Time(mjd[finite], format='mjd').datetime]
+    return dates
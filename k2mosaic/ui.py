@@ -1,17 +1,22 @@
 """Implements the k2mosaic command-line interface.
+
+Heavy dependencies (astropy, numpy, requests, ...) are imported inside the
+functions which need them, to keep the start-up time of the CLI short.
 """
-from astropy.io import fits
 import click
-from functools import partial
-import numpy as np
+from functools import partial, lru_cache
 
-from . import mast, __version__, KEPLER_CHANNEL_SHAPE
+from . import __version__, KEPLER_CHANNEL_SHAPE
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+# Maps the --compress choices onto FITS tile compression algorithms
+COMPRESSION_TYPES = {'rice': 'RICE_1', 'gzip': 'GZIP_1', 'gzip2': 'GZIP_2',
+                     'hcompress': 'HCOMPRESS_1'}
 
 
 def _parse_mosaic_request(tpf_filenames, cadence='all', step=10):
     """Parse the campaign/channel/cadence arguments passed to `k2mosaic mosaic`."""
+    from astropy.io import fits
     with fits.open(tpf_filenames[0]) as first_tpf:
         try:
             campaign = first_tpf[0].header['CAMPAIGN']
@@ -53,44 +58,338 @@ def _parse_mosaic_request(tpf_filenames, cadence='all', step=10):
 
 
 def k2mosaic_mosaic(tpf_filenames, mission, campaign, channel, cadencelist, add_background,
-                    output_prefix='', verbose=True, processes=None):
-    """Mosaic a set of TPF files for a set of cadences."""
-    task = partial(k2mosaic_mosaic_one, tpf_filenames=tpf_filenames,
-                   campaign=campaign, channel=channel, add_background=add_background,
-                   output_prefix=output_prefix, verbose=verbose)
-    if processes is None or processes > 1:  # Use parallel processing
-        from multiprocessing import Pool
-        pool = Pool(processes=processes)
-        with click.progressbar(pool.imap(task, cadencelist), label='Mosaicking', show_pos=True) as iterable:
-            [job for job in iterable]
-    else:  # Single process
-        with click.progressbar(cadencelist, label='Mosaicking', show_pos=True) as iterable:
-            [task(job) for job in iterable]
+                    output_prefix='', verbose=True, processes=None,
+                    bin_size=None, bin_method='mean', quality_bitmask=0,
+                    reference_fn=None, coverage_fn=None, compression=None,
+                    quantize_level=16., dither=True, cosmic_ray_fn=None,
+                    clean_cosmic_rays=False, max_memory=None, max_workers=None,
+                    metrics=None, ownership_fn=None, stats_fn=None):
+    """Mosaic a set of TPF files for a set of cadences.
+
+    If `bin_size` is given, consecutive groups of `bin_size` cadences are
+    stacked using `bin_method` and only the stacked mosaics are written.
+    If `reference_fn` is given, the reference mosaic is subtracted from each
+    output mosaic.  If `coverage_fn` is given, sparse mosaics are written.
+    `compression`, `quantize_level`, and `dither` are passed on to
+    `KeplerChannelMosaic`.  If `cosmic_ray_fn` is given, the cosmic rays
+    listed in this file fill the COSMIC_RAY extension of each mosaic,
+    and are subtracted from the image if `clean_cosmic_rays` is set.
+    If `ownership_fn` is given, each pixel is only written by the TPF which
+    owns it in this `k2mosaic.ownership.OwnershipMap`.
+    If `max_memory` is given, the number of processes (at most `max_workers`)
+    and the work sent to each are planned to fit in this memory budget
+    (see `k2mosaic.resources`).  The outcome of every mosaic is added to
+    the `k2mosaic.metrics.MetricsRecorder` given as `metrics`, if any.
+    If `stats_fn` is given, the statistics of every mosaic are written to
+    this `k2mosaic.framestats.FrameStatistics` table, or merged into it if
+    it exists.
+
+    Returns the list of files written, with `None` for failed cadences.
+    """
+    from .metrics import run_task
+    if bin_size is None:
+        task = partial(k2mosaic_mosaic_one, tpf_filenames=tpf_filenames,
+                       campaign=campaign, channel=channel, add_background=add_background,
+                       output_prefix=output_prefix, verbose=verbose,
+                       reference_fn=reference_fn, coverage_fn=coverage_fn,
+                       compression=compression, quantize_level=quantize_level,
+                       dither=dither, cosmic_ray_fn=cosmic_ray_fn,
+                       clean_cosmic_rays=clean_cosmic_rays, ownership_fn=ownership_fn,
+                       statistics=stats_fn is not None)
+    else:
+        task = partial(k2mosaic_stack_one, tpf_filenames=tpf_filenames,
+                       campaign=campaign, channel=channel, add_background=add_background,
+                       method=bin_method, quality_bitmask=quality_bitmask,
+                       output_prefix=output_prefix, verbose=verbose,
+                       reference_fn=reference_fn, compression=compression,
+                       quantize_level=quantize_level, dither=dither,
+                       ownership_fn=ownership_fn, statistics=stats_fn is not None)
+        cadencelist = [cadencelist[i:i + bin_size]
+                       for i in range(0, len(cadencelist), bin_size)]
+    if metrics is not None:
+        metrics.start(n_tasks=len(cadencelist), n_tpfs=len(tpf_filenames))
+    # Compute the time metadata of all cadences once; forked workers inherit the cache
+    try:
+        _cadence_times(tpf_filenames[0])
+    except Exception:
+        pass  # Each mosaic tries again, and records its own failure
+    records = []
+
+    def record(rec):
+        records.append(rec)
+        if metrics is not None:
+            metrics.record(rec)
+
+    if max_memory is not None:
+        from .resources import plan_resources, run_adaptive, ResourceException
+        try:
+            plan = plan_resources(tpf_filenames, len(cadencelist), max_memory,
+                                  max_workers=max_workers or processes, bin_size=bin_size)
+        except ResourceException as e:
+            raise click.ClickException(str(e))
+        click.echo(plan.summary(), err=True)
+        if bin_size is not None:
+            task = partial(task, chunk_size=plan.chunk_size)
+        records = run_adaptive(partial(run_task, task), cadencelist, plan, callback=record)
+    else:
+        processes = max_workers or processes
+        task = partial(run_task, task)
+        if processes is None or processes > 1:  # Use parallel processing
+            from multiprocessing import Pool
+            pool = Pool(processes=processes)
+            with click.progressbar(pool.imap(task, cadencelist), label='Mosaicking',
+                                   show_pos=True) as iterable:
+                [record(rec) for rec in iterable]
+        else:  # Single process
+            with click.progressbar(cadencelist, label='Mosaicking', show_pos=True) as iterable:
+                [record(task(job)) for job in iterable]
+    if metrics is not None:
+        metrics.finish()
+    stats_records = [(rec['output'], rec['statistics']) for rec in records
+                     if rec['statistics'] is not None]
+    if stats_fn is not None and len(stats_records) > 0:
+        import os
+        from .framestats import FrameStatistics
+        stats = FrameStatistics.from_records(stats_records)
+        if os.path.exists(stats_fn):
+            stats = FrameStatistics.read(stats_fn).merge(stats)
+        stats.writeto(stats_fn)
+        click.echo('Wrote the statistics of the mosaics to {}.'.format(stats_fn), err=True)
+    return [rec['output'] for rec in records]
 
 
 def k2mosaic_mosaic_one(cadenceno, tpf_filenames, campaign, channel, add_background,
-                        output_prefix='k2mosaic-c', progressbar=False, verbose=False):
-    """Create a mosaic fits file for one cadence."""
-    from .mosaic import KeplerChannelMosaic
-    output_fn = "{}{:02d}-ch{:02d}-cad{}.fits".format(output_prefix, campaign, channel, cadenceno)
+                        output_prefix='k2mosaic-c', progressbar=False, verbose=False,
+                        reference_fn=None, coverage_fn=None, compression=None,
+                        quantize_level=16., dither=True, cosmic_ray_fn=None,
+                        clean_cosmic_rays=False, raise_errors=False, ownership_fn=None,
+                        statistics=False):
+    """Create a mosaic fits file for one cadence.
+
+    Returns the output filename, or `None` if the mosaic could not be made
+    (the exception is raised instead if `raise_errors` is set).  If
+    `statistics` is set, returns a tuple of the filename and the
+    `KeplerChannelMosaic.statistics` of the mosaic instead."""
+    from .mosaic import KeplerChannelMosaic, SparseChannelMosaic
+    output_fn = "{}{:02d}-ch{:02d}-cad{}{}.fits".format(output_prefix, campaign, channel, cadenceno,
+                                                       '' if reference_fn is None else '-diff')
     if verbose:
         click.echo("\nStarted writing {}".format(output_fn))
-    mosaic = KeplerChannelMosaic(campaign=campaign, channel=channel,
-                                 cadenceno=cadenceno, add_background=add_background)
-
     try:
+        times = _cadence_times(tpf_filenames[0])
+        ownership = _read_ownership(ownership_fn)
+        if coverage_fn is None:
+            mosaic = KeplerChannelMosaic(campaign=campaign, channel=channel,
+                                         cadenceno=cadenceno, add_background=add_background,
+                                         compression=compression,
+                                         quantize_level=quantize_level, dither=dither,
+                                         times=times, ownership=ownership)
+        else:
+            mosaic = SparseChannelMosaic(coverage_fn, campaign=campaign, channel=channel,
+                                         cadenceno=cadenceno, add_background=add_background,
+                                         times=times, ownership=ownership)
         if progressbar:
             with click.progressbar(tpf_filenames, label='Reading TPFs', show_pos=True) as bar:
                 [mosaic.add_tpf(tpf) for tpf in bar]
         else:
             [mosaic.add_tpf(tpf) for tpf in tpf_filenames]
+        if cosmic_ray_fn is not None:
+            from .cosmicrays import cosmic_rays_at
+            mosaic.add_cosmic_rays(*cosmic_rays_at(_read_cosmic_rays(cosmic_ray_fn), cadenceno),
+                                   clean=clean_cosmic_rays)
+        if reference_fn is not None:
+            mosaic.subtract_reference(reference_fn, *_read_reference(reference_fn))
+        mosaic.add_wcs()
+        mosaic.writeto(output_fn)
+        if verbose:
+            click.secho('Finished writing {}'.format(output_fn), fg='green')
+        if statistics:
+            return output_fn, mosaic.statistics()
+        return output_fn
+    except Exception as e:
+        if raise_errors:
+            raise
+        click.secho('{}'.format(e), fg='red')
+
+
+def k2mosaic_stack_one(cadencenos, tpf_filenames, campaign, channel, add_background,
+                       method='mean', quality_bitmask=0, output_prefix='k2mosaic-c',
+                       verbose=False, reference_fn=None, compression=None,
+                       quantize_level=16., dither=True, chunk_size=None, raise_errors=False,
+                       ownership_fn=None, statistics=False):
+    """Create a mosaic fits file stacking a window of cadences.
+
+    Returns the output filename, or `None` if the mosaic could not be made
+    (the exception is raised instead if `raise_errors` is set).  If
+    `statistics` is set, returns a tuple of the filename and the
+    `KeplerChannelMosaic.statistics` of the mosaic instead."""
+    from .mosaic import KeplerChannelStack
+    output_fn = "{}{:02d}-ch{:02d}-cad{}-{}-{}{}.fits".format(
+                    output_prefix, campaign, channel, cadencenos[0], cadencenos[-1], method,
+                    '' if reference_fn is None else '-diff')
+    if verbose:
+        click.echo("\nStarted writing {}".format(output_fn))
+    try:
+        mosaic = KeplerChannelStack(cadencenos, method=method, quality_bitmask=quality_bitmask,
+                                    chunk_size=chunk_size, campaign=campaign, channel=channel,
+                                    add_background=add_background, compression=compression,
+                                    quantize_level=quantize_level, dither=dither,
+                                    times=_cadence_times(tpf_filenames[0]),
+                                    ownership=_read_ownership(ownership_fn))
+        [mosaic.add_tpf(tpf) for tpf in tpf_filenames]
+        if reference_fn is not None:
+            mosaic.subtract_reference(reference_fn, *_read_reference(reference_fn))
         mosaic.add_wcs()
         mosaic.writeto(output_fn)
         if verbose:
             click.secho('Finished writing {}'.format(output_fn), fg='green')
+        if statistics:
+            return output_fn, mosaic.statistics()
+        return output_fn
     except Exception as e:
+        if raise_errors:
+            raise
         click.secho('{}'.format(e), fg='red')
 
+
+def k2mosaic_reference(tpf_filenames, campaign, channel, cadencelist, add_background,
+                       method='median', sample=100, quality_bitmask=0,
+                       output_prefix='k2mosaic-c', ownership_fn=None):
+    """Create a reference mosaic to be subtracted from each cadence.
+
+    With `method='median'` the reference is the median of `sample` cadences
+    spread evenly over `cadencelist`.  With `method='running'` all cadences
+    are used and the reference is the median of the medians of consecutive
+    chunks of `sample` cadences.  Either way, no more than `sample` cadences
+    of a single TPF are held in memory at once.
+    """
+    import numpy as np
+    from .mosaic import KeplerChannelStack
+    output_fn = "{}{:02d}-ch{:02d}-reference.fits".format(output_prefix, campaign, channel)
+    if method == 'median':
+        idx = np.unique(np.linspace(0, len(cadencelist) - 1, sample).astype(int))
+        cadencelist = [cadencelist[i] for i in idx]
+    reference = KeplerChannelStack(cadencelist, method='median', chunk_size=sample,
+                                   quality_bitmask=quality_bitmask,
+                                   campaign=campaign, channel=channel,
+                                   add_background=add_background,
+                                   times=_cadence_times(tpf_filenames[0]),
+                                   ownership=_read_ownership(ownership_fn))
+    with click.progressbar(tpf_filenames, label='Building reference', show_pos=True) as bar:
+        [reference.add_tpf(tpf) for tpf in bar]
+    reference.add_wcs()
+    reference.writeto(output_fn)
+    return output_fn
+
+
+def k2mosaic_coverage(tpf_filenames, campaign, channel, output_prefix='k2mosaic-c'):
+    """Write the index of the pixels covered by a set of TPFs, for sparse mosaics."""
+    from .sparse import CoverageIndex
+    output_fn = "{}{:02d}-ch{:02d}-coverage.fits".format(output_prefix, campaign, channel)
+    coverage = CoverageIndex.from_tpfs(tpf_filenames)
+    coverage.writeto(output_fn)
+    click.echo('Wrote {} ({} pixels, {:.1%} of the channel).'.format(
+               output_fn, len(coverage), coverage.fraction), err=True)
+    return output_fn
+
+
+def k2mosaic_ownership(tpf_filenames, campaign, channel, policy='last',
+                       output_prefix='k2mosaic-c'):
+    """Decide which TPF supplies each pixel where apertures overlap, and save the map."""
+    from .ownership import OwnershipMap
+    output_fn = "{}{:02d}-ch{:02d}-ownership.fits".format(output_prefix, campaign, channel)
+    ownership = OwnershipMap.from_tpfs(tpf_filenames, policy=policy)
+    ownership.writeto(output_fn)
+    click.echo(ownership.summary(), err=True)
+    return output_fn
+
+
+def k2mosaic_cosmic_rays(tpf_filenames, campaign, channel, cadencelist, add_background,
+                         half_window=5, nsigma=5., output_prefix='k2mosaic-c', pointing=None,
+                         ownership_fn=None):
+    """Detect the cosmic rays in a set of TPFs and write them to a table.
+
+    If `ownership_fn` is given, only the pixels which each TPF owns in
+    this `k2mosaic.ownership.OwnershipMap` are searched, so that the events
+    come from the TPFs the mosaics are made of.  If given, the
+    `k2mosaic.pointing.PointingTracker` `pointing` is fed the flux of the
+    TPFs in the same pass."""
+    from .cosmicrays import detect_in_tpf, merge_events, mosaic_masks, write_cosmic_rays
+    output_fn = "{}{:02d}-ch{:02d}-cosmicrays.fits".format(output_prefix, campaign, channel)
+    masks = mosaic_masks(tpf_filenames, ownership=_read_ownership(ownership_fn))
+    events = []
+    with click.progressbar(list(zip(tpf_filenames, masks)), label='Detecting cosmic rays',
+                           show_pos=True) as bar:
+        for tpf_filename, mask in bar:
+            events.append(detect_in_tpf(tpf_filename, half_window=half_window, nsigma=nsigma,
+                                        add_background=add_background, mask=mask,
+                                        cadence_range=(min(cadencelist), max(cadencelist)),
+                                        pointing=pointing))
+    events = merge_events(events)
+    write_cosmic_rays(events, output_fn, half_window=half_window, nsigma=nsigma)
+    click.echo('Wrote {} ({} cosmic rays).'.format(output_fn, len(events['CADENCENO'])),
+               err=True)
+    return output_fn
+
+
+def _pointing_tracker(tpf_filenames, cadencelist):
+    """Returns an empty `PointingTracker` for the cadences of the channel
+    between the first and last of `cadencelist`."""
+    from .pointing import PointingTracker
+    times = _cadence_times(tpf_filenames[0])
+    keep = (times.cadenceno >= min(cadencelist)) & (times.cadenceno <= max(cadencelist))
+    return PointingTracker(times.cadenceno[keep], time=times.time[keep])
+
+
+def k2mosaic_pointing(tpf_filenames, campaign, channel, cadencelist,
+                      output_prefix='k2mosaic-c', tracker=None):
+    """Measure the pointing drift of a channel and write it to a table.
+
+    If `tracker` is given, it has already been fed the TPFs (e.g. by
+    `k2mosaic_cosmic_rays`), and the TPFs are not read again."""
+    from .pointing import track_pointing, write_pointing
+    output_fn = "{}{:02d}-ch{:02d}-pointing.fits".format(output_prefix, campaign, channel)
+    if tracker is None:
+        tracker = _pointing_tracker(tpf_filenames, cadencelist)
+        with click.progressbar(tpf_filenames, label='Tracking the pointing',
+                               show_pos=True) as bar:
+            track_pointing(bar, tracker, cadence_range=(min(cadencelist), max(cadencelist)))
+    table = tracker.table()
+    write_pointing(table, output_fn, min_flux=tracker.min_flux)
+    click.echo('Wrote {} (pointing offsets from up to {} apertures).'.format(
+               output_fn, int(table['NAPERTURES'].max()) if len(table['NAPERTURES']) else 0),
+               err=True)
+    return output_fn
+
+
+@lru_cache(maxsize=1)
+def _read_cosmic_rays(cosmic_ray_fn):
+    """Returns the cosmic ray events of a table, cached per process."""
+    from .cosmicrays import read_cosmic_rays
+    return read_cosmic_rays(cosmic_ray_fn)
+
+
+@lru_cache(maxsize=1)
+def _cadence_times(tpf_filename):
+    """Returns the `CadenceTimes` of the channel of a TPF, cached per process."""
+    from .timing import CadenceTimes
+    return CadenceTimes.from_tpf(tpf_filename)
+
+
+def _read_ownership(ownership_fn):
+    if ownership_fn is None:
+        return None
+    from .ownership import read_ownership
+    return read_ownership(ownership_fn)
+
+
+@lru_cache(maxsize=1)
+def _read_reference(reference_fn):
+    """Returns the image and uncertainty of a reference mosaic, cached per process."""
+    from .sparse import read_mosaic_image
+    return read_mosaic_image(reference_fn, 1), read_mosaic_image(reference_fn, 2)
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(version=__version__)
 def k2mosaic(**kwargs):
@@ -99,59 +398,575 @@ def k2mosaic(**kwargs):
 
 @k2mosaic.command(name='tpflist', short_help='List all target pixel files for a given campaign & CCD channel.')
 @click.argument('campaign', type=str)
-@click.argument('channel', type=click.IntRange(0, 84))
+@click.argument('channel', type=str)
 @click.option('--sc/--lc', is_flag=True,
               help='Short cadence or long cadence? (default: lc)')
 @click.option('--wget', is_flag=True,
               help='Output the wget commands to obtain the files')
-def tpflist(campaign, channel, sc, wget):
+@click.option('-j', '--concurrency', type=click.IntRange(min=1), default=8,
+              metavar='<N>',
+              help='Maximum number of simultaneous MAST queries (default: 8)')
+@click.option('--mirror', type=click.Path(exists=True, file_okay=False), default=None,
+              envvar='K2MOSAIC_MIRROR',
+              help='Local archive mirror indexed with `k2mosaic mirror`; '
+                   'print the paths of the files it holds instead of their urls')
+@click.option('--offline', is_flag=True,
+              help='Only list the files of the --mirror, without querying MAST; '
+                   'needs an index built with `k2mosaic mirror --headers`')
+def tpflist(campaign, channel, sc, wget, concurrency, mirror, offline):
     """Prints the Target Pixel File URLS for a given CAMPAIGN/QUARTER and ccd CHANNEL.
 
     CAMPAIGN can refer to a K2 Campaign (e.g. 'C4') or a Kepler Quarter (e.g. 'Q4').
+    Several campaigns can be given as a list or range, e.g. 'C4,C5' or 'C1..C5'.
+
+    CHANNEL can be a single channel (e.g. '13'), a list or range
+    (e.g. '13,14' or '1..84'), or 'all'.
+
+    With --offline, the TPFs which are not in the mirror are not listed.
     """
+    from . import mast
+    campaigns = _parse_list(campaign)
+    if channel.strip() == 'all':
+        channels = list(range(1, 85))
+    else:
+        channels = _parse_list(channel, bounds=(1, 84), param_hint="'CHANNEL'")
+    if offline and mirror is None:
+        raise click.UsageError('--offline needs a --mirror')
+    mirror_index = None
+    if mirror is not None:
+        from .mirror import MirrorIndex
+        mirror_index = MirrorIndex(mirror)
+        if not mirror_index.exists:
+            click.echo('Warning: {} has not been indexed yet, '
+                       'see `k2mosaic mirror`.'.format(mirror), err=True)
+            mirror_index = None
+    if offline:
+        if mirror_index is None or not mirror_index.has_headers:
+            raise click.UsageError('--offline needs a mirror indexed with '
+                                   '`k2mosaic mirror --headers`')
+        # The index knows the campaign and channel of every file it holds,
+        # but not of the files missing from the mirror
+        paths = [path for campaign_ in campaigns for ch in channels
+                 for path in mirror_index.find(*mast.parse_campaign(campaign_), channel=ch,
+                                               obsmode='SC' if sc else 'LC')]
+        click.echo('Mirror {}: {} files found (MAST not queried).'.format(
+                   mirror_index.root, len(paths)), err=True)
+        print('\n'.join(paths))
+        return
+    failures = {}
     try:
-        urls = mast.get_tpf_urls(campaign, channel=channel, short_cadence=sc)
+        if len(campaigns) == 1 and len(channels) == 1:
+            urls = mast.get_tpf_urls(campaigns[0], channel=channels[0], short_cadence=sc)
+        else:
+            try:
+                results = mast.get_tpf_urls_bulk(campaigns, channels, short_cadence=sc,
+                                                 concurrency=concurrency)
+            except mast.BulkQueryError as e:
+                results, failures = e.urls, e.failures
+            urls = [url for result in results.values() for url in result]
+        if len(urls) == 0 and len(failures) == 0:
+            raise mast.NoDataFoundException("Error: no data found for these parameters.")
+        _echo_store_stats(urls)
+        paths = [None] * len(urls)
+        if mirror_index is not None:
+            paths = [mirror_index.resolve(url) for url in urls]
+            click.echo('Mirror {}: {} of {} files found.'.format(
+                       mirror_index.root, sum(path is not None for path in paths), len(urls)),
+                       err=True)
         if wget:
             WGET_CMD = 'wget -nH --cut-dirs=6 -c -N '
-            print('\n'.join([WGET_CMD + url for url in urls]))
+            print('\n'.join([WGET_CMD + url for url, path in zip(urls, paths) if path is None]))
         else:
-            print('\n'.join(urls))
+            print('\n'.join([path or url for url, path in zip(urls, paths)]))
     except mast.NoDataFoundException as e:
         click.echo(e)
+    except mast.ApiError as e:
+        failures[(campaigns[0], channels[0])] = e
+    if len(failures) > 0:
+        # The list is incomplete: say which queries are missing from it
+        for (campaign_, ch), error in failures.items():
+            click.secho('Error: the MAST query of campaign {} channel {} failed ({}).'.format(
+                        campaign_, ch, error), fg='red', err=True)
+        raise SystemExit(1)
 
 
-@k2mosaic.command()
-@click.argument('filelist', type=click.File('r'))
-@click.option('-c', '--cadence', type=str,
-              default=None, metavar='cadenceno1..cadenceno2',
-              help='Cadence number range (default: all).')
-@click.option('-s', '--step', type=click.IntRange(min=1),
-              default=1, metavar='<N>',
-              help='Only mosaic every Nth cadence (default: 1).')
-@click.option('--add-background', is_flag=True,
-              help='Add the background flux to the images')
-@click.option('-p', '--processes', type=click.IntRange(min=1),
-              default=None, metavar='<CPUs>',
-              help='Number of processes to use (default: #CPUs)')
-@click.option('-o', '--output', type=str, default=None,
-              help='output filename prefix (default: k2mosaic-[cq])')
-def mosaic(filelist, cadence, step, add_background, processes, output):
-    """Mosaic a list of target pixel files."""
-    tpf_filenames = [path.strip() for path in filelist.read().splitlines()]
+def _echo_store_stats(urls):
+    """Reports how many of the urls are already in the local TPF store, if any."""
+    import os
+    from .store import DEFAULT_STORE_DIR
+    if not os.path.isdir(os.getenv('K2MOSAIC_STORE', DEFAULT_STORE_DIR)):
+        return
+    from .store import default_store
+    store = default_store()
+    n_stored = sum(url in store for url in urls)
+    click.echo('TPF store {}: {} hits, {} misses.'.format(
+               store.directory, n_stored, len(urls) - n_stored), err=True)
+
+
+def _parse_list(spec, bounds=None, param_hint=None):
+    """Expands a list such as '1,3..5' or 'C1..C3' into ['1', '3', '4', '5'] or
+    ['C1', 'C2', 'C3'].
+
+    If `bounds` is given, the items are integers which must lie in the
+    (min, max) range; `click.BadParameter` is raised otherwise."""
+    items = []
+    try:
+        for item in spec.split(','):
+            item = item.strip()
+            if '..' in item:
+                start, stop = item.split('..')
+                prefix = start.rstrip('0123456789')
+                for number in range(int(start[len(prefix):]), int(stop.lstrip(prefix)) + 1):
+                    items.append('{}{}'.format(prefix, number))
+            else:
+                items.append(item)
+        if bounds is not None:
+            items = [int(item) for item in items]
+    except ValueError:
+        raise click.BadParameter('{!r} is not a valid list or range.'.format(spec),
+                                 param_hint=param_hint)
+    if bounds is not None:
+        outside = [item for item in items if not bounds[0] <= item <= bounds[1]]
+        if len(outside) > 0:
+            raise click.BadParameter('{} is not in the range {}..{}.'.format(
+                                     outside[0], *bounds), param_hint=param_hint)
+    return items
+
+
+@k2mosaic.command(short_help='Index a local mirror of the TPF archive.')
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--headers', is_flag=True,
+              help='Also record the campaign and channel of every file, so that '
+                   '`tpflist --mirror --offline` does not need to query MAST (slower)')
+def mirror(root, headers):
+    """Walks ROOT, a local copy of (part of) the MAST target pixel file
+    archive, and indexes the files it contains.
+
+    Afterwards, urls are resolved to files in the mirror without walking
+    it again.  Set K2MOSAIC_MIRROR to ROOT to make all commands read TPF
+    urls from the mirror; run this command again when the mirror changes.
+    """
+    from .mirror import MirrorIndex
+    index = MirrorIndex(root)
+    n_files = index.build(read_headers=headers)
+    click.echo('Indexed {} target pixel files in {}.'.format(n_files, index.index_fn))
+
+
+@k2mosaic.command(short_help='List the campaigns, channels, and TPFs covering a sky position.')
+@click.argument('ra', type=float)
+@click.argument('dec', type=float)
+@click.option('-r', '--radius', type=click.FloatRange(min=0), default=0., metavar='<arcsec>',
+              help='Search radius in arcsec (default: 0)')
+@click.option('--tpfs', type=click.Path(exists=True), default=None,
+              help='csv index or list of TPFs in which to look for the position')
+def locate(ra, dec, radius, tpfs):
+    """Prints the campaigns and channels which contain the sky position RA DEC.
+
+    RA and DEC are in decimal degrees; put '--' in front of them if
+    DEC is negative.  The pixel position is zero-based (row, col).
+    """
+    from .skyindex import SkyIndex, build_tpf_index, find_tpfs
+    matches = SkyIndex().locate(ra, dec, radius=radius)
+    if len(matches) == 0:
+        click.echo('No campaign observed this position.')
+        return
+    click.echo('campaign,channel,row,col')
+    for match in matches:
+        click.echo('{campaign},{channel},{row:.1f},{col:.1f}'.format(**match))
+    if tpfs is not None:
+        if tpfs.endswith('.csv'):
+            import pandas as pd
+            tpf_index = pd.read_csv(tpfs)
+        else:
+            with open(tpfs) as filelist:
+                tpf_index = build_tpf_index([path.strip() for path in filelist.read().splitlines()])
+        click.echo('\nTarget pixel files within {} arcsec:'.format(radius))
+        for filename in find_tpfs(tpf_index, matches, radius=radius)['filename']:
+            click.echo(filename)
+
+
+def _parse_bitmask(ctx, param, value):
+    """Converts a decimal or hexadecimal (0x...) bitmask into an int."""
+    try:
+        bitmask = int(value, 0)
+    except ValueError:
+        raise click.BadParameter('{!r} is not a decimal or hexadecimal integer.'.format(value))
+    if bitmask < 0:
+        raise click.BadParameter('{!r} is negative.'.format(value))
+    return bitmask
+
+
+def _mosaic_options(func):
+    """Adds the options shared by `k2mosaic mosaic` and `k2mosaic plan`."""
+    options = [
+        click.option('-c', '--cadence', type=str,
+                     default=None, metavar='cadenceno1..cadenceno2',
+                     help='Cadence number range (default: all).'),
+        click.option('-s', '--step', type=click.IntRange(min=1),
+                     default=1, metavar='<N>',
+                     help='Only mosaic every Nth cadence (default: 1).'),
+        click.option('--add-background', is_flag=True,
+                     help='Add the background flux to the images'),
+        click.option('-o', '--output', type=str, default=None,
+                     help='output filename prefix (default: k2mosaic-[cq])'),
+        click.option('-q', '--quality-bitmask', type=str, default='0', metavar='<bitmask>',
+                     callback=_parse_bitmask,
+                     help='Skip cadences with any of these QUALITY bits set, '
+                          'e.g. 1130799 or 0x1141ff (default: 0, i.e. only '
+                          'skip cadences without data)'),
+        click.option('-b', '--bin', 'bin_size', type=click.IntRange(min=1),
+                     default=None, metavar='<N>',
+                     help='Stack every N good cadences into a single mosaic'),
+        click.option('--bin-method', type=click.Choice(['mean', 'sum', 'median']),
+                     default='mean', help='How to stack the binned cadences (default: mean)'),
+        click.option('-d', '--difference', is_flag=True,
+                     help='Subtract a reference image from each mosaic'),
+        click.option('--reference-method', type=click.Choice(['median', 'running']),
+                     default='median',
+                     help='Build the reference from the median of a sample of cadences, '
+                          'or from a running median over all cadences (default: median)'),
+        click.option('--reference-sample', type=click.IntRange(min=1), default=100,
+                     metavar='<N>',
+                     help='Number of cadences sampled, or read at once, to build '
+                          'the reference (default: 100)'),
+        click.option('--sparse', is_flag=True,
+                     help='Only store the pixels covered by the TPFs, '
+                          'listed once in a separate coverage index file'),
+        click.option('--compress', type=click.Choice(sorted(COMPRESSION_TYPES)), default=None,
+                     help='Write tile-compressed image extensions (default: no compression)'),
+        click.option('--quantize-level', type=float, default=16., metavar='<Q>',
+                     help='Quantization level of compressed images; higher is more accurate, '
+                          '0 is lossless with gzip (default: 16)'),
+        click.option('--dither/--no-dither', default=True,
+                     help='Dither the quantization of compressed images (default: dither)'),
+        click.option('--overlap', type=click.Choice(['first', 'last', 'snr']), default=None,
+                     help='Where apertures overlap, take each pixel from only one TPF: '
+                          'the first or last in the list, or the one with the highest '
+                          'signal-to-noise ratio (default: the last TPF overwrites the others)'),
+        click.option('--cosmic-rays', is_flag=True,
+                     help='Detect cosmic rays and list them in the COSMIC_RAY extension'),
+        click.option('--clean-cosmic-rays', is_flag=True,
+                     help='Also remove the detected cosmic rays from the images '
+                          '(implies --cosmic-rays)'),
+        click.option('--cr-window', type=click.IntRange(min=1), default=5, metavar='<N>',
+                     help='Compare each cadence with the median of the N cadences '
+                          'on either side to detect cosmic rays (default: 5)'),
+        click.option('--cr-threshold', type=float, default=5., metavar='<sigma>',
+                     help='Cosmic ray detection threshold (default: 5)'),
+        click.option('--pointing', is_flag=True,
+                     help='Measure the pointing drift of the channel from the centroids '
+                          'of the bright apertures, in the same pass as --cosmic-rays'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _resource_options(func):
+    """Adds the memory budget options of `k2mosaic mosaic` and `k2mosaic run-shard`."""
+    func = click.option('--max-workers', type=click.IntRange(min=1), default=None,
+                        metavar='<N>',
+                        help='Maximum number of processes (default: --processes, or #CPUs)')(func)
+    func = click.option('--max-memory', type=str, default=None, metavar='<size>',
+                        help='Memory budget, e.g. 8G; the number of processes and the '
+                             'work sent to each are chosen to fit in it, and adapted to '
+                             'the memory the processes are measured to use')(func)
+    return func
+
+
+def _metrics_options(func):
+    """Adds the metrics options of `k2mosaic mosaic` and `k2mosaic run-shard`."""
+    func = click.option('--metrics-prom', type=click.Path(dir_okay=False), default=None,
+                        help='Prometheus textfile to keep up to date with the '
+                             'progress and throughput metrics')(func)
+    func = click.option('--metrics-jsonl', type=click.Path(dir_okay=False), default=None,
+                        help='File to append JSON-lines progress, throughput, and '
+                             'failure events to')(func)
+    return func
+
+
+def _make_metrics(job, metrics_jsonl, metrics_prom):
+    from .metrics import MetricsRecorder
+    return MetricsRecorder(jsonl_fn=metrics_jsonl, prometheus_fn=metrics_prom,
+                           labels={'campaign': job['campaign'], 'channel': job['channel']})
+
+
+def _exit_on_failures(metrics):
+    """Prints the summary of a run, exiting with status 1 if any mosaics failed."""
+    if metrics.failures:
+        click.secho(metrics.summary(), fg='red', err=True)
+        raise SystemExit(1)
+    click.echo(metrics.summary(), err=True)
+
+
+def _prepare_job(tpf_filenames, cadence, step, add_background, output, quality_bitmask,
+                 bin_size, sparse, compress, difference=False, reference_fn=None,
+                 reference_method='median', reference_sample=100, quality_index=None,
+                 cosmic_rays=False, cr_window=5, cr_threshold=5., overlap=None,
+                 pointing=False, dry_run=False):
+    """Plans the cadences of a list of TPFs and builds the reference,
+    coverage, cosmic ray, and pointing files they need.
+
+    Returns a dict with keys mission, campaign, channel, tpf_filenames,
+    cadences, output_prefix, reference_fn, coverage_fn, cosmic_ray_fn,
+    ownership_fn, and pointing_fn, or `None` if `dry_run` is set.
+    """
     if tpf_filenames[0].endswith('gz'):
         click.secho('Warning: some of your TPFs are gzip-compressed. '
                     'K2mosaic will perform much faster if you decompress them first.',
                     fg='yellow')
+    if sparse and bin_size is not None:
+        raise click.UsageError('--sparse cannot be combined with --bin')
+    if sparse and compress is not None:
+        raise click.UsageError('--sparse cannot be combined with --compress')
+    if cosmic_rays and bin_size is not None:
+        raise click.UsageError('--cosmic-rays cannot be combined with --bin')
     # Parse the requested cadences
     mission, campaign, channel, cadencelist = \
         _parse_mosaic_request(tpf_filenames, cadence=cadence, step=step)
+    # Drop the cadences without data before doing any work
+    from .planner import plan_cadences
+    plan = plan_cadences(tpf_filenames, cadencelist,
+                         quality_bitmask=quality_bitmask, index=quality_index)
+    click.echo(plan.summary(), err=True)
+    if dry_run:
+        return None
     if output is None:
         if mission == 'k2':
             output = 'k2mosaic-c'
         else:
             output = 'k2mosaic-q'
-    k2mosaic_mosaic(tpf_filenames, mission, campaign, channel, cadencelist, add_background,
-                    output_prefix=output, processes=processes)
+    ownership_fn = None
+    if overlap is not None:
+        ownership_fn = k2mosaic_ownership(tpf_filenames, campaign, channel, policy=overlap,
+                                          output_prefix=output)
+    if difference and reference_fn is None:
+        reference_fn = k2mosaic_reference(tpf_filenames, campaign, channel, plan.kept,
+                                          add_background, method=reference_method,
+                                          sample=reference_sample,
+                                          quality_bitmask=quality_bitmask,
+                                          output_prefix=output, ownership_fn=ownership_fn)
+    coverage_fn = None
+    if sparse:
+        coverage_fn = k2mosaic_coverage(tpf_filenames, campaign, channel, output_prefix=output)
+    cosmic_ray_fn, pointing_fn, tracker = None, None, None
+    if cosmic_rays and len(plan.kept) > 0:
+        if pointing:
+            tracker = _pointing_tracker(tpf_filenames, plan.kept)
+        cosmic_ray_fn = k2mosaic_cosmic_rays(tpf_filenames, campaign, channel, plan.kept,
+                                             add_background, half_window=cr_window,
+                                             nsigma=cr_threshold, output_prefix=output,
+                                             pointing=tracker, ownership_fn=ownership_fn)
+    if pointing and len(plan.kept) > 0:
+        pointing_fn = k2mosaic_pointing(tpf_filenames, campaign, channel, plan.kept,
+                                        output_prefix=output, tracker=tracker)
+    return {'mission': mission, 'campaign': int(campaign), 'channel': int(channel),
+            'tpf_filenames': tpf_filenames, 'cadences': plan.kept, 'output_prefix': output,
+            'reference_fn': reference_fn, 'coverage_fn': coverage_fn,
+            'cosmic_ray_fn': cosmic_ray_fn, 'ownership_fn': ownership_fn,
+            'pointing_fn': pointing_fn}
+
+
+@k2mosaic.command()
+@click.argument('filelist', type=click.File('r'))
+@_mosaic_options
+@click.option('-p', '--processes', type=click.IntRange(min=1),
+              default=None, metavar='<CPUs>',
+              help='Number of processes to use (default: #CPUs)')
+@click.option('--quality-index', type=click.Path(exists=True), default=None,
+              help='csv file with CADENCENO/QUALITY columns to plan the '
+                   'cadences with (default: read the first TPF)')
+@click.option('--dry-run', is_flag=True,
+              help='Print the cadence plan without mosaicking')
+@click.option('--reference', 'reference_fn', type=click.Path(exists=True), default=None,
+              help='Reference mosaic to subtract (implies --difference)')
+@_resource_options
+@_metrics_options
+def mosaic(filelist, cadence, step, add_background, output, quality_bitmask,
+           bin_size, bin_method, difference, reference_method, reference_sample,
+           sparse, compress, quantize_level, dither, overlap, cosmic_rays, clean_cosmic_rays,
+           cr_window, cr_threshold, pointing, processes, quality_index, dry_run, reference_fn,
+           max_memory, max_workers, metrics_jsonl, metrics_prom):
+    """Mosaic a list of target pixel files.
+
+    The exit code is non-zero if any of the mosaics could not be made."""
+    tpf_filenames = [path.strip() for path in filelist.read().splitlines()]
+    job = _prepare_job(tpf_filenames, cadence, step, add_background, output, quality_bitmask,
+                       bin_size, sparse, compress, difference=difference,
+                       reference_fn=reference_fn, reference_method=reference_method,
+                       reference_sample=reference_sample, quality_index=quality_index,
+                       cosmic_rays=cosmic_rays or clean_cosmic_rays, cr_window=cr_window,
+                       cr_threshold=cr_threshold, overlap=overlap, pointing=pointing,
+                       dry_run=dry_run)
+    if job is None:
+        return
+    metrics = _make_metrics(job, metrics_jsonl, metrics_prom)
+    stats_fn = "{}{:02d}-ch{:02d}-stats.fits".format(job['output_prefix'], job['campaign'],
+                                                   job['channel'])
+    k2mosaic_mosaic(tpf_filenames, job['mission'], job['campaign'], job['channel'],
+                    job['cadences'], add_background,
+                    output_prefix=job['output_prefix'], processes=processes,
+                    bin_size=bin_size, bin_method=bin_method, quality_bitmask=quality_bitmask,
+                    reference_fn=job['reference_fn'], coverage_fn=job['coverage_fn'],
+                    compression=COMPRESSION_TYPES.get(compress),
+                    quantize_level=quantize_level, dither=dither,
+                    cosmic_ray_fn=job['cosmic_ray_fn'], clean_cosmic_rays=clean_cosmic_rays,
+                    max_memory=max_memory, max_workers=max_workers, metrics=metrics,
+                    ownership_fn=job['ownership_fn'], stats_fn=stats_fn)
+    _exit_on_failures(metrics)
+
+
+@k2mosaic.command(short_help='Split mosaicking work into shards for many machines.')
+@click.argument('filelists', nargs=-1, required=True, type=click.File('r'))
+@_mosaic_options
+@click.option('-m', '--manifest', type=click.Path(), default='k2mosaic-shards.json',
+              help='Shard manifest to write (default: k2mosaic-shards.json)')
+@click.option('-w', '--workdir', type=click.Path(), default=None,
+              help='Shared directory for completion markers and partial mosaics '
+                   '(default: the manifest name without .json, plus -work)')
+@click.option('-n', '--cadences-per-shard', type=click.IntRange(min=1), default=100,
+              metavar='<N>', help='Number of cadences per shard (default: 100)')
+@click.option('-g', '--tpf-groups', type=click.IntRange(min=1), default=1, metavar='<N>',
+              help='Split the TPFs of each channel into N groups whose partial '
+                   'mosaics are combined by `k2mosaic merge` (default: 1)')
+def plan(filelists, cadence, step, add_background, output, quality_bitmask,
+         bin_size, bin_method, difference, reference_method, reference_sample,
+         sparse, compress, quantize_level, dither, overlap, cosmic_rays, clean_cosmic_rays,
+         cr_window, cr_threshold, pointing, manifest, workdir, cadences_per_shard, tpf_groups):
+    """Write a manifest splitting the mosaics of one or more FILELISTS into shards.
+
+    Each FILELIST lists the target pixel files of one channel.  The shards
+    can then be executed on any machine sharing the filesystem using
+    `k2mosaic run-shard MANIFEST ID`, and finally checked and combined using
+    `k2mosaic merge MANIFEST`.  Reference images (--difference), coverage
+    indices (--sparse), cosmic ray tables (--cosmic-rays), and pointing
+    tables (--pointing) are built while planning.
+    """
+    import os
+    from .shards import ShardManifest
+    jobs = []
+    for filelist in filelists:
+        tpf_filenames = [path.strip() for path in filelist.read().splitlines()]
+        # Shards may run in another working directory
+        tpf_filenames = [fn if fn.startswith('http') else os.path.abspath(fn)
+                         for fn in tpf_filenames]
+        job = _prepare_job(tpf_filenames, cadence, step, add_background,
+                           None if output is None else os.path.abspath(output),
+                           quality_bitmask, bin_size, sparse, compress,
+                           difference=difference, reference_method=reference_method,
+                           reference_sample=reference_sample,
+                           cosmic_rays=cosmic_rays or clean_cosmic_rays,
+                           cr_window=cr_window, cr_threshold=cr_threshold, overlap=overlap,
+                           pointing=pointing)
+        for key in ['output_prefix', 'reference_fn', 'coverage_fn', 'cosmic_ray_fn',
+                    'ownership_fn', 'pointing_fn']:
+            if job[key] is not None:
+                job[key] = os.path.abspath(job[key])
+        jobs.append(job)
+    if workdir is None:
+        workdir = os.path.splitext(manifest)[0] + '-work'
+    options = {'add_background': add_background, 'bin_size': bin_size,
+               'bin_method': bin_method, 'quality_bitmask': quality_bitmask,
+               'compression': COMPRESSION_TYPES.get(compress),
+               'quantize_level': quantize_level, 'dither': dither,
+               'clean_cosmic_rays': clean_cosmic_rays}
+    shards = ShardManifest.create(jobs, workdir, options=options,
+                                  cadences_per_shard=cadences_per_shard,
+                                  tpf_groups=tpf_groups)
+    if not os.path.isdir(shards.workdir):
+        os.makedirs(shards.workdir)
+    shards.writeto(manifest)
+    click.echo('Wrote {} with {} shards.'.format(manifest, len(shards)), err=True)
+
+
+@k2mosaic.command(name='run-shard', short_help='Execute one shard of a manifest.')
+@click.argument('manifest', type=click.Path(exists=True))
+@click.argument('shard_id', type=click.IntRange(min=0))
+@click.option('-p', '--processes', type=click.IntRange(min=1),
+              default=None, metavar='<CPUs>',
+              help='Number of processes to use (default: #CPUs)')
+@click.option('-f', '--force', is_flag=True,
+              help='Run the shard even if it has already completed')
+@_resource_options
+@_metrics_options
+def run_shard(manifest, shard_id, processes, force, max_memory, max_workers,
+              metrics_jsonl, metrics_prom):
+    """Execute shard SHARD_ID of the manifest written by `k2mosaic plan`.
+
+    Running a shard which has already completed does nothing, so a shard
+    can safely be resubmitted.  The exit code is non-zero if any of its
+    mosaics could not be made.
+    """
+    from .shards import ShardManifest
+    shards = ShardManifest.read(manifest)
+    if shard_id >= len(shards):
+        raise click.BadParameter('the manifest has {} shards'.format(len(shards)),
+                                 param_hint='SHARD_ID')
+    job = shards.jobs[shards.shards[shard_id]['job']]
+    metrics = _make_metrics(job, metrics_jsonl, metrics_prom)
+    metrics.labels['shard'] = str(shard_id)
+    outputs = k2mosaic_run_shard(shards, shard_id, processes=processes, force=force,
+                                 max_memory=max_memory, max_workers=max_workers,
+                                 metrics=metrics)
+    if None in outputs:
+        click.secho('Shard {}: {} of {} mosaics failed.'.format(
+                    shard_id, outputs.count(None), len(outputs)), fg='red', err=True)
+        if metrics.failures:
+            click.secho(metrics.summary(), fg='red', err=True)
+        raise SystemExit(1)
+
+
+def k2mosaic_run_shard(shards, shard_id, processes=None, force=False, max_memory=None,
+                       max_workers=None, metrics=None):
+    """Executes one shard of a `ShardManifest`, unless it has already completed.
+
+    Returns the list of files written, with `None` for failed mosaics."""
+    import os
+    if not force and shards.is_done(shard_id):
+        click.echo('Shard {} has already completed.'.format(shard_id), err=True)
+        return shards.outputs(shard_id)
+    shard = shards.shards[shard_id]
+    job = shards.jobs[shard['job']]
+    output_prefix = shards.output_prefix(shard_id)
+    output_dir = os.path.dirname(output_prefix)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    outputs = k2mosaic_mosaic(shards.tpf_filenames(shard_id), job['mission'],
+                              job['campaign'], job['channel'], shard['cadences'],
+                              output_prefix=output_prefix, processes=processes,
+                              reference_fn=job['reference_fn'],
+                              coverage_fn=job['coverage_fn'],
+                              cosmic_ray_fn=job['cosmic_ray_fn'], max_memory=max_memory,
+                              max_workers=max_workers, metrics=metrics,
+                              ownership_fn=job.get('ownership_fn'), **shards.options)
+    if None not in outputs:
+        shards.mark_done(shard_id, outputs)
+    return outputs
+
+
+@k2mosaic.command(short_help='Check that all shards completed and combine their output.')
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option('--status', is_flag=True,
+              help='Only list the shards which have not completed')
+@click.option('--clean', is_flag=True,
+              help='Remove the partial mosaics once they have been merged')
+def merge(manifest, status, clean):
+    """Verify that every shard of MANIFEST has completed, and combine the
+    partial mosaics written by shards of the same channel and cadences."""
+    from .shards import ShardManifest, ShardException, merge_shards
+    shards = ShardManifest.read(manifest)
+    if status:
+        pending = shards.pending()
+        click.echo('{} of {} shards have completed.'.format(len(shards) - len(pending),
+                                                            len(shards)))
+        for shard_id in pending:
+            click.echo(shard_id)
+        return
+    try:
+        outputs = merge_shards(shards, clean=clean)
+    except ShardException as e:
+        raise click.ClickException(str(e))
+    click.secho('{} mosaics are complete.'.format(len(outputs)), fg='green')
 
 
 @k2mosaic.command()
@@ -165,22 +980,58 @@ def mosaic(filelist, cadence, step, add_background, processes, output):
 @click.option('--fps', type=float, default=5, metavar='FPS',
               help='frames per second (default: 15)')
 @click.option('--dpi', type=float, default=50, metavar='DPI',
-              help='resolution of the output in dots per K2 pixel (default: 50)')
+              help='resolution of .mp4 output in dots per K2 pixel (default: 50)')
 @click.option('--cut', type=str, default=None, metavar='min_cut..max_cut',
-              help='minimum/maximum cut levels')
+              help='minimum/maximum cut levels (default: per frame for .mp4, '
+                   'shared by all frames for .gif)')
 @click.option('--cmap', type=str, default='gray', metavar='colormap_name',
               help='matplotlib color map name (default: gray)')
 @click.option('-e', '--ext', type=int, default=1,
               help='FITS extension number (default: 1)')
-def movie(filelist, output, rows, cols, fps, dpi, cut, cmap, ext, **kwargs):
+@click.option('--stats', 'stats_fn', type=click.Path(exists=True, dir_okay=False),
+              default=None, metavar='<stats.fits>',
+              help='statistics table written by `k2mosaic mosaic`, used to skip '
+                   'frames without data and to crop and stretch without reading '
+                   'the images first')
+def movie(filelist, output, rows, cols, fps, dpi, cut, cmap, ext, stats_fn, **kwargs):
     """Turn mosaics into a movie or animated gif.
 
     FILELIST should be a text file listing the mosaics to animate,
     containing one path or url per line."""
     mosaic_filenames = [path.strip() for path in filelist.read().splitlines()]
+    statistics = None
+    if stats_fn is not None:
+        from .framestats import FrameStatistics
+        statistics = FrameStatistics.read(stats_fn)
+        mosaic_filenames = statistics.valid_filenames(mosaic_filenames)
+        if len(mosaic_filenames) == 0:
+            raise click.ClickException('None of the mosaics contain data.')
+    rowrange, colrange = _parse_crop(mosaic_filenames[0], rows, cols, ext,
+                                     statistics=statistics)
+    if cut is not None:
+        cut = [int(c) for c in cut.split("..")]
 
+    from .movie import KeplerMosaicMovie
+    kmm = KeplerMosaicMovie(mosaic_filenames, colrange=colrange, rowrange=rowrange,
+                            statistics=statistics)
+    click.echo('\nStarted writing {}'.format(output))
+    kmm.to_movie(output, extension=ext, fps=fps, dpi=dpi, cut=cut, cmap=cmap)
+    click.secho('Finished writing {}'.format(output), fg='green')
+
+
+def _parse_crop(mosaic_filename, rows, cols, ext=1, statistics=None):
+    """Parses the --rows/--cols options of `movie` and `pyramid`,
+    cropping to the pixels with data of the first mosaic by default,
+    or to those of all the mosaics if their `statistics` are given."""
+    import numpy as np
+    if (rows is None or cols is None) and statistics is not None and ext == 1:
+        bounds = statistics.bounds()
+        if bounds is not None:
+            rows = rows or '{}..{}'.format(*bounds[0])
+            cols = cols or '{}..{}'.format(*bounds[1])
     if rows is None or cols is None:
-        idx_not_nan = np.argwhere(np.isfinite(fits.open(mosaic_filenames[0])[1].data))
+        from .sparse import read_mosaic_image
+        idx_not_nan = np.argwhere(np.isfinite(read_mosaic_image(mosaic_filename, ext)))
 
     if rows is None:
         rowrange = (np.min(idx_not_nan[:, 0]), np.max(idx_not_nan[:, 0]))
@@ -195,15 +1046,156 @@ def movie(filelist, output, rows, cols, fps, dpi, cut, cmap, ext, **kwargs):
         colrange = (0, KEPLER_CHANNEL_SHAPE[1])
     else:
         colrange = [int(c) for c in cols.split("..")]
+    return rowrange, colrange
+
+
+@k2mosaic.command(short_help='Turn mosaics into zoomable tile pyramids.')
+@click.argument('filelist', type=click.File('r'))
+@click.option('-o', '--output', type=click.Path(file_okay=False), default='.',
+              help='output directory (default: current directory)')
+@click.option('-r', '--rows', type=str, default='all', metavar='row1..row2',
+              help="row range, or 'data' to crop to the data (default: all)")
+@click.option('-c', '--cols', type=str, default='all', metavar='col1..col2',
+              help="column range, or 'data' to crop to the data (default: all)")
+@click.option('--cut', type=str, default=None, metavar='min_cut..max_cut',
+              help='minimum/maximum cut levels (default: the 10th and 99.5th '
+                   'percentiles of a sample of the mosaics)')
+@click.option('--cmap', type=str, default='gray', metavar='colormap_name',
+              help='matplotlib color map name (default: gray)')
+@click.option('--zoom', type=click.Choice(['1', '2', '4', '8', '16', '32']), default='16',
+              help='screen pixels per K2 pixel at the highest resolution (default: 16)')
+@click.option('--tile-size', type=click.IntRange(min=16), default=256, metavar='<px>',
+              help='tile size in screen pixels (default: 256)')
+@click.option('-j', '--workers', type=click.IntRange(min=1), default=None, metavar='<N>',
+              help='number of threads writing tiles (default: #CPUs + 4, at most 32)')
+@click.option('-e', '--ext', type=int, default=1,
+              help='FITS extension number (default: 1)')
+def pyramid(filelist, output, rows, cols, cut, cmap, zoom, tile_size, workers, ext):
+    """Turn mosaics into Deep Zoom image pyramids.
 
+    FILELIST should be a text file listing the mosaics, containing one path
+    or url per line.  For each mosaic, a .dzi file and a directory of PNG
+    tiles are written, which can be browsed using e.g. OpenSeadragon.
+    Only the tiles which contain data are written, and the same stretch
+    is used for every mosaic."""
+    import os
+    mosaic_filenames = [path.strip() for path in filelist.read().splitlines()]
+    rowrange, colrange = _parse_crop(mosaic_filenames[0],
+                                     None if rows == 'data' else rows,
+                                     None if cols == 'data' else cols, ext)
     if cut is not None:
-        cut = [int(c) for c in cut.split("..")]
+        cut = [float(c) for c in cut.split("..")]
+    if not os.path.isdir(output):
+        os.makedirs(output)
 
     from .movie import KeplerMosaicMovie
     kmm = KeplerMosaicMovie(mosaic_filenames, colrange=colrange, rowrange=rowrange)
-    click.echo('\nStarted writing {}'.format(output))
-    kmm.to_movie(output, extension=ext, fps=fps, dpi=dpi, cut=cut, cmap=cmap)
-    click.secho('Finished writing {}'.format(output), fg='green')
+    dzi_filenames = kmm.export_pyramids(output, extension=ext, cut=cut, cmap=cmap,
+                                        zoom=int(zoom), tile_size=tile_size, workers=workers)
+    click.secho('Finished writing {} pyramids to {}'.format(len(dzi_filenames), output),
+                fg='green')
+
+
+@k2mosaic.command(short_help='Cut movies or cubes of many targets out of one pass over the data.')
+@click.argument('filelist', type=click.File('r'))
+@click.argument('targets', type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', type=str, default='cutout-',
+              help="output filename prefix, followed by each target's name (default: cutout-)")
+@click.option('-f', '--format', 'fmt', type=click.Choice(['gif', 'mp4', 'fits']), default='gif',
+              help='animated gif, mp4 video, or FITS cube (default: gif)')
+@click.option('-s', '--size', type=click.IntRange(min=1), default=50, metavar='<px>',
+              help='size of the boxes which do not set it in TARGETS (default: 50)')
+@click.option('--tpfs', is_flag=True,
+              help='FILELIST lists target pixel files rather than mosaics')
+@click.option('--add-background', is_flag=True,
+              help='Add the background flux (with --tpfs)')
+@click.option('--fps', type=float, default=5, metavar='FPS',
+              help='frames per second (default: 5)')
+@click.option('--cut', type=str, default=None, metavar='min_cut..max_cut',
+              help='minimum/maximum cut levels (default: per target, from the '
+                   'percentiles of its first frames)')
+@click.option('--cmap', type=str, default='gray', metavar='colormap_name',
+              help='matplotlib color map name (default: gray)')
+@click.option('-j', '--workers', type=click.IntRange(min=1), default=None, metavar='<N>',
+              help='number of threads encoding the cutouts (default: #CPUs + 4, at most 32)')
+@click.option('-e', '--ext', type=int, default=1,
+              help='FITS extension number, 2 for the uncertainties (default: 1)')
+def cutouts(filelist, targets, output, fmt, size, tpfs, add_background, fps, cut, cmap,
+            workers, ext):
+    """Cut a movie or cube for every target in TARGETS out of the mosaics
+    listed in FILELIST, reading each mosaic only once.
+
+    TARGETS is a csv file with the centre of each box in 'row' and 'col'
+    (zero-based pixels) or 'ra' and 'dec' (degrees) columns, and optionally
+    'name', 'size', or 'height' and 'width' columns."""
+    import fitsio
+    from .cutouts import (CutoutException, cube_frames, mosaic_frames,
+                          read_targets, write_cutouts)
+    filenames = [path.strip() for path in filelist.read().splitlines() if path.strip()]
+    if tpfs:
+        from .cube import KeplerChannelCube
+        cube = KeplerChannelCube(filenames, column='FLUX' if ext == 1 else 'FLUX_ERR',
+                                 add_background=add_background)
+        from .geometry import pinned_path
+        with pinned_path(filenames[0]) as path:
+            hdr = fitsio.read_header(path, ext=0)
+        campaign, channel = hdr.get('CAMPAIGN'), hdr.get('CHANNEL')
+    else:
+        campaign = fitsio.read_header(filenames[0], ext=0).get('CAMPAIGN')
+        channel = fitsio.read_header(filenames[0], ext=ext).get('CHANNEL')
+    try:
+        target_list = read_targets(targets, campaign=campaign, channel=channel, size=size)
+    except CutoutException as e:
+        raise click.ClickException(str(e))
+    if tpfs:
+        frames, n_frames = cube_frames(cube, target_list), len(cube)
+    else:
+        frames, n_frames = mosaic_frames(filenames, target_list, extension=ext), len(filenames)
+    cuts = None
+    if cut is not None:
+        cuts = [[float(c) for c in cut.split("..")]] * len(target_list)
+    written = write_cutouts(frames, target_list, output_prefix=output, fmt=fmt,
+                            n_frames=n_frames, cuts=cuts, cmap=cmap, fps=fps, workers=workers,
+                            header={'CAMPAIGN': campaign, 'CHANNEL': channel})
+    click.secho('Finished writing {} cutouts of {} frames'.format(len(written), n_frames),
+                fg='green')
+
+
+@k2mosaic.command(short_help='Serve images, cutouts, and frames of a set of TPFs over HTTP.')
+@click.argument('filelist', type=click.File('r'))
+@click.option('--host', type=str, default='127.0.0.1', show_default=True,
+              help='Address to listen on')
+@click.option('-p', '--port', type=click.IntRange(min=0), default=8000, show_default=True,
+              help='Port to listen on (0 picks a free port)')
+@click.option('--cache-size', type=str, default='512M', show_default=True, metavar='<size>',
+              help='Memory kept for decoded TPF data between requests, e.g. 2G')
+@click.option('-j', '--workers', type=click.IntRange(min=1), default=4, show_default=True,
+              metavar='<N>', help='Number of requests handled at once')
+@click.option('--add-background', is_flag=True,
+              help='Add the background back to the flux')
+@click.option('-v', '--verbose', is_flag=True, help='Log every request')
+def serve(filelist, host, port, cache_size, workers, add_background, verbose):
+    """Serve the channel images, cutouts, and rendered frames of the TPFs
+    listed in FILELIST, keeping decoded TPF data in memory between requests.
+
+    \b
+    GET /image/<cadenceno>.fits
+    GET /cutout.fits?row=&col=&height=&width=[&start=&stop=]
+    GET /frame/<cadenceno>.png[?row=&col=&height=&width=&cut=min..max&cmap=]
+    GET /stats and /metrics for request latencies and cache hit rates"""
+    from .server import MosaicServer, MosaicService
+    tpf_filenames = [path.strip() for path in filelist.read().splitlines() if path.strip()]
+    service = MosaicService(tpf_filenames, cache_size=cache_size,
+                            add_background=add_background)
+    server = MosaicServer((host, port), service, workers=workers, verbose=verbose)
+    click.secho('Serving {} TPFs of channel {} at {}'.format(
+                len(tpf_filenames), service.channel, server.url), fg='green')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
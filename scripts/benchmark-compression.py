@@ -0,0 +1,81 @@
+"""
+Benchmarks the size, write time, and reconstruction error of the
+tile-compressed mosaic output (`k2mosaic mosaic --compress`).
+
+Usage:
+    python benchmark-compression.py [k2mosaic-c05-ch13-cad110000.fits]
+
+If no mosaic is given, a synthetic channel with ~10% of the pixels
+covered by apertures containing stars is used instead.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from k2mosaic import KEPLER_CHANNEL_SHAPE
+
+MODES = [(None, None), ('GZIP_1', 0.), ('GZIP_2', 0.),
+         ('RICE_1', 4.), ('RICE_1', 16.), ('RICE_1', 64.),
+         ('GZIP_2', 4.), ('GZIP_2', 16.), ('HCOMPRESS_1', 16.)]
+
+
+def synthetic_channel(coverage=0.1, seed=42):
+    """Returns a mostly-NaN (image, uncertainty) pair resembling a K2 mosaic."""
+    rng = np.random.RandomState(seed)
+    image = np.full(KEPLER_CHANNEL_SHAPE, np.nan, dtype=np.float32)
+    n_apertures = int(coverage * image.size / 100.)
+    for _ in range(n_apertures):
+        row = rng.randint(0, KEPLER_CHANNEL_SHAPE[0] - 10)
+        col = rng.randint(0, KEPLER_CHANNEL_SHAPE[1] - 10)
+        y, x = np.mgrid[:10, :10]
+        star = rng.lognormal(8, 1.5) * np.exp(-((y - 4.5)**2 + (x - 4.5)**2) / 2.)
+        image[row:row+10, col:col+10] = 50. + star
+    uncert = np.sqrt(np.abs(image) + 100.).astype(np.float32)
+    image += rng.normal(size=image.shape).astype(np.float32) * uncert
+    return image, uncert
+
+
+def write(image, uncert, output_fn, compression, quantize_level):
+    if compression is None:
+        hdus = [fits.ImageHDU(image), fits.ImageHDU(uncert)]
+    else:
+        hdus = [fits.CompImageHDU(data, compression_type=compression,
+                                  quantize_level=quantize_level,
+                                  quantize_method=1, dither_seed=1)
+                for data in [image, uncert]]
+    fits.HDUList([fits.PrimaryHDU()] + hdus).writeto(output_fn, overwrite=True, checksum=True)
+
+
+def benchmark(image, uncert, repeat=3):
+    print("{:<12} {:>5} {:>10} {:>10} {:>12} {:>12}".format(
+          "compression", "q", "size [MB]", "write [s]", "rms err/sig", "max err/sig"))
+    finite = np.isfinite(image)
+    output_fn = os.path.join(tempfile.mkdtemp(), 'benchmark.fits')
+    for compression, quantize_level in MODES:
+        elapsed = []
+        for _ in range(repeat):
+            start = time.time()
+            write(image, uncert, output_fn, compression, quantize_level)
+            elapsed.append(time.time() - start)
+        with fits.open(output_fn) as hdulist:
+            restored = hdulist[1].data
+        assert np.array_equal(np.isfinite(restored), finite)
+        error = (restored[finite] - image[finite]) / uncert[finite]
+        print("{:<12} {:>5} {:>10.2f} {:>10.3f} {:>12.2e} {:>12.2e}".format(
+              str(compression), str(quantize_level), os.path.getsize(output_fn) / 1e6,
+              min(elapsed), np.sqrt(np.mean(error**2)), np.max(np.abs(error))))
+    os.remove(output_fn)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with fits.open(sys.argv[1]) as hdulist:
+            image, uncert = hdulist[1].data, hdulist[2].data
+    else:
+        image, uncert = synthetic_channel()
+    print("{:.1%} of the pixels are covered.".format(np.isfinite(image).mean()))
+    benchmark(image, uncert)
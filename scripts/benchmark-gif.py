@@ -0,0 +1,76 @@
+"""
+Benchmarks the encode time and size of animated gif movies written by
+`k2mosaic movie`, comparing the global-palette, frame-delta writer
+(`KeplerMosaicMovie.to_gif`) with the previous approach of rendering
+each frame with matplotlib and letting imageio quantize it.
+
+Usage:
+    python benchmark-gif.py [n_frames]
+
+The mosaics are synthetic: a channel with ~10% of the pixels covered by
+apertures containing stars, with new noise in every frame.  Both the full
+channel and a 110x110 pixel crop are benchmarked.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import imageio
+import numpy as np
+from astropy.io import fits
+
+from k2mosaic import KEPLER_CHANNEL_SHAPE
+from k2mosaic.movie import KeplerMosaicMovie
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from importlib import import_module
+synthetic_channel = import_module('benchmark-compression').synthetic_channel
+
+CROPS = [('full channel', (0, KEPLER_CHANNEL_SHAPE[0]), (0, KEPLER_CHANNEL_SHAPE[1])),
+         ('110x110 crop', (400, 510), (500, 610))]
+
+
+def write_mosaics(directory, n_frames, seed=42):
+    image, uncert = synthetic_channel(seed=seed)
+    rng = np.random.RandomState(seed)
+    filenames = []
+    for idx in range(n_frames):
+        frame = image + rng.normal(size=image.shape).astype(np.float32) * uncert
+        fn = os.path.join(directory, 'mosaic-{:03d}.fits'.format(idx))
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(frame)]).writeto(fn)
+        filenames.append(fn)
+    return filenames
+
+
+def imageio_gif(movie, output_fn, fps, cut):
+    """The previous `to_movie` gif output: quantizes every frame separately."""
+    frames = list(movie.render_frames(cut=cut))
+    imageio.mimsave(output_fn, frames, duration=1000. / fps)
+
+
+def benchmark(filenames, fps=15.):
+    print("{:<14} {:<10} {:>8} {:>10} {:>10}".format(
+          "frames", "writer", "width", "size [MB]", "time [s]"))
+    output_dir = tempfile.mkdtemp()
+    for label, rowrange, colrange in CROPS:
+        movie = KeplerMosaicMovie(filenames, rowrange=rowrange, colrange=colrange)
+        cut = movie.cut_levels()
+        for writer in ['imageio', 'to_gif']:
+            output_fn = os.path.join(output_dir, writer + '.gif')
+            start = time.time()
+            if writer == 'imageio':
+                imageio_gif(movie, output_fn, fps, cut)
+            else:
+                movie.to_gif(output_fn, fps=fps, cut=cut)
+            elapsed = time.time() - start
+            width = imageio.v2.imread(output_fn).shape[1]
+            print("{:<14} {:<10} {:>8} {:>10.2f} {:>10.2f}".format(
+                  label, writer, width, os.path.getsize(output_fn) / 1e6, elapsed))
+            os.remove(output_fn)
+
+
+if __name__ == '__main__':
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    filenames = write_mosaics(tempfile.mkdtemp(), n_frames)
+    benchmark(filenames)
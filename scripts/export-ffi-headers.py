@@ -1,6 +1,25 @@
 """
 Extracts WCS keywords from the real FFI images and saves them to
-`k2mosaic/data/k2-ffi-headers.csv`."""
+`k2mosaic/data/k2-ffi-headers.csv`.
+
+Usage:
+    python export-ffi-headers.py [--rebuild] [--processes N] [FFI_DIRECTORY]
+
+By default only the FFIs which are not yet listed in the table are read,
+and FFI_DIRECTORY defaults to $K2DATA/ffi.
+"""
+import argparse
+
 import k2mosaic
 
-k2mosaic.export_ffi_headers()
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('ffi_store', nargs='?', default=None)
+parser.add_argument('--rebuild', action='store_true',
+                    help='re-read all FFIs rather than only the new ones')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='number of processes to use (default: #CPUs)')
+args = parser.parse_args()
+
+k2mosaic.export_ffi_headers(ffi_store=args.ffi_store, processes=args.processes,
+                            incremental=not args.rebuild)
@@ -29,18 +29,18 @@ setup(name='k2mosaic',
       packages=['k2mosaic'],
       package_data={'k2mosaic': ['data/*.csv']},
       install_requires=['astropy>=2.0.8',
-                        'numpy>=1.16',
+                        'numpy>=1.20',
                         'pandas',
                         'click',
                         'requests',
                         'imageio>=1',
                         'fitsio'],
+      python_requires='>=3.7',
       entry_points=entry_points,
       classifiers=[
           "Development Status :: 5 - Production/Stable",
           "License :: OSI Approved :: MIT License",
           "Operating System :: OS Independent",
-          "Programming Language :: Python :: 2.7",
           "Programming Language :: Python :: 3",
           "Intended Audience :: Science/Research",
           "Topic :: Scientific/Engineering :: Astronomy",